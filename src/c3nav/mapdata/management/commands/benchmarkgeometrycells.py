@@ -0,0 +1,73 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+from shapely import prepared
+from shapely.geometry import box
+
+from c3nav.mapdata.models import Level
+from c3nav.mapdata.utils.cache.indexed import GeometryIndexed
+from c3nav.mapdata.utils.geometry import unwrap_geom
+
+
+def get_geometry_cells_reference(indexed, geometry, bounds):
+    # the original implementation, testing every cell with shapely separately
+    minx, miny, maxx, maxy = bounds
+    height, width = indexed.data.shape
+    minx = max(minx, indexed.x)
+    miny = max(miny, indexed.y)
+    maxx = min(maxx, indexed.x + width)
+    maxy = min(maxy, indexed.y + height)
+
+    cells = np.zeros_like(indexed.data, dtype=bool)
+    prep = prepared.prep(geometry)
+    res = indexed.resolution
+    for iy, y in enumerate(range(miny * res, maxy * res, res), start=miny - indexed.y):
+        for ix, x in enumerate(range(minx * res, maxx * res, res), start=minx - indexed.x):
+            if prep.intersects(box(x, y, x + res, y + res)):
+                cells[iy, ix] = True
+    return cells
+
+
+class Command(BaseCommand):
+    help = 'benchmark GeometryIndexed.get_geometry_cells against the original per-cell implementation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolution', type=int, default=None,
+                            help=_('cell resolution, defaults to CACHE_RESOLUTION'))
+
+    def handle(self, *args, **options):
+        durations = {'reference': 0, 'vectorized': 0, 'vectorized (center)': 0}
+        mismatches = 0
+        num_geometries = 0
+        for level in Level.objects.prefetch_related('spaces'):
+            geometries = tuple(unwrap_geom(space.geometry) for space in level.spaces.all())
+            if not geometries:
+                continue
+            indexed = GeometryIndexed(resolution=options['resolution'])
+            for geometry in geometries:
+                indexed.fit_bounds(*indexed._get_geometry_bounds(geometry))
+
+            for geometry in geometries:
+                bounds = indexed._get_geometry_bounds(geometry)
+
+                start = time.perf_counter()
+                reference = get_geometry_cells_reference(indexed, geometry, bounds)
+                durations['reference'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                result = indexed.get_geometry_cells(geometry, bounds)
+                durations['vectorized'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                indexed.get_geometry_cells(geometry, bounds, touches=False)
+                durations['vectorized (center)'] += time.perf_counter() - start
+
+                mismatches += int((reference != result).any())
+                num_geometries += 1
+
+        self.stdout.write('%d geometries' % num_geometries)
+        for name, duration in durations.items():
+            self.stdout.write('  %s: %.3f s (%.1fx)' % (name, duration, durations['reference'] / max(duration, 1e-9)))
+        self.stdout.write('  geometries with mismatching cells: %d' % mismatches)
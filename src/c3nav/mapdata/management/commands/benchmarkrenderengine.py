@@ -0,0 +1,76 @@
+import io
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext_lazy as _
+from PIL import Image
+
+from c3nav.mapdata.models import AccessRestriction, Level
+from c3nav.mapdata.render.engines import RasterEngine, SVGEngine
+from c3nav.mapdata.render.renderer import MapRenderer
+from c3nav.mapdata.utils.cache.package import CachePackage
+from c3nav.mapdata.utils.tiles import get_tile_bounds
+
+
+class Command(BaseCommand):
+    help = 'compare the raster render engine with the svg render engine on random tiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tiles', type=int, default=100, help=_('number of random tiles per zoom level'))
+        parser.add_argument('--zoom', type=int, action='append', default=None,
+                            help=_('zoom level to render, can be given multiple times (default: 0, 3 and 5)'))
+        parser.add_argument('--seed', type=int, default=0, help=_('random seed for tile selection'))
+        parser.add_argument('--threshold', type=int, default=24,
+                            help=_('maximum difference of a pixel channel (0-255) to still count as equal'))
+        parser.add_argument('--max-different', type=float, default=0.01,
+                            help=_('maximum share of different pixels of a tile to count as equivalent'))
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        package = CachePackage.open_cached()
+        minx, miny, maxx, maxy = package.bounds
+        levels = tuple(Level.objects.filter(on_top_of__isnull=True).values_list('pk', flat=True))
+        if not levels:
+            raise CommandError(_('No levels to render.'))
+        access_permissions = AccessRestriction.get_all_public()
+
+        for zoom in (options['zoom'] or (0, 3, 5)):
+            size = 256 / 2 ** zoom
+            tiles = []
+            for i in range(options['tiles']):
+                x = rng.randrange(int(minx // size), int(maxx // size) + 1)
+                y = rng.randrange(int(-maxy // size) - 1, int(-miny // size) + 1)
+                tiles.append((rng.choice(levels), x, y))
+
+            durations = {SVGEngine: 0, RasterEngine: 0}
+            images = {SVGEngine: [], RasterEngine: []}
+            for engine in durations:
+                start = time.perf_counter()
+                for level, x, y in tiles:
+                    renderer = MapRenderer(level, *get_tile_bounds(zoom, x, y), scale=2 ** zoom,
+                                           access_permissions=access_permissions)
+                    images[engine].append(renderer.render(engine, theme=None).render())
+                durations[engine] = time.perf_counter() - start
+
+            max_differences = []
+            different_shares = []
+            for svg_png, raster_png in zip(images[SVGEngine], images[RasterEngine]):
+                svg_image = np.asarray(Image.open(io.BytesIO(svg_png)).convert('RGB'), dtype=np.int16)
+                raster_image = np.asarray(Image.open(io.BytesIO(raster_png)).convert('RGB'), dtype=np.int16)
+                difference = np.abs(svg_image - raster_image).max(axis=2)
+                max_differences.append(int(difference.max()))
+                different_shares.append(float((difference > options['threshold']).mean()))
+
+            self.stdout.write('zoom %d: %d tiles' % (zoom, len(tiles)))
+            for engine, duration in durations.items():
+                self.stdout.write('  %s: %.1f tiles/s' % (engine.__name__, len(tiles) / duration))
+            self.stdout.write('  speedup: %.1fx' % (durations[SVGEngine] / durations[RasterEngine]))
+            self.stdout.write('  max pixel difference: %d, mean share of different pixels: %.4f' % (
+                max(max_differences), sum(different_shares) / len(different_shares)
+            ))
+            self.stdout.write('  tiles with more than %.2f%% different pixels: %d' % (
+                options['max_different'] * 100,
+                sum(share > options['max_different'] for share in different_shares),
+            ))
@@ -0,0 +1,65 @@
+import gzip
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext_lazy as _
+
+from c3nav.mapdata.models import AccessRestriction, Level
+from c3nav.mapdata.render.engines import ImageRenderEngine, VectorTileEngine
+from c3nav.mapdata.render.renderer import MapRenderer
+from c3nav.mapdata.utils.cache.package import CachePackage
+from c3nav.mapdata.utils.tiles import get_tile_bounds
+
+
+class Command(BaseCommand):
+    help = 'compare size and render time of vector tiles and png tiles on random tiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tiles', type=int, default=100, help=_('number of random tiles per zoom level'))
+        parser.add_argument('--zoom', type=int, action='append', default=None,
+                            help=_('zoom level to render, can be given multiple times (default: 0, 3 and 5)'))
+        parser.add_argument('--seed', type=int, default=0, help=_('random seed for tile selection'))
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        package = CachePackage.open_cached()
+        minx, miny, maxx, maxy = package.bounds
+        levels = tuple(Level.objects.filter(on_top_of__isnull=True).values_list('pk', flat=True))
+        if not levels:
+            raise CommandError(_('No levels to render.'))
+        access_permissions = AccessRestriction.get_all_public()
+
+        for zoom in (options['zoom'] or (0, 3, 5)):
+            size = 256 / 2 ** zoom
+            tiles = []
+            for i in range(options['tiles']):
+                x = rng.randrange(int(minx // size), int(maxx // size) + 1)
+                y = rng.randrange(int(-maxy // size) - 1, int(-miny // size) + 1)
+                tiles.append((rng.choice(levels), x, y))
+
+            # cpu time, so waiting for the database or the disk doesn't count
+            durations = {ImageRenderEngine: 0, VectorTileEngine: 0}
+            sizes = {ImageRenderEngine: 0, VectorTileEngine: 0}
+            gzipped_size = 0
+            for engine in durations:
+                start = time.process_time()
+                for level, x, y in tiles:
+                    renderer = MapRenderer(level, *get_tile_bounds(zoom, x, y), scale=2 ** zoom,
+                                           access_permissions=access_permissions)
+                    data = renderer.render(engine, theme=None).render()
+                    sizes[engine] += len(data)
+                    if engine is VectorTileEngine:
+                        gzipped_size += len(gzip.compress(data))
+                durations[engine] = time.process_time() - start
+
+            self.stdout.write('zoom %d: %d tiles' % (zoom, len(tiles)))
+            for engine, duration in durations.items():
+                self.stdout.write('  %s (%s): %.2f ms cpu time per tile, %.1f KiB per tile' % (
+                    engine.__name__, engine.filetype, duration / len(tiles) * 1000, sizes[engine] / len(tiles) / 1024
+                ))
+            self.stdout.write('  %s gzipped: %.1f KiB per tile' % (VectorTileEngine.__name__,
+                                                                   gzipped_size / len(tiles) / 1024))
+            self.stdout.write('  size ratio (gzipped mvt / png): %.2f, cpu time ratio (mvt / png): %.2f' % (
+                gzipped_size / sizes[ImageRenderEngine], durations[VectorTileEngine] / durations[ImageRenderEngine]
+            ))
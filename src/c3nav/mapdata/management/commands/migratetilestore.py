@@ -0,0 +1,106 @@
+import logging
+import os
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+
+from c3nav.mapdata.utils.cache import TileStore
+from c3nav.mapdata.views import get_tile_last_update_filename, get_tile_store_theme_key
+
+
+class Command(BaseCommand):
+    help = 'move tiles from the tile directories into the sqlite tile store and warm it up'
+
+    filetypes = ('png', 'mvt')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_const', const=True, default=False,
+                            help=_('delete the moved tiles from the tile directories'))
+        parser.add_argument('--prerender', action='store_const', const=True, default=False,
+                            help=_('prerender all outdated tiles afterwards'))
+
+    @staticmethod
+    def _iter_tile_directories():
+        # TILES_ROOT/level/zoom/x/y/access_cache_key/
+        for level in os.scandir(settings.TILES_ROOT):
+            if not level.is_dir() or not level.name.isdigit():
+                continue
+            for zoom in os.scandir(level.path):
+                if not zoom.is_dir():
+                    continue
+                for x in os.scandir(zoom.path):
+                    if not x.is_dir():
+                        continue
+                    for y in os.scandir(x.path):
+                        for access in os.scandir(y.path):
+                            if access.is_dir() and not access.name.endswith('_old_tile_dir'):
+                                yield (int(level.name), int(zoom.name), int(x.name), int(y.name),
+                                       access.name, access.path)
+
+    def _iter_tiles(self):
+        """ yields every tile in the tile store format, with the file it was read from """
+        for level, zoom, x, y, access_cache_key, path in self._iter_tile_directories():
+            filenames = os.listdir(path)
+            for filetype in self.filetypes:
+                last_update_filename = get_tile_last_update_filename(filetype)
+                try:
+                    with open(os.path.join(path, last_update_filename)) as f:
+                        base_cache_key = f.read()
+                except FileNotFoundError:
+                    continue
+                for filename in filenames:
+                    if filename.endswith('.' + filetype) and filename != last_update_filename:
+                        theme_key = get_tile_store_theme_key(filename[:-len(filetype)-1], filetype)
+                        with open(os.path.join(path, filename), 'rb') as f:
+                            yield ((level, zoom, x, y, theme_key, base_cache_key, access_cache_key, f.read()),
+                                   os.path.join(path, filename))
+
+    def _remove_empty_tile_directories(self):
+        # remove last update files of tile types that have no tiles left, then empty directories
+        last_update_filenames = {get_tile_last_update_filename(filetype): filetype for filetype in self.filetypes}
+        for level in os.scandir(settings.TILES_ROOT):
+            if not level.is_dir() or not level.name.isdigit():
+                continue
+            for path, dirnames, filenames in os.walk(level.path, topdown=False):
+                for last_update_filename, filetype in last_update_filenames.items():
+                    if last_update_filename in filenames and not any(
+                        filename.endswith('.' + filetype) and filename not in last_update_filenames
+                        for filename in filenames
+                    ):
+                        os.remove(os.path.join(path, last_update_filename))
+                if not os.listdir(path):
+                    os.rmdir(path)
+
+    def handle(self, *args, **options):
+        logger = logging.getLogger('c3nav')
+
+        if settings.TILE_STORE != 'sqlite':
+            logger.warning('The sqlite tile store is not enabled, set tile_store=sqlite to use it.')
+
+        tile_store = TileStore(settings.TILE_STORE_FILE)
+
+        logger.info('Moving tiles into %s...' % settings.TILE_STORE_FILE)
+        tiles = self._iter_tiles()
+        while True:
+            batch = tuple(islice(tiles, 1000))
+            if not batch:
+                break
+            tile_store.put_many(tile for tile, filename in batch)
+            if options['delete']:
+                # only delete what was moved, other files in the tile directories are kept
+                for tile, filename in batch:
+                    os.remove(filename)
+        num_tiles, num_images = tile_store.stats()
+        logger.info('The tile store contains %d tiles using %d distinct images.' % (num_tiles, num_images))
+
+        if options['delete']:
+            logger.info('Removing empty tile directories...')
+            self._remove_empty_tile_directories()
+
+        if options['prerender']:
+            from c3nav.mapdata.render.prerender import prerender_tiles
+            prerender_tiles()
+
+        logger.info('Removed %d unused tile images.' % tile_store.clean())
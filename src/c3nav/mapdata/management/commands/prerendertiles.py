@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+
+from c3nav.mapdata.render.prerender import parse_prerender_access_permissions, prerender_tiles
+
+
+class Command(BaseCommand):
+    help = 'render outdated tiles into the tile cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zoom', type=int, action='append', default=None,
+                            help=_('zoom level to prerender, can be given multiple times '
+                                   '(default: all up to TILE_PRERENDER_MAX_ZOOM)'))
+        parser.add_argument('--access', type=str, default=None,
+                            help=_('access permission combinations like "0; 1,2; 3" (default: TILE_PRERENDER_ACCESS)'))
+        parser.add_argument('--since', type=int, default=None,
+                            help=_('only prerender tiles changed by map updates after the one with this id'))
+        parser.add_argument('--workers', type=int, default=None,
+                            help=_('number of worker processes (default: TILE_PRERENDER_WORKERS)'))
+
+    def handle(self, *args, **options):
+        if not settings.CACHE_TILES:
+            self.stderr.write(_('Tile caching is disabled, prerendered tiles would not be used.'))
+            return
+
+        prerender_tiles(
+            zooms=options['zoom'],
+            access_permission_combinations=(None if options['access'] is None
+                                            else parse_prerender_access_permissions(options['access'])),
+            since=options['since'],
+            workers=options['workers'],
+        )
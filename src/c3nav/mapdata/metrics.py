@@ -32,6 +32,19 @@ if settings.METRICS:
     reports_open = Gauge('c3nav_reports_open', 'Number of open reports', registry=REGISTRY)
     reports_open.set_function(lambda: Report.objects.filter(open=True).count()),
 
+    def tile_prerender_progress(key):
+        progress = cache.get('mapdata:tile-prerender-progress')
+        return progress[key] if progress else 0
+
+    tile_prerender_remaining = Gauge('c3nav_tile_prerender_remaining',
+                                     'Number of tiles or metatiles left to prerender', registry=REGISTRY)
+    tile_prerender_remaining.set_function(
+        lambda: tile_prerender_progress('total') - tile_prerender_progress('done')
+    )
+    tile_prerender_rate = Gauge('c3nav_tile_prerender_tiles_per_second',
+                                'Throughput of the current or last tile prerender run', registry=REGISTRY)
+    tile_prerender_rate.set_function(lambda: tile_prerender_progress('tiles_per_second'))
+
     class APIStatsCollector(Collector):
 
         name_registry: dict[str, None | Sequence[str]] = dict()
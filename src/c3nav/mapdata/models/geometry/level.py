@@ -248,13 +248,26 @@ class AltitudeArea(LevelGeometryMixin, models.Model):
             )
             altitudes = self.points[0].altitude + distances*(self.points[1].altitude-self.points[0].altitude)
         else:
-            altitudes = RBFInterpolator(
-                np.array([p.coordinates for p in self.points]),
-                np.array([p.altitude for p in self.points])
-            )(points)
+            altitudes = AltitudeArea.get_altitude_interpolator(self)(points)
 
         return np.clip(altitudes, a_min=min_altitude, a_max=max_altitude)
 
+    def get_altitude_interpolator(self) -> RBFInterpolator:
+        """
+        Get the interpolator for sloped altitude areas with more than two points.
+        It is only built once per area (and rebuilt if the points change), since building it is expensive.
+        This is also called with a RouterAltitudeArea as self, so only self.points may be used.
+        """
+        points = tuple((tuple(p.coordinates), p.altitude) for p in self.points)
+        cached = getattr(self, '_altitude_interpolator', None)
+        if cached is None or cached[0] != points:
+            cached = (points, RBFInterpolator(
+                np.array([coordinates for coordinates, altitude in points]),
+                np.array([altitude for coordinates, altitude in points])
+            ))
+            self._altitude_interpolator = cached
+        return cached[1]
+
     @classmethod
     def recalculate(cls):
         # collect location areas
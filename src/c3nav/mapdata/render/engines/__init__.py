@@ -8,12 +8,14 @@ from c3nav.mapdata.render.engines.openscad import OpenSCADEngine  # noqa
 from c3nav.mapdata.render.engines.wavefront import WavefrontEngine  # noqa
 from c3nav.mapdata.render.engines.stl import STLEngine  # noqa
 from c3nav.mapdata.render.engines.svg import SVGEngine  # noqa
+from c3nav.mapdata.render.engines.raster import RasterEngine  # noqa
+from c3nav.mapdata.render.engines.vectortile import VectorTileEngine  # noqa
 
 
 @checks.register()
 def check_image_renderer(app_configs, **kwargs):
     errors = []
-    if settings.IMAGE_RENDERER not in ('svg', 'opengl'):
+    if settings.IMAGE_RENDERER not in ('svg', 'raster', 'opengl'):
         errors.append(
             checks.Error(
                 'Invalid image renderer: '+settings.IMAGE_RENDERER,
@@ -26,6 +28,8 @@ def check_image_renderer(app_configs, **kwargs):
 
 if settings.IMAGE_RENDERER == 'opengl':
     from c3nav.mapdata.render.engines.opengl import OpenGLEngine as ImageRenderEngine  # noqa
+elif settings.IMAGE_RENDERER == 'raster':
+    from c3nav.mapdata.render.engines.raster import RasterEngine as ImageRenderEngine  # noqa
 else:
     from c3nav.mapdata.render.engines.svg import SVGEngine as ImageRenderEngine  # noqa
 
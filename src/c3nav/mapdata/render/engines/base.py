@@ -1,4 +1,5 @@
 import math
+import zlib
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Optional
@@ -57,6 +58,15 @@ class RenderEngine(ABC):
         # render the image to png.
         pass
 
+    def empty_png(self) -> bytes:
+        # create empty tile png with minimal size, indexed color palette with only one entry
+        plte = b'PLTE' + bytearray(tuple(int(i*255) for i in self.background_rgb))
+        return (b'\x89PNG\r\n\x1a\n' +
+                b'\x00\x00\x00\rIHDR\x00\x00\x01\x00\x00\x00\x01\x00\x01\x03\x00\x00\x00f\xbc:%\x00\x00\x00\x03' +
+                plte + zlib.crc32(plte).to_bytes(4, byteorder='big') +
+                b'\x00\x00\x00\x1fIDATh\xde\xed\xc1\x01\r\x00\x00\x00\xc2\xa0\xf7Om\x0e7\xa0\x00\x00\x00\x00\x00' +
+                b'\x00\x00\x00\xbe\r!\x00\x00\x01\x7f\x19\x9c\xa7\x00\x00\x00\x00IEND\xaeB`\x82')
+
     @staticmethod
     def color_to_rgb(color, alpha=None):
         return color_to_rgb(color, alpha=None)
@@ -67,6 +77,10 @@ class RenderEngine(ABC):
     def darken(self, area, much=False):
         pass
 
+    def add_restricted_areas(self, area):
+        # areas that are hidden because their access restriction was not unlocked
+        pass
+
     def add_geometry(self, geometry, fill: Optional[FillAttribs] = None, stroke: Optional[StrokeAttribs] = None,
                      altitude=None, height=None, shadow_color=None, shape_cache_key=None, category=None, item=None):
         # draw a shapely geometry with a given style
@@ -0,0 +1,186 @@
+import io
+from typing import Optional
+
+import numpy as np
+import shapely
+from PIL import Image
+from shapely.affinity import translate
+
+from c3nav.mapdata.render.engines.base import FillAttribs, RenderEngine, StrokeAttribs
+from c3nav.mapdata.render.engines.svg import unwrap_hybrid_geom
+from c3nav.mapdata.utils.color import color_to_rgb
+from c3nav.mapdata.utils.geometry import get_rings
+
+
+class RasterEngine(RenderEngine):
+    """
+    Rasterizes geometries directly into a numpy buffer, without building and parsing an SVG document.
+    Produces the same images as the SVGEngine, as far as anti-aliasing allows.
+    """
+    filetype = 'png'
+
+    # sub-rows per pixel row for anti-aliasing, horizontal coverage is calculated exactly
+    subsamples = 4
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # for fast numpy operations, same transformation as the svg engine plus the buffer offset
+        self.np_scale = np.array((self.scale, -self.scale))
+        self.np_offset = np.array((-self.minx * self.scale + self.buffer, self.maxy * self.scale + self.buffer))
+
+        self.image = np.empty((self.buffered_height, self.buffered_width, 3), dtype=np.float32)
+        self.image[:] = self.background_rgb
+        self.empty = True
+
+    def render(self, filename=None):
+        # render the image to png
+        if self.width == 256 and self.height == 256 and self.empty:
+            return self.empty_png()
+
+        image = self.image[self.buffer:self.buffer+self.height, self.buffer:self.buffer+self.width]
+        f = io.BytesIO()
+        Image.fromarray((image * 255 + 0.5).astype(np.uint8), 'RGB').save(f, 'PNG')
+        return f.getvalue()
+
+    def _coverage(self, geometry, margin=0) -> Optional[tuple[tuple[slice, slice], np.ndarray]]:
+        """
+        Calculate how much of each pixel is covered by the given polygons, using the even-odd rule.
+        Returns the image window and the coverage within it, or None if nothing is covered.
+        The window is extended by the given margin in pixels, so it can be blurred.
+        """
+        rings = tuple(np.array(ring.coords) * self.np_scale + self.np_offset for ring in get_rings(geometry))
+        if not rings:
+            return None
+        starts = np.vstack(tuple(ring[:-1] for ring in rings))
+        ends = np.vstack(tuple(ring[1:] for ring in rings))
+
+        bounds_min = np.minimum(starts.min(axis=0), ends.min(axis=0))
+        bounds_max = np.maximum(starts.max(axis=0), ends.max(axis=0))
+        x0, y0 = (max(int(i)-margin, 0) for i in np.floor(bounds_min))
+        x1 = min(int(np.ceil(bounds_max[0]))+margin, self.buffered_width)
+        y1 = min(int(np.ceil(bounds_max[1]))+margin, self.buffered_height)
+        width, height = x1 - x0, y1 - y0
+        if width <= 0 or height <= 0:
+            return None
+        window = (slice(y0, y1), slice(x0, x1))
+
+        # only edges that are not horizontal cross any sub-rows
+        edges = starts[:, 1] != ends[:, 1]
+        starts, ends = starts[edges] - (x0, y0), ends[edges] - (x0, y0)
+        ymin = np.minimum(starts[:, 1], ends[:, 1])
+        ymax = np.maximum(starts[:, 1], ends[:, 1])
+
+        # sub-row i has its center at (i+0.5)/subsamples, edges are half-open so vertices are counted once
+        subsamples = self.subsamples
+        first_row = np.clip(np.ceil(ymin * subsamples - 0.5), 0, height * subsamples).astype(np.int64)
+        last_row = np.clip(np.ceil(ymax * subsamples - 0.5), 0, height * subsamples).astype(np.int64)
+        counts = last_row - first_row
+        total = int(counts.sum())
+        if not total:
+            return None
+
+        edge_index = np.repeat(np.arange(counts.size), counts)
+        rows = first_row[edge_index] + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        row_y = (rows + 0.5) / subsamples
+        start, end = starts[edge_index], ends[edge_index]
+        crossings = start[:, 0] + (row_y - start[:, 1]) * (end[:, 0] - start[:, 0]) / (end[:, 1] - start[:, 1])
+
+        # every sub-row has an even number of crossings, consecutive pairs are the filled spans
+        order = np.lexsort((crossings, rows))
+        rows, crossings = rows[order], np.clip(crossings[order], 0, width)
+        span_rows, span_starts, span_ends = rows[0::2], crossings[0::2], crossings[1::2]
+
+        # exact horizontal coverage using a difference array, that is summed up afterwards
+        row_width = width + 2
+        offsets = span_rows * row_width
+        start_pixels, start_fractions = np.floor(span_starts).astype(np.int64), span_starts % 1
+        end_pixels, end_fractions = np.floor(span_ends).astype(np.int64), span_ends % 1
+        coverage = np.bincount(
+            np.concatenate((offsets + start_pixels, offsets + start_pixels + 1,
+                            offsets + end_pixels, offsets + end_pixels + 1)),
+            weights=np.concatenate((1 - start_fractions, start_fractions, end_fractions - 1, -end_fractions)),
+            minlength=height * subsamples * row_width,
+        ).reshape((height * subsamples, row_width)).cumsum(axis=1)[:, :width]
+        coverage = coverage.reshape((height, subsamples, width)).mean(axis=1)
+
+        return window, np.clip(coverage, 0, 1).astype(np.float32)
+
+    @staticmethod
+    def _blur(coverage: np.ndarray, sigma: float) -> np.ndarray:
+        # gaussian blur as two one-dimensional convolutions
+        radius = int(np.ceil(sigma * 3))
+        if radius < 1:
+            return coverage
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+        kernel /= kernel.sum()
+        height, width = coverage.shape
+
+        padded = np.pad(coverage, ((radius, radius), (0, 0)))
+        coverage = sum(weight * padded[i:i + height] for i, weight in enumerate(kernel))
+        padded = np.pad(coverage, ((0, 0), (radius, radius)))
+        return sum(weight * padded[:, i:i + width] for i, weight in enumerate(kernel))
+
+    def _paint(self, coverage, color: str, opacity: float | None = None):
+        if coverage is None:
+            return
+        window, coverage = coverage
+        *rgb, alpha = color_to_rgb(color)
+        if opacity:
+            alpha *= opacity
+        region = self.image[window]
+        region += (np.array(rgb, dtype=np.float32) - region) * (coverage * alpha)[:, :, np.newaxis]
+        self.empty = False
+
+    def _stroke_geometry(self, geometry, width: float):
+        # outline polygons and lines like an svg stroke would, width is given in pixels
+        parts = shapely.get_parts(geometry)
+        lines = shapely.get_parts(np.where(shapely.get_dimensions(parts) == 2, shapely.boundary(parts), parts))
+        lines = lines[shapely.get_dimensions(lines) == 1]
+        if not lines.size:
+            return None
+        return shapely.buffer(shapely.multilinestrings(lines), width / self.scale / 2,
+                              cap_style='flat', join_style='mitre')
+
+    def add_shadow(self, geometry, elevation, color):
+        # add a blurred shadow for the given geometry with the given elevation
+        elevation = float(min(elevation, 2))
+        blur_radius = elevation / 3 * 0.25
+
+        shadow_geom = translate(geometry.buffer(blur_radius),
+                                xoff=(elevation / 3 * 0.12), yoff=-(elevation / 3 * 0.12))
+
+        sigma = blur_radius * self.scale
+        coverage = self._coverage(shadow_geom, margin=int(np.ceil(sigma * 3)))
+        if coverage is not None:
+            window, coverage = coverage
+            coverage = (window, self._blur(coverage, sigma))
+        self._paint(coverage, color or '#000', 0.2)
+
+    def darken(self, area, much=False):
+        if area:
+            self.add_geometry(geometry=area, fill=FillAttribs('#000000', 0.4 if much else 0.1), category='darken')
+
+    def _add_geometry(self, geometry, fill: Optional[FillAttribs], stroke: Optional[StrokeAttribs],
+                      altitude=None, height=None, shadow_color=None, shape_cache_key=None, **kwargs):
+        geometry = self.buffered_bbox.intersection(unwrap_hybrid_geom(geometry))
+
+        if geometry.is_empty:
+            return
+
+        if altitude is not None and stroke is None:
+            stroke = StrokeAttribs('rgba(0, 0, 0, 0.15)', 0.05, min_px=0.2)
+
+        if height is not None:
+            self.add_shadow(geometry, height, shadow_color)
+
+        if fill:
+            self._paint(self._coverage(geometry), fill.color, fill.opacity)
+
+        if stroke:
+            width = stroke.width*self.scale
+            if stroke.min_px:
+                width = max(width, stroke.min_px)
+            stroke_geometry = self._stroke_geometry(geometry, width)
+            if stroke_geometry is not None:
+                self._paint(self._coverage(stroke_geometry), stroke.color, stroke.opacity)
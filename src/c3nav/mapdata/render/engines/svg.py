@@ -1,7 +1,6 @@
 import io
 import re
 import subprocess
-import zlib
 from itertools import chain
 from typing import Optional
 
@@ -102,13 +101,7 @@ class SVGEngine(RenderEngine):
         # render the image to png. returns bytes if f is None, otherwise it calls f.write()
 
         if self.width == 256 and self.height == 256 and not self.g:
-            # create empty tile png with minimal size, indexed color palette with only one entry
-            plte = b'PLTE' + bytearray(tuple(int(i*255) for i in self.background_rgb))
-            return (b'\x89PNG\r\n\x1a\n' +
-                    b'\x00\x00\x00\rIHDR\x00\x00\x01\x00\x00\x00\x01\x00\x01\x03\x00\x00\x00f\xbc:%\x00\x00\x00\x03' +
-                    plte + zlib.crc32(plte).to_bytes(4, byteorder='big') +
-                    b'\x00\x00\x00\x1fIDATh\xde\xed\xc1\x01\r\x00\x00\x00\xc2\xa0\xf7Om\x0e7\xa0\x00\x00\x00\x00\x00' +
-                    b'\x00\x00\x00\xbe\r!\x00\x00\x01\x7f\x19\x9c\xa7\x00\x00\x00\x00IEND\xaeB`\x82')
+            return self.empty_png()
 
         if settings.SVG_RENDERER == 'rsvg':
             # create buffered surfaces
@@ -0,0 +1,157 @@
+from typing import Optional
+
+import numpy as np
+import shapely
+from shapely.geometry.polygon import orient
+
+from c3nav.mapdata.render.engines import register_engine
+from c3nav.mapdata.render.engines.base import FillAttribs, RenderEngine, StrokeAttribs
+from c3nav.mapdata.render.engines.svg import unwrap_hybrid_geom
+
+
+def _varint(value: int) -> bytes:
+    result = bytearray()
+    while value > 0x7f:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _field(number: int, data: bytes) -> bytes:
+    # length-delimited protobuf field
+    return _varint((number << 3) | 2) + _varint(len(data)) + data
+
+
+def _packed(number: int, values) -> bytes:
+    return _field(number, b''.join(_varint(value) for value in values))
+
+
+def _value(value) -> bytes:
+    if isinstance(value, str):
+        return _field(1, value.encode())
+    if isinstance(value, float):
+        return _varint((3 << 3) | 1) + np.float64(value).tobytes()
+    raise TypeError
+
+
+def _command(command_id: int, count: int) -> int:
+    return (command_id & 0x7) | (count << 3)
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    return (values << 1) ^ (values >> 63)
+
+
+@register_engine
+class VectorTileEngine(RenderEngine):
+    """
+    Encodes the rendered geometries as a Mapbox Vector Tile, with one layer per category.
+    Colors are passed as feature properties, so clients can style the map themselves.
+    """
+    filetype = 'mvt'
+
+    # number of integer coordinates along a tile side
+    extent = 4096
+
+    # geometries are clipped a bit outside of the tile, so there are no visible seams at tile borders
+    clip_buffer = 64
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.layers: dict[str, list[tuple[shapely.Geometry, dict]]] = {}
+
+    def _add_feature(self, layer, geometry, properties):
+        self.layers.setdefault(layer, []).append((unwrap_hybrid_geom(geometry), properties))
+
+    def darken(self, area, much=False):
+        if area:
+            self.add_geometry(geometry=area, fill=FillAttribs('#000000', 0.4 if much else 0.1), category='darken')
+
+    def add_restricted_areas(self, area):
+        if not area.is_empty:
+            self._add_feature('restricted', area, {})
+
+    def _add_geometry(self, geometry, fill: Optional[FillAttribs], stroke: Optional[StrokeAttribs],
+                      altitude=None, height=None, shadow_color=None, shape_cache_key=None, category=None, item=None):
+        if fill is None:
+            # outlines of geometries that were already added, clients can draw them themselves
+            return
+
+        properties = {'color': fill.color}
+        if fill.opacity:
+            properties['opacity'] = float(fill.opacity)
+        if stroke is not None:
+            properties['stroke_color'] = stroke.color
+        if altitude is not None:
+            properties['altitude'] = float(altitude)
+        if height is not None:
+            properties['height'] = float(height)
+
+        # ground colors have their color in their category name
+        self._add_feature(category.split('_')[0], geometry, properties)
+
+    def _quantize(self, geometry):
+        # transform into tile coordinates (y pointing down) and snap to the integer grid
+        scale = np.array((self.extent / (self.maxx - self.minx), -self.extent / (self.maxy - self.miny)))
+        offset = np.array((-self.minx, -self.maxy)) * scale
+        geometry = shapely.clip_by_rect(geometry, self.minx - self.clip_buffer / scale[0],
+                                        self.miny + self.clip_buffer / scale[1],
+                                        self.maxx + self.clip_buffer / scale[0],
+                                        self.maxy - self.clip_buffer / scale[1])
+        if geometry.is_empty:
+            return geometry
+        geometry = shapely.transform(geometry, lambda coords: coords * scale + offset)
+        return shapely.set_precision(geometry, 1)
+
+    def _encode_polygons(self, geometry) -> list[int]:
+        commands = []
+        cursor = np.zeros(2, dtype=np.int64)
+        for polygon in shapely.get_parts(geometry):
+            if not isinstance(polygon, shapely.Polygon):
+                continue
+            # exterior rings need a positive area in tile coordinates, interior rings a negative one
+            polygon = orient(polygon, sign=1.0)
+            for ring in (polygon.exterior, *polygon.interiors):
+                points = np.array(ring.coords[:-1], dtype=np.int64)
+                if len(points) < 3:
+                    continue
+                deltas = _zigzag(np.diff(points, axis=0, prepend=cursor[np.newaxis]))
+                cursor = points[-1]
+                commands.append(_command(1, 1))
+                commands.extend(deltas[0].tolist())
+                commands.append(_command(2, len(points) - 1))
+                commands.extend(deltas[1:].ravel().tolist())
+                commands.append(_command(7, 1))
+        return commands
+
+    def _encode_layer(self, name, features) -> bytes:
+        keys: dict[str, int] = {}
+        values: dict[object, int] = {}
+        encoded_features = []
+        for geometry, properties in features:
+            commands = self._encode_polygons(self._quantize(geometry))
+            if not commands:
+                continue
+            tags = []
+            for key, value in properties.items():
+                tags.append(keys.setdefault(key, len(keys)))
+                tags.append(values.setdefault(value, len(values)))
+            encoded_features.append(_field(2, (
+                (_packed(2, tags) if tags else b'') +
+                _varint((3 << 3) | 0) + _varint(3) +  # polygon
+                _packed(4, commands)
+            )))
+        if not encoded_features:
+            return b''
+        return _field(3, (
+            _varint((15 << 3) | 0) + _varint(2) +  # version
+            _field(1, name.encode()) +
+            b''.join(encoded_features) +
+            b''.join(_field(3, key.encode()) for key in keys) +
+            b''.join(_field(4, _value(value)) for value in values) +
+            _varint((5 << 3) | 0) + _varint(self.extent)
+        ))
+
+    def render(self, filename=None) -> bytes:
+        return b''.join(self._encode_layer(name, features) for name, features in self.layers.items())
@@ -10,7 +10,7 @@ from shapely import prepared, box
 from shapely.geometry import GeometryCollection, Polygon, MultiPolygon
 from shapely.ops import unary_union
 
-from c3nav.mapdata.models import Space, Level, AltitudeArea, Source
+from c3nav.mapdata.models import Space, Level, AltitudeArea, Source, Area, Obstacle, LineObstacle
 from c3nav.mapdata.render.geometry.altitudearea import AltitudeAreaGeometries
 from c3nav.mapdata.render.geometry.hybrid import HybridGeometry
 from c3nav.mapdata.render.geometry.mesh import Mesh
@@ -115,15 +115,16 @@ class SingleLevelGeometries(BaseLevelGeometries):
         restricted_spaces_indoors: dict[int, list[ZeroOrMorePolygons]]
         restricted_spaces_outdoors: dict[int, list[ZeroOrMorePolygons]]
 
-        colors: dict[tuple, dict[int, ZeroOrMorePolygons]]
-        obstacles: dict[int, dict[str | None, list[ZeroOrMorePolygons]]]
+        # colors depend on the theme, so we only remember what to get the color from
+        colored_areas: list[tuple[Space | Area, int | None, ZeroOrMorePolygons]]
+        colored_obstacles: list[tuple[int, Obstacle | LineObstacle, ZeroOrMorePolygons]]
         heightareas: dict[int, list[ZeroOrMorePolygons]]
 
         ramps: list[ZeroOrMorePolygons]
 
     @classmethod
     def analyze_spaces(cls, level: Level, spaces: list[SpaceGeometries], walkable_spaces_geom: ZeroOrMorePolygons,
-                       buildings_geom: ZeroOrMorePolygons, color_manager: 'ThemeColorManager') -> Analysis:
+                       buildings_geom: ZeroOrMorePolygons) -> Analysis:
         buildings_geom_prep = prepared.prep(buildings_geom)
 
         # keep track which areas are affected by access restrictions
@@ -134,8 +135,8 @@ class SingleLevelGeometries(BaseLevelGeometries):
         restricted_spaces_outdoors: dict[int, list[ZeroOrMorePolygons]] = {}
 
         # go through spaces and their areas for access control, ground colors, height areas and obstacles
-        colors: dict[tuple | None, dict[int, list[ZeroOrMorePolygons]]] = {}
-        obstacles: dict[int, dict[str | None, list[ZeroOrMorePolygons]]] = {}
+        colored_areas: list[tuple[Space | Area, int | None, ZeroOrMorePolygons]] = []
+        colored_obstacles: list[tuple[int, Obstacle | LineObstacle, ZeroOrMorePolygons]] = []
         heightareas: dict[int, list[ZeroOrMorePolygons]] = {}
 
         ramps: list[ZeroOrMorePolygons] = []
@@ -160,19 +161,14 @@ class SingleLevelGeometries(BaseLevelGeometries):
                         buffered.difference(buildings_geom)
                     )
 
-            colors.setdefault(space.instance.get_color_sorted(color_manager), {}).setdefault(access_restriction,
-                                                                                             []).append(
-                unwrap_geom(space.geometry)
-            )
+            colored_areas.append((space.instance, access_restriction, unwrap_geom(space.geometry)))
 
             for area in space.instance.areas.all():  # noqa
                 access_restriction = area.access_restriction_id or space.instance.access_restriction_id
                 area.geometry = area.geometry.intersection(unwrap_geom(space.walkable_geom))
                 if access_restriction is not None:
                     access_restriction_affected.setdefault(access_restriction, []).append(area.geometry)
-                colors.setdefault(
-                    area.get_color_sorted(color_manager), {}
-                ).setdefault(access_restriction, []).append(area.geometry)
+                colored_areas.append((area, access_restriction, area.geometry))
 
             for column in space.instance.columns.all():  # noqa
                 access_restriction = column.access_restriction_id
@@ -189,28 +185,55 @@ class SingleLevelGeometries(BaseLevelGeometries):
             for obstacle in sorted(space.instance.obstacles.all(), key=lambda o: o.height + o.altitude):  # noqa
                 if not obstacle.height:
                     continue
-                obstacles.setdefault(
-                    int((obstacle.height + obstacle.altitude) * 1000), {}
-                ).setdefault(obstacle.get_color(color_manager), []).append(
+                colored_obstacles.append((
+                    int((obstacle.height + obstacle.altitude) * 1000),
+                    obstacle,
                     obstacle.geometry.intersection(unwrap_geom(space.walkable_geom))
-                )
+                ))
 
             for lineobstacle in space.instance.lineobstacles.all():  # noqa
                 if not lineobstacle.height:
                     continue
-                obstacles.setdefault(int(lineobstacle.height * 1000), {}).setdefault(
-                    lineobstacle.get_color(color_manager), []
-                ).append(
+                colored_obstacles.append((
+                    int(lineobstacle.height * 1000),
+                    lineobstacle,
                     lineobstacle.buffered_geometry.intersection(unwrap_geom(space.walkable_geom))
-                )
+                ))
 
             ramps.extend(ramp.geometry for ramp in space.instance.ramps.all())  # noqa
 
             heightareas.setdefault(int((space.instance.height or level.default_height) * 1000), []).append(
                 unwrap_geom(space.geometry)
             )
+
+        return cls.Analysis(
+            access_restriction_affected=access_restriction_affected,
+
+            restricted_spaces_indoors=restricted_spaces_indoors,
+            restricted_spaces_outdoors=restricted_spaces_outdoors,
+
+            colored_areas=colored_areas,
+            colored_obstacles=colored_obstacles,
+            heightareas=heightareas,
+
+            ramps=ramps,
+        )
+
+    @classmethod
+    def get_colors(cls, analysis: Analysis, color_manager: 'ThemeColorManager') -> tuple[
+        dict[tuple, dict[int, ZeroOrMorePolygons]],
+        dict[int, dict[str | None, list[ZeroOrMorePolygons]]],
+    ]:
+        colors: dict[tuple | None, dict[int, list[ZeroOrMorePolygons]]] = {}
+        for instance, access_restriction, geometry in analysis.colored_areas:
+            colors.setdefault(instance.get_color_sorted(color_manager), {}).setdefault(access_restriction,
+                                                                                       []).append(geometry)
         colors.pop(None, None)
 
+        obstacles: dict[int, dict[str | None, list[ZeroOrMorePolygons]]] = {}
+        for height, instance, geometry in analysis.colored_obstacles:
+            obstacles.setdefault(height, {}).setdefault(instance.get_color(color_manager), []).append(geometry)
+
         new_colors: dict[tuple, dict[int, ZeroOrMorePolygons]] = {}
 
         # merge ground colors
@@ -222,34 +245,25 @@ class SingleLevelGeometries(BaseLevelGeometries):
 
         new_colors = {color: geometry for color, geometry in sorted(new_colors.items(), key=lambda v: v[0][0])}
 
-        return cls.Analysis(
-            access_restriction_affected=access_restriction_affected,
-
-            restricted_spaces_indoors=restricted_spaces_indoors,
-            restricted_spaces_outdoors=restricted_spaces_outdoors,
+        return new_colors, obstacles
 
-            colors=new_colors,
-            obstacles=obstacles,
-            heightareas=heightareas,
-
-            ramps=ramps,
-        )
-    
     @classmethod
-    def build_altitudeareas(cls, level: Level, analysis: Analysis) -> list[AltitudeAreaGeometries]:
+    def build_altitudeareas(cls, altitudeareas: typing.Sequence[AltitudeArea],
+                            colors: dict[tuple, dict[int, ZeroOrMorePolygons]],
+                            obstacles: dict[int, dict[str | None, list[ZeroOrMorePolygons]]],
+                            ) -> list[AltitudeAreaGeometries]:
         # add altitudegroup geometries and split ground colors into them
-        altitudearea_geoms: list[AltitudeAreaGeometries] = [] 
-        for altitudearea in level.altitudeareas.all():  # noqa
-            altitudearea.geometry = unwrap_geom(altitudearea.geometry).buffer(0)
+        altitudearea_geoms: list[AltitudeAreaGeometries] = []
+        for altitudearea in altitudeareas:
             altitudearea_prep = prepared.prep(unwrap_geom(altitudearea.geometry))
             altitudearea_colors = {color: {access_restriction: area.intersection(unwrap_geom(altitudearea.geometry))
                                            for access_restriction, area in areas.items()
                                            if altitudearea_prep.intersects(area)}
-                                   for color, areas in analysis.colors.items()}
+                                   for color, areas in colors.items()}
             altitudearea_colors = {color: areas for color, areas in altitudearea_colors.items() if areas}
 
             altitudearea_obstacles = {}
-            for height, height_obstacles in analysis.obstacles.items():
+            for height, height_obstacles in obstacles.items():
                 new_height_obstacles = {}
                 for color, color_obstacles in height_obstacles.items():
                     new_color_obstacles = []
@@ -263,12 +277,12 @@ class SingleLevelGeometries(BaseLevelGeometries):
                     altitudearea_obstacles[height] = new_height_obstacles
 
             altitudearea_geoms.append(AltitudeAreaGeometries(
-                altitudearea=altitudearea, 
-                colors=altitudearea_colors, 
+                altitudearea=altitudearea,
+                colors=altitudearea_colors,
                 obstacles=altitudearea_obstacles
-            ))     
+            ))
         return altitudearea_geoms
-    
+
     @classmethod
     def build_short_walls(cls, altitudeareas_above,
                           walls_geom: ZeroOrMorePolygons) -> list[tuple[AltitudeArea, ZeroOrMorePolygons]]:
@@ -283,7 +297,12 @@ class SingleLevelGeometries(BaseLevelGeometries):
         return short_walls
 
     @classmethod
-    def build_for_level(cls, level: Level, color_manager: 'ThemeColorManager', altitudeareas_above):
+    def build_for_level(cls, level: Level, color_managers: dict[int | None, 'ThemeColorManager'],
+                        altitudeareas_above) -> dict[int | None, typing.Self]:
+        """
+        Build the level geometries for every given theme.
+        Everything except for the colors is independent of the theme, so it's only calculated once.
+        """
         buildings_geom = unary_union([unwrap_geom(b.geometry) for b in level.buildings.all()])  # noqa
 
         # remove columns and holes from space areas
@@ -312,10 +331,12 @@ class SingleLevelGeometries(BaseLevelGeometries):
             spaces=spaces,
             walkable_spaces_geom=walkable_spaces_geom,
             buildings_geom=buildings_geom,
-            color_manager=color_manager
         )
 
-        altitudearea_geoms = cls.build_altitudeareas(level=level, analysis=analysis)
+        altitudeareas = tuple(level.altitudeareas.all())  # noqa
+        for altitudearea in altitudeareas:
+            altitudearea.geometry = unwrap_geom(altitudearea.geometry).buffer(0)
+
         heightareas_geom = tuple((unary_union(geoms), height) for height, geoms in
                                  sorted(analysis.heightareas.items(), key=operator.itemgetter(0)))
 
@@ -323,61 +344,75 @@ class SingleLevelGeometries(BaseLevelGeometries):
         default_height = int(level.default_height * 1000)
         door_height = int(level.door_height * 1000)
 
-        min_altitude = (min(area.min_altitude for area in altitudearea_geoms) if altitudearea_geoms else base_altitude)
-
-        # hybrid geometries
-
-        geoms = cls(
-            ramps=analysis.ramps,
-
-            buildings=buildings_geom,
-            doors=doors_geom,
-            holes=holes_geom,
-
-            altitudeareas=altitudearea_geoms,
-            heightareas=heightareas_geom,
-
-            # merge access restrictions
-            access_restriction_affected={
-                access_restriction: unary_union([unwrap_geom(geom) for geom in areas])
-                for access_restriction, areas in analysis.access_restriction_affected.items()
-            },
-            restricted_spaces_indoors={
-                access_restriction: unary_union(spaces)
-                for access_restriction, spaces in analysis.restricted_spaces_indoors.items()
-            },
-            restricted_spaces_outdoors={
-                access_restriction: unary_union(spaces)
-                for access_restriction, spaces in analysis.restricted_spaces_outdoors.items()
-            },
-
-            # shorten walls if there are altitudeareas above
-            short_walls=cls.build_short_walls(altitudeareas_above, walls_geom),
-
-            all_walls=walls_geom,
-            walls=walls_geom.difference(
-                unary_union(tuple(unwrap_geom(altitudearea.geometry) for altitudearea in altitudeareas_above))
-            ),
-
-            # general level infos
-            pk=level.pk,
-            on_top_of_id=level.on_top_of_id,
-            short_label=level.short_label,
-            level_index=level.level_index,
-            base_altitude=base_altitude,
-            default_height=default_height,
-            door_height=door_height,
-            min_altitude=min_altitude,
-            max_altitude=(max(area.max_altitude for area in altitudearea_geoms)
-                          if altitudearea_geoms else base_altitude),
-            max_height=(min(height for area, height in heightareas_geom)
-                        if analysis.heightareas else default_height),
-            lower_bound=min_altitude-700,
+        altitudearea_geoms = {
+            theme: cls.build_altitudeareas(altitudeareas, *cls.get_colors(analysis, color_manager))
+            for theme, color_manager in color_managers.items()
+        }
+        # altitudes are the same for every theme
+        any_altitudearea_geoms = next(iter(altitudearea_geoms.values()), ())
+        min_altitude = (min(area.min_altitude for area in any_altitudearea_geoms)
+                        if any_altitudearea_geoms else base_altitude)
+        max_altitude = (max(area.max_altitude for area in any_altitudearea_geoms)
+                        if any_altitudearea_geoms else base_altitude)
+
+        # merge access restrictions
+        access_restriction_affected = {
+            access_restriction: unary_union([unwrap_geom(geom) for geom in areas])
+            for access_restriction, areas in analysis.access_restriction_affected.items()
+        }
+        restricted_spaces_indoors = {
+            access_restriction: unary_union(spaces)
+            for access_restriction, spaces in analysis.restricted_spaces_indoors.items()
+        }
+        restricted_spaces_outdoors = {
+            access_restriction: unary_union(spaces)
+            for access_restriction, spaces in analysis.restricted_spaces_outdoors.items()
+        }
+
+        # shorten walls if there are altitudeareas above
+        short_walls = cls.build_short_walls(altitudeareas_above, walls_geom)
+        walls = walls_geom.difference(
+            unary_union(tuple(unwrap_geom(altitudearea.geometry) for altitudearea in altitudeareas_above))
         )
-        
-        AccessRestrictionAffected.build(geoms.access_restriction_affected).save_level(level.pk, 'base')
 
-        return geoms
+        result = {}
+        for theme, theme_altitudearea_geoms in altitudearea_geoms.items():
+            result[theme] = cls(
+                ramps=analysis.ramps,
+
+                buildings=buildings_geom,
+                doors=doors_geom,
+                holes=holes_geom,
+
+                altitudeareas=theme_altitudearea_geoms,
+                heightareas=heightareas_geom,
+
+                access_restriction_affected=access_restriction_affected,
+                restricted_spaces_indoors=restricted_spaces_indoors,
+                restricted_spaces_outdoors=restricted_spaces_outdoors,
+
+                short_walls=short_walls,
+                all_walls=walls_geom,
+                walls=walls,
+
+                # general level infos
+                pk=level.pk,
+                on_top_of_id=level.on_top_of_id,
+                short_label=level.short_label,
+                level_index=level.level_index,
+                base_altitude=base_altitude,
+                default_height=default_height,
+                door_height=door_height,
+                min_altitude=min_altitude,
+                max_altitude=max_altitude,
+                max_height=(min(height for area, height in heightareas_geom)
+                            if analysis.heightareas else default_height),
+                lower_bound=min_altitude-700,
+            )
+
+        AccessRestrictionAffected.build(access_restriction_affected).save_level(level.pk, 'base')
+
+        return result
 
 
 @dataclass(slots=True)
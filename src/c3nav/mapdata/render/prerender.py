@@ -0,0 +1,221 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from c3nav.mapdata.render.engines import ImageRenderEngine
+from c3nav.mapdata.render.renderer import MapRenderer
+from c3nav.mapdata.utils.cache import CachePackage
+from c3nav.mapdata.utils.tiles import build_access_cache_key, build_base_cache_key, get_tile_bounds
+
+
+def tile_access_cache_key(level, zoom, x, y):
+    return 'mapdata:tile-access:%d-%d-%d-%d' % (level, zoom, x, y)
+
+
+def count_tile_access(level, zoom, x, y):
+    cache_key = tile_access_cache_key(level, zoom, x, y)
+    try:
+        cache.incr(cache_key)
+    except ValueError:
+        # counters expire, so the prerender order follows recent traffic
+        cache.set(cache_key, 1, 7*24*3600)
+
+
+def parse_prerender_access_permissions(value: str) -> list[frozenset[int]]:
+    """
+    Parse access permission combinations like "0; 1,2; 3", where 0 stands for no permissions.
+    """
+    return list(dict.fromkeys(
+        frozenset(int(i) for i in combination.split(',') if i.strip() and int(i))
+        for combination in value.split(';')
+    ))
+
+
+@dataclass(frozen=True)
+class TileJob:
+    level: int
+    theme: Optional[int]
+    zoom: int
+    x: int
+    y: int
+    requested_access_permissions: frozenset[int]
+    access_permissions: frozenset[int]
+    base_cache_key: str
+    access_cache_key: str
+
+    @property
+    def theme_key(self):
+        return str(self.theme)
+
+    def render(self) -> int:
+        """
+        Render this tile (or the metatile containing it) into the tile cache. Returns the number of rendered tiles.
+        """
+        from c3nav.mapdata.views import get_cached_tile, render_metatile, write_cached_tile
+
+        # maybe it was rendered by a request or as part of a metatile in the meantime
+        if get_cached_tile(self.level, self.zoom, self.x, self.y, self.theme_key,
+                           self.base_cache_key, self.access_cache_key, use_cache=False) is not None:
+            return 0
+
+        if settings.TILE_METATILE_SIZE > 1:
+            cache_package = CachePackage.open_cached()
+            render_metatile(cache_package, cache_package.levels[(self.level, self.theme)], self.level,
+                            self.zoom, self.x, self.y, self.theme, set(self.requested_access_permissions),
+                            self.base_cache_key, self.access_cache_key)
+            return settings.TILE_METATILE_SIZE ** 2
+
+        renderer = MapRenderer(self.level, *get_tile_bounds(self.zoom, self.x, self.y), scale=2 ** self.zoom,
+                               access_permissions=set(self.access_permissions))
+        data = renderer.render(ImageRenderEngine, theme=self.theme).render()
+        write_cached_tile(self.level, self.zoom, self.x, self.y, self.theme_key,
+                          self.base_cache_key, self.access_cache_key, data)
+        return 1
+
+
+def find_outdated_tiles(cache_package: CachePackage, zooms: Iterable[int],
+                        access_permission_combinations: list[frozenset[int]],
+                        since: Optional[int] = None) -> list[TileJob]:
+    """
+    Walk the map history of every level and theme and collect all tiles whose cached version is outdated.
+    If since is given, only tiles that were changed by later map updates are considered.
+    With metatiles, only one tile per metatile is returned. Tiles are ordered by zoom and then by traffic.
+    """
+    from c3nav.mapdata.views import is_tile_cached
+
+    minx, miny, maxx, maxy = cache_package.bounds
+    metatile_size = settings.TILE_METATILE_SIZE
+
+    jobs = {}
+    for (level, theme), level_data in cache_package.levels.items():
+        for zoom in zooms:
+            size = 256 / 2 ** zoom
+            for x in range(int(minx // size), int(maxx // size) + 1):
+                for y in range(int(-maxy // size) - 1, int(-miny // size) + 1):
+                    tile_minx, tile_miny, tile_maxx, tile_maxy = get_tile_bounds(zoom, x, y)
+                    if not cache_package.bounds_valid(tile_minx, tile_miny, tile_maxx, tile_maxy):
+                        continue
+
+                    last_update = level_data.history.last_update(tile_minx, tile_miny, tile_maxx, tile_maxy)
+                    if since is not None and last_update[0] <= since:
+                        continue
+                    base_cache_key = build_base_cache_key(last_update)
+
+                    tile_restrictions = (set(level_data.restrictions[tile_minx:tile_maxx, tile_miny:tile_maxy]) |
+                                         level_data.global_restrictions)
+                    for requested_access_permissions in access_permission_combinations:
+                        access_permissions = requested_access_permissions & tile_restrictions
+                        if not all((r in access_permissions) for r in level_data.global_restrictions):
+                            continue
+                        access_cache_key = build_access_cache_key(access_permissions)
+
+                        if is_tile_cached(level, zoom, x, y, str(theme), base_cache_key, access_cache_key):
+                            continue
+
+                        if metatile_size > 1:
+                            job_key = (level, theme, zoom, x - x % metatile_size, y - y % metatile_size,
+                                       requested_access_permissions)
+                        else:
+                            job_key = (level, theme, zoom, x, y, access_cache_key)
+                        jobs.setdefault(job_key, []).append(TileJob(
+                            level=level, theme=theme, zoom=zoom, x=x, y=y,
+                            requested_access_permissions=requested_access_permissions,
+                            access_permissions=frozenset(access_permissions),
+                            base_cache_key=base_cache_key,
+                            access_cache_key=access_cache_key,
+                        ))
+
+    if not jobs:
+        return []
+
+    # order by zoom and then by how often tiles were requested, if we have that data
+    tiles = {(job.level, job.zoom, job.x, job.y) for tile_jobs in jobs.values() for job in tile_jobs}
+    access_counts = cache.get_many([tile_access_cache_key(*tile) for tile in tiles])
+
+    def get_access_count(job):
+        return access_counts.get(tile_access_cache_key(job.level, job.zoom, job.x, job.y), 0)
+
+    # for metatiles, render via the most popular outdated tile and prioritize by the traffic of all of them
+    result = []
+    for tile_jobs in jobs.values():
+        job = max(tile_jobs, key=get_access_count)
+        result.append((job.zoom, -sum(get_access_count(j) for j in tile_jobs), job))
+    result.sort(key=lambda item: item[:2])
+    return [job for zoom, priority, job in result]
+
+
+def prerender_tiles(zooms: Optional[Iterable[int]] = None,
+                    access_permission_combinations: Optional[list[frozenset[int]]] = None,
+                    since: Optional[int] = None, workers: Optional[int] = None):
+    """
+    Render all outdated tiles into the tile cache, so the first users after a map update don't hit cold tiles.
+    """
+    logger = logging.getLogger('c3nav')
+
+    if zooms is None:
+        zooms = range(-2, settings.TILE_PRERENDER_MAX_ZOOM + 1)
+    if access_permission_combinations is None:
+        access_permission_combinations = parse_prerender_access_permissions(settings.TILE_PRERENDER_ACCESS)
+    if workers is None:
+        workers = settings.TILE_PRERENDER_WORKERS
+
+    start = time.perf_counter()
+    jobs = find_outdated_tiles(CachePackage.open_cached(), zooms, access_permission_combinations, since=since)
+    logger.info('Found %d outdated tiles or metatiles to prerender in %.2fs.' %
+                (len(jobs), time.perf_counter() - start))
+    if not jobs:
+        return
+
+    workers = min(workers, len(jobs))
+    if workers > 1 and multiprocessing.current_process().daemon:
+        # daemonic processes (like celery workers) are not allowed to have children
+        logger.warning('Can\'t use tile prerender worker processes inside a daemonic process, rendering serially.')
+        workers = 1
+
+    start = time.perf_counter()
+    last_report = start
+    progress = {'total': len(jobs), 'done': 0, 'tiles': 0, 'tiles_per_second': 0, 'eta': None}
+
+    def report(finished=False):
+        duration = time.perf_counter() - start
+        progress['tiles_per_second'] = progress['tiles'] / duration if duration else 0
+        progress['eta'] = (duration / progress['done'] * (progress['total'] - progress['done'])
+                           if progress['done'] else None)
+        cache.set('mapdata:tile-prerender-progress', progress, None)
+        if finished:
+            logger.info('Prerendered %d tiles in %.2fs (%.1f tiles/s) using %d worker(s).' %
+                        (progress['tiles'], duration, progress['tiles_per_second'], workers))
+        else:
+            logger.info('Prerendering tiles: %d/%d jobs done, %.1f tiles/s, ETA %s' % (
+                progress['done'], progress['total'], progress['tiles_per_second'],
+                '%ds' % progress['eta'] if progress['eta'] is not None else 'unknown',
+            ))
+
+    def finished_job(rendered_tiles):
+        nonlocal last_report
+        progress['done'] += 1
+        progress['tiles'] += rendered_tiles
+        if time.perf_counter() - last_report >= 10:
+            last_report = time.perf_counter()
+            report()
+
+    report()
+    if workers > 1:
+        # don't share database connections with the forked worker processes
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+            # jobs are submitted in priority order, so the most important tiles are rendered first
+            for future in as_completed([executor.submit(job.render) for job in jobs]):
+                finished_job(future.result())
+    else:
+        for job in jobs:
+            finished_job(job.render())
+    report(finished=True)
@@ -1,11 +1,17 @@
+import logging
+import multiprocessing
 import operator
 import pickle
+import time
 from collections import deque
-from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
 from itertools import chain
-from typing import Optional
+from typing import Iterable, Optional, Self
 
+import django
 import numpy as np
+import shapely
 from django.conf import settings
 from shapely import Geometry, MultiPolygon, prepared
 from shapely.geometry import GeometryCollection
@@ -14,7 +20,8 @@ from shapely.prepared import PreparedGeometry
 
 from c3nav.mapdata.models import Level, MapUpdate, Source
 from c3nav.mapdata.models.theme import Theme
-from c3nav.mapdata.render.geometry import AltitudeAreaGeometries, SingleLevelGeometries, CompositeLevelGeometries
+from c3nav.mapdata.render.geometry import (AltitudeAreaGeometries, CompositeLevelGeometries, HybridGeometry,
+                                           SingleLevelGeometries, hybrid_union)
 from c3nav.mapdata.utils.cache import AccessRestrictionAffected, MapHistory
 from c3nav.mapdata.utils.cache.package import CachePackage
 from c3nav.mapdata.utils.geometry import get_rings, unwrap_geom
@@ -44,7 +51,61 @@ class Cropper:
 
 
 @dataclass
-class LevelRenderData:
+class LevelRenderPlan:
+    """
+    Theme-independent plan for building the LevelRenderData of one level.
+    """
+    level_pk: int
+    base_altitude: float
+    intermediate: bool
+    lowest_important_level: int
+    # relevant levels in ascending order, with the area to crop them to (None means no cropping)
+    crops: list[tuple[int, Optional[Geometry]]]
+    upper_bounds: dict[int, int]
+
+
+class LevelFileMixin:
+    """
+    Saving and loading of per-level and per-theme data in the map update cache directory.
+    """
+    filename_prefix: str
+    cached: LocalContext
+
+    @classmethod
+    def _level_filename(cls, update_cache_key, level_pk, theme_pk):
+        if theme_pk is None:
+            name = '%s_level_%d.pickle' % (cls.filename_prefix, level_pk)
+        else:
+            name = '%s_level_%d_theme_%d.pickle' % (cls.filename_prefix, level_pk, theme_pk)
+        return settings.CACHE_ROOT / update_cache_key / name
+
+    @classmethod
+    def get(cls, level, theme):
+        # get the current render data from local variable if no new processed mapupdate exists.
+        # this is much faster than any other possible cache
+        cache_key = MapUpdate.current_processed_geometry_cache_key()
+        level_pk = level.pk if isinstance(level, Level) else level
+        theme_pk = theme.pk if isinstance(theme, Theme) else theme
+        key = f'{level_pk}_{theme_pk}'
+        if getattr(cls.cached, 'key', None) != cache_key:
+            cls.cached.key = cache_key
+            cls.cached.data = {}
+        else:
+            result = cls.cached.data.get(key, None)
+            if result is not None:
+                return result
+
+        result = pickle.load(open(cls._level_filename(cache_key, level_pk, theme_pk), 'rb'))
+
+        cls.cached.data[key] = result
+        return result
+
+    def save(self, update_cache_key, level_pk, theme_pk):
+        return pickle.dump(self, open(self._level_filename(update_cache_key, level_pk, theme_pk), 'wb'))
+
+
+@dataclass
+class LevelRenderData(LevelFileMixin):
     """
     Renderdata for a level to display.
     This contains multiple LevelGeometries instances because you might to look through holes onto lower levels.
@@ -55,13 +116,21 @@ class LevelRenderData:
     darken_area: MultiPolygon | None = None
     darken_much: bool = False
 
+    filename_prefix = 'render_data'
+    cached = LocalContext()
+
     @staticmethod
     def rebuild(update_cache_key):
+        logger = logging.getLogger('c3nav')
+
         # Levels are automatically sorted by base_altitude, ascending
         levels = tuple(Level.objects.prefetch_related('altitudeareas', 'buildings', 'doors', 'spaces',
                                                       'spaces__holes', 'spaces__areas', 'spaces__columns',
                                                       'spaces__obstacles', 'spaces__lineobstacles',
-                                                      'spaces__groups', 'spaces__ramps'))
+                                                      'spaces__groups', 'spaces__ramps',
+                                                      # needed to get the colors for every theme
+                                                      'spaces__groups__category', 'spaces__areas__groups__category',
+                                                      'spaces__obstacles__group', 'spaces__lineobstacles__group'))
 
         package = CachePackage(bounds=tuple(chain(*Source.max_bounds())))
 
@@ -72,332 +141,574 @@ class LevelRenderData:
 
         from c3nav.mapdata.render.theme import ColorManager
 
-        for theme in themes:
-            color_manager = ColorManager.for_theme(theme)
+        color_managers = {theme: ColorManager.for_theme(theme) for theme in themes}
+
+        """
+        first pass in reverse to collect some data that we need later
+        """
+        stage_start = time.perf_counter()
+        # level geometry for every single level and every theme
+        single_level_geoms: dict[int, dict[int | None, SingleLevelGeometries]] = {}
+        # interpolator are used to create the 3d mesh
+        interpolators = {}
+        last_interpolator: NearestNDInterpolator | None = None
+        # altitudeareas of levels on top are collected on the way down to supply to the levelgeometries builder
+        altitudeareas_above = []  # todo: typing
+        for render_level in reversed(levels):
+            # build level geometry for every single level
+            single_level_geoms[render_level.pk] = SingleLevelGeometries.build_for_level(
+                render_level, color_managers, altitudeareas_above
+            )
+            # the geometry itself does not depend on the theme
+            geoms = single_level_geoms[render_level.pk][None]
+
+            # ignore intermediate levels in this pass
+            if render_level.on_top_of_id is not None:
+                # todo: shouldn't this be cleared or something?
+                altitudeareas_above.extend(geoms.altitudeareas)
+                altitudeareas_above.sort(key=operator.attrgetter('max_altitude'))
+                continue
+
+            # create interpolator to create the pieces that fit multiple 3d layers together
+            if last_interpolator is not None:
+                interpolators[render_level.pk] = last_interpolator
+
+            coords = deque()
+            values = deque()
+            for area in geoms.altitudeareas:
+                new_coords = np.vstack(tuple(np.array(ring.coords) for ring in get_rings(area.geometry)))
+                coords.append(new_coords)
+                values.append(np.full((new_coords.shape[0], 1), fill_value=area.altitude))
+
+            if coords:
+                last_interpolator = NearestNDInterpolator(np.vstack(coords), np.vstack(values))
+            else:
+                last_interpolator = NearestNDInterpolator(np.array([[0, 0]]),
+                                                          np.array([float(render_level.base_altitude)]))
+
+        logger.info('Built geometries of %d levels for %d themes in %.2fs.' %
+                    (len(levels), len(themes), time.perf_counter() - stage_start))
+
+        """
+        second pass, forward to plan the LevelRenderData for each level, this is independent of the theme
+        """
+        stage_start = time.perf_counter()
+        plans: list[LevelRenderPlan] = []
+        map_histories: dict[int, MapHistory] = {}
+        upper_bounds: dict[int, int] = {}
+        for render_level in levels:
+            # we don't create render data for on_top_of levels
+            if render_level.on_top_of_id is not None:
+                continue
+
+            # collect potentially relevant levels for rendering this level
+            # these are all levels that are on_top_of this level or below this level (inless intermediate)
+            relevant_levels = tuple(
+                sublevel for sublevel in levels
+                if (sublevel.pk == render_level.pk or sublevel.on_top_of_id == render_level.pk or
+                    (sublevel.base_altitude <= render_level.base_altitude and not sublevel.intermediate))
+            )
+
             """
-            first pass in reverse to collect some data that we need later
+            choose a crop area for each level. non-intermediate levels (not on_top_of) below the one that we are
+            currently rendering will be cropped to only render content that is visible through holes indoors in the
+            levels above them.
             """
-            # level geometry for every single level
-            single_level_geoms: dict[int, SingleLevelGeometries] = {}
-            # interpolator are used to create the 3d mesh
-            interpolators = {}
-            last_interpolator: NearestNDInterpolator | None = None
-            # altitudeareas of levels on top are collected on the way down to supply to the levelgeometries builder
-            altitudeareas_above = []  # todo: typing
-            for render_level in reversed(levels):
-                # build level geometry for every single level
-                single_level_geoms[render_level.pk] = SingleLevelGeometries.build_for_level(
-                    render_level, color_manager, altitudeareas_above
-                )
-
-                # ignore intermediate levels in this pass
-                if render_level.on_top_of_id is not None:
-                    # todo: shouldn't this be cleared or something?
-                    altitudeareas_above.extend(single_level_geoms[render_level.pk].altitudeareas)
-                    altitudeareas_above.sort(key=operator.attrgetter('max_altitude'))
-                    continue
-
-                # create interpolator to create the pieces that fit multiple 3d layers together
-                if last_interpolator is not None:
-                    interpolators[render_level.pk] = last_interpolator
-
-                coords = deque()
-                values = deque()
-                for area in single_level_geoms[render_level.pk].altitudeareas:
-                    new_coords = np.vstack(tuple(np.array(ring.coords) for ring in get_rings(area.geometry)))
-                    coords.append(new_coords)
-                    values.append(np.full((new_coords.shape[0], 1), fill_value=area.altitude))
-
-                if coords:
-                    last_interpolator = NearestNDInterpolator(np.vstack(coords), np.vstack(values))
+            # area to crop each level to, by id
+            level_crop_to: dict[int, Optional[Geometry]] = {}
+            # current remaining area that we're cropping to – None means no cropping
+            crop_to = None
+            primary_level_count = 0
+            main_level_passed = 0
+            lowest_important_level = None
+            last_lower_bound = None
+            for level in reversed(relevant_levels):  # reversed means we are going down
+                geoms = single_level_geoms[level.pk][None]
+
+                if geoms.holes is not None:
+                    primary_level_count += 1
+
+                # get lowest intermediate level directly below main level
+                if not main_level_passed:
+                    if geoms.pk == render_level.pk:
+                        main_level_passed = 1
                 else:
-                    last_interpolator = NearestNDInterpolator(np.array([[0, 0]]),
-                                                              np.array([float(render_level.base_altitude)]))
+                    if not level.on_top_of_id:
+                        main_level_passed += 1
+                if main_level_passed < 2:
+                    lowest_important_level = level
+
+                # make upper bounds
+                if geoms.on_top_of_id is None:
+                    if last_lower_bound is None:
+                        upper_bounds[geoms.pk] = geoms.max_altitude+geoms.max_height
+                    else:
+                        upper_bounds[geoms.pk] = last_lower_bound
+                    last_lower_bound = geoms.lower_bound
 
-            """
-            second pass, forward to create the LevelRenderData for each level
-            """
-            upper_bounds: dict[int, int] = {}
-            for render_level in levels:
-                # we don't create render data for on_top_of levels
-                if render_level.on_top_of_id is not None:
-                    continue
+                # set crop area if we are on the second primary layer from top or below
+                level_crop_to[level.pk] = crop_to if primary_level_count > 1 else None
 
-                map_history = MapHistory.open_level(render_level.pk, 'base')
-
-                # collect potentially relevant levels for rendering this level
-                # these are all levels that are on_top_of this level or below this level (inless intermediate)
-                relevant_levels = tuple(
-                    sublevel for sublevel in levels
-                    if (sublevel.pk == render_level.pk or sublevel.on_top_of_id == render_level.pk or
-                        (sublevel.base_altitude <= render_level.base_altitude and not sublevel.intermediate))
-                )
-
-                """
-                choose a crop area for each level. non-intermediate levels (not on_top_of) below the one that we are
-                currently rendering will be cropped to only render content that is visible through holes indoors in the
-                levels above them.
-                """
-                # area to crop each level to, by id
-                level_crop_to: dict[int, Cropper] = {}
-                # current remaining area that we're cropping to – None means no cropping
-                crop_to = None
-                primary_level_count = 0
-                main_level_passed = 0
-                lowest_important_level = None
-                last_lower_bound = None
-                for level in reversed(relevant_levels):  # reversed means we are going down
-                    geoms = single_level_geoms[level.pk]
-
-                    if geoms.holes is not None:
-                        primary_level_count += 1
-
-                    # get lowest intermediate level directly below main level
-                    if not main_level_passed:
-                        if geoms.pk == render_level.pk:
-                            main_level_passed = 1
-                    else:
-                        if not level.on_top_of_id:
-                            main_level_passed += 1
-                    if main_level_passed < 2:
-                        lowest_important_level = level
-
-                    # make upper bounds
-                    if geoms.on_top_of_id is None:
-                        if last_lower_bound is None:
-                            upper_bounds[geoms.pk] = geoms.max_altitude+geoms.max_height
-                        else:
-                            upper_bounds[geoms.pk] = last_lower_bound
-                        last_lower_bound = geoms.lower_bound
-
-                    # set crop area if we are on the second primary layer from top or below
-                    level_crop_to[level.pk] = Cropper(crop_to if primary_level_count > 1 else None)
-
-                    if geoms.holes is not None:  # there area holes on this area
-                        if crop_to is None:
-                            crop_to = geoms.holes
-                        else:
-                            crop_to = crop_to.intersection(geoms.holes)
-
-                        if crop_to.is_empty:
-                            break
-
-                if render_level.intermediate:
-                    # todo: would be nice to still have the staircases leading to this level i guess?
-                    lowest_important_level = render_level
-
-                render_data = LevelRenderData(
-                    base_altitude=render_level.base_altitude,
-                    lowest_important_level=lowest_important_level.pk,
-                )
-                access_restriction_affected = {}
-
-                # go through sublevels, get their level geometries and crop them
-                lowest_important_level_passed = False
-                for level in relevant_levels:
-                    try:
-                        crop_to = level_crop_to[level.pk]
-                    except KeyError:
-                        continue
-
-                    single_geoms = single_level_geoms[level.pk]
-
-                    if render_data.lowest_important_level == level.pk:
-                        lowest_important_level_passed = True
-
-                    if single_geoms.holes and render_data.darken_area is None and lowest_important_level_passed:
-                        render_data.darken_area = single_geoms.holes
-                        if render_level.intermediate:
-                            render_data.darken_much = True
-
-                    if crop_to.geometry is not None:
-                        map_history.composite(MapHistory.open_level(level.pk, 'base'), crop_to.geometry)
-                    elif render_level.pk != level.pk:
-                        map_history.composite(MapHistory.open_level(level.pk, 'base'), None)
-
-                    new_buildings_geoms = crop_to.intersection(single_geoms.buildings)
-                    if single_geoms.on_top_of_id is None:
-                        new_holes_geoms = crop_to.intersection(single_geoms.holes)
+                if geoms.holes is not None:  # there area holes on this area
+                    if crop_to is None:
+                        crop_to = geoms.holes
                     else:
-                        new_holes_geoms = None
-                    new_doors_geoms = crop_to.intersection(single_geoms.doors)
-                    new_walls_geoms = crop_to.intersection(single_geoms.walls)
-                    new_all_walls_geoms = crop_to.intersection(single_geoms.all_walls)
-                    new_short_walls_geoms = tuple((altitude, geom) for altitude, geom in tuple(
-                        (altitude, crop_to.intersection(geom))
-                        for altitude, geom in single_geoms.short_walls
-                    ) if not geom.is_empty)
-
-                    new_altitudeareas = []
-                    for altitudearea in single_geoms.altitudeareas:
-                        new_geometry = crop_to.intersection(unwrap_geom(altitudearea.geometry))
-                        if new_geometry.is_empty:
-                            continue
-                        new_geometry_prep = prepared.prep(new_geometry)
-
-                        new_altitudearea = AltitudeAreaGeometries()
-                        new_altitudearea.geometry = new_geometry
-                        new_altitudearea.altitude = altitudearea.altitude
-                        new_altitudearea.points = altitudearea.points
-
-                        new_colors = {}
-                        for color, areas in altitudearea.colors.items():
-                            new_areas = {}
-                            for access_restriction, area in areas.items():
-                                if not new_geometry_prep.intersects(area):
-                                    continue
-                                new_area = new_geometry.intersection(area)
-                                if not new_area.is_empty:
-                                    new_areas[access_restriction] = new_area
-                            if new_areas:
-                                new_colors[color] = new_areas
-                        new_altitudearea.colors = new_colors
-
-                        new_altitudearea_obstacles = {}
-                        for height, height_obstacles in altitudearea.obstacles.items():
-                            new_height_obstacles = {}
-                            for color, color_obstacles in height_obstacles.items():
-                                new_color_obstacles = []
-                                for obstacle in color_obstacles:
-                                    obstacle = obstacle.buffer(0)
-                                    if new_geometry_prep.intersects(obstacle):
-                                        new_color_obstacles.append(
-                                            obstacle.intersection(unwrap_geom(altitudearea.geometry))
-                                        )
-                                if new_color_obstacles:
-                                    new_height_obstacles[color] = new_color_obstacles
-                            if new_height_obstacles:
-                                new_altitudearea_obstacles[height] = new_height_obstacles
-                        new_altitudearea.obstacles = new_altitudearea_obstacles
-
-                        new_altitudeareas.append(new_altitudearea)
-
-                    if new_walls_geoms.is_empty and not new_altitudeareas:
-                        continue
-
-                    new_heightareas = tuple(
-                        (area, height) for area, height in ((crop_to.intersection(unwrap_geom(area)), height)
-                                                            for area, height in single_geoms.heightareas)
-                        if not area.is_empty
-                    )
-
-                    for access_restriction, area in single_geoms.access_restriction_affected.items():
-                        new_area = crop_to.intersection(area)
-                        if not new_area.is_empty:
-                            access_restriction_affected.setdefault(access_restriction, []).append(new_area)
+                        crop_to = crop_to.intersection(geoms.holes)
+
+                    if crop_to.is_empty:
+                        break
+
+            if render_level.intermediate:
+                # todo: would be nice to still have the staircases leading to this level i guess?
+                lowest_important_level = render_level
+
+            plan = LevelRenderPlan(
+                level_pk=render_level.pk,
+                base_altitude=render_level.base_altitude,
+                intermediate=render_level.intermediate,
+                lowest_important_level=lowest_important_level.pk,
+                crops=[(level.pk, level_crop_to[level.pk]) for level in relevant_levels if level.pk in level_crop_to],
+                upper_bounds=upper_bounds.copy(),
+            )
+            plans.append(plan)
+
+            map_history = MapHistory.open_level(render_level.pk, 'base')
+            for level_pk, crop_geometry in plan.crops:
+                if crop_geometry is not None:
+                    map_history.composite(MapHistory.open_level(level_pk, 'base'), crop_geometry)
+                elif render_level.pk != level_pk:
+                    map_history.composite(MapHistory.open_level(level_pk, 'base'), None)
+            map_history.save_level(render_level.pk, 'composite')
+            map_histories[render_level.pk] = map_history
+
+        logger.info('Planned render data for %d levels in %.2fs.' % (len(plans), time.perf_counter() - stage_start))
+
+        """
+        third pass, crop, compose and save the LevelRenderData for each level and theme
+        these are independent of each other, so they can be done in parallel
+        """
+        stage_start = time.perf_counter()
+        tasks = [
+            (update_cache_key, plan, theme,
+             {level_pk: single_level_geoms[level_pk][theme] for level_pk, crop_geometry in plan.crops},
+             interpolators.get(plan.level_pk), theme is None)
+            for theme in themes for plan in plans
+        ]
+
+        workers = min(settings.RENDER_DATA_WORKERS, len(tasks))
+        if workers > 1 and multiprocessing.current_process().daemon:
+            # daemonic processes (like celery workers) are not allowed to have children
+            logger.warning('Can\'t use render data worker processes inside a daemonic process, building serially.')
+            workers = 1
+
+        if workers > 1:
+            # worker processes don't touch the database, since it might be in an uncommitted transaction
+            with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+                results = list(executor.map(LevelRenderData._build_and_save, *zip(*tasks)))
+        else:
+            results = [LevelRenderData._build_and_save(*task) for task in tasks]
 
-                    new_restricted_spaces_indoors = {}
-                    for access_restriction, area in single_geoms.restricted_spaces_indoors.items():
-                        new_area = crop_to.intersection(area)
-                        if not new_area.is_empty:
-                            new_restricted_spaces_indoors[access_restriction] = new_area
+        access_restriction_affected: dict[int, AccessRestrictionAffected] = {}
+        for level_pk, theme, restrictions, duration in results:
+            logger.debug('Built render data for level %d with theme %s in %.2fs.' % (level_pk, theme, duration))
+            if restrictions is not None:
+                access_restriction_affected[level_pk] = AccessRestrictionAffected.build(restrictions)
+                access_restriction_affected[level_pk].save_level(level_pk, 'composite')
 
-                    new_restricted_spaces_outdoors = {}
-                    for access_restriction, area in single_geoms.restricted_spaces_outdoors.items():
-                        new_area = crop_to.intersection(area)
-                        if not new_area.is_empty:
-                            new_restricted_spaces_outdoors[access_restriction] = new_area
-
-                    composite_geoms = CompositeLevelGeometries(
-                        pk=single_geoms.pk,
-                        on_top_of_id=single_geoms.on_top_of_id,
-                        short_label=single_geoms.short_label,
-                        level_index=single_geoms.level_index,
-                        base_altitude=single_geoms.base_altitude,
-                        default_height=single_geoms.default_height,
-                        door_height=single_geoms.door_height,
-                        min_altitude=(min(area.min_altitude for area in new_altitudeareas)
-                                                  if new_altitudeareas else single_geoms.base_altitude),
-                        max_altitude=(max(area.max_altitude for area in new_altitudeareas)
-                                                  if new_altitudeareas else single_geoms.base_altitude),
-                        max_height=(min(height for area, height in new_heightareas)
-                                                if new_heightareas else single_geoms.default_height),
-                        lower_bound=single_geoms.lower_bound,
-                        upper_bound=upper_bounds.get(single_geoms.pk, 0),  # might be wrong but only needed for 3d
-                        heightareas=new_heightareas,
-                        altitudeareas=new_altitudeareas,
-
-                        buildings=new_buildings_geoms,
-                        holes=new_holes_geoms,
-                        doors=new_doors_geoms,
-                        walls=new_walls_geoms,
-                        all_walls=new_all_walls_geoms,
-                        short_walls=new_short_walls_geoms,
-
-                        restricted_spaces_indoors=new_restricted_spaces_indoors,
-                        restricted_spaces_outdoors=new_restricted_spaces_outdoors,
-
-                        ramps=tuple(
-                            ramp for ramp in (crop_to.intersection(unwrap_geom(ramp)) for ramp in single_geoms.ramps)
-                            if not ramp.is_empty
-                        ),
-
-                        affected_area=unary_union((
-                            *(altitudearea.geometry for altitudearea in new_altitudeareas),
-                            crop_to.intersection(new_walls_geoms.buffer(1)),
-                            *((new_holes_geoms.buffer(1),) if new_holes_geoms else ()),
-                        )),
-
-                        doors_extended=None,
-                        faces=None,
-                        vertices=None,
-                        walls_base=None,
-                        walls_bottom=None,
-                        walls_extended=None,
-                    )
-
-                    composite_geoms.build_mesh(interpolators.get(render_level.pk) if level.pk == render_level.pk else None)
-
-                    render_data.levels.append(composite_geoms)
-
-                access_restriction_affected = {
-                    access_restriction: unary_union(areas)
-                    for access_restriction, areas in access_restriction_affected.items()
-                }
-
-                access_restriction_affected = AccessRestrictionAffected.build(access_restriction_affected)
-                access_restriction_affected.save_level(render_level.pk, 'composite')
-
-                map_history.save_level(render_level.pk, 'composite')
-
-                package.add_level(level_id=render_level.pk, theme_id=theme, history=map_history,
-                                  restrictions=access_restriction_affected,
-                                  level_restriction=render_level.access_restriction_id)
-
-                render_data.save(update_cache_key, render_level.pk, theme)
+        logger.info('Built render data for %d levels and %d themes in %.2fs using %d worker(s).' %
+                    (len(plans), len(themes), time.perf_counter() - stage_start, workers))
+
+        stage_start = time.perf_counter()
+        levels_by_pk = {level.pk: level for level in levels}
+        for theme in themes:
+            for plan in plans:
+                package.add_level(level_id=plan.level_pk, theme_id=theme, history=map_histories[plan.level_pk],
+                                  restrictions=access_restriction_affected[plan.level_pk],
+                                  level_restriction=levels_by_pk[plan.level_pk].access_restriction_id)
 
         package.save_all(update_cache_key)
 
-    cached = LocalContext()
+        # tileservers that have the previous package only need to download what changed
+        previous_update_cache_key = MapUpdate.current_processed_geometry_cache_key()
+        if previous_update_cache_key != update_cache_key:
+            try:
+                package.save_delta(update_cache_key, previous_update_cache_key)
+            except FileNotFoundError:
+                logger.info('No previous cache package found, not saving a delta package.')
+        logger.info('Saved cache package in %.2fs.' % (time.perf_counter() - stage_start))
 
     @staticmethod
-    def _level_filename(update_cache_key, level_pk, theme_pk):
-        if theme_pk is None:
-            name = 'render_data_level_%d.pickle' % level_pk
+    def _build_and_save(update_cache_key, plan: "LevelRenderPlan", theme: int | None,
+                        single_level_geoms: dict[int, SingleLevelGeometries], interpolator,
+                        collect_restrictions: bool) -> tuple[int, int | None, Optional[dict], float]:
+        """
+        Crop and compose the LevelRenderData for one level and one theme and save it.
+        This runs in a worker process, so it gets everything it needs passed and must not access the database.
+        Returns the level, the theme, the composite access restriction areas (if requested) and the duration.
+        """
+        start = time.perf_counter()
+
+        render_data = LevelRenderData(
+            base_altitude=plan.base_altitude,
+            lowest_important_level=plan.lowest_important_level,
+        )
+        access_restriction_affected = {}
+
+        # go through sublevels, get their level geometries and crop them
+        lowest_important_level_passed = False
+        for level_pk, crop_geometry in plan.crops:
+            crop_to = Cropper(crop_geometry)
+
+            single_geoms = single_level_geoms[level_pk]
+
+            if render_data.lowest_important_level == level_pk:
+                lowest_important_level_passed = True
+
+            if single_geoms.holes and render_data.darken_area is None and lowest_important_level_passed:
+                render_data.darken_area = single_geoms.holes
+                if plan.intermediate:
+                    render_data.darken_much = True
+
+            new_buildings_geoms = crop_to.intersection(single_geoms.buildings)
+            if single_geoms.on_top_of_id is None:
+                new_holes_geoms = crop_to.intersection(single_geoms.holes)
+            else:
+                new_holes_geoms = None
+            new_doors_geoms = crop_to.intersection(single_geoms.doors)
+            new_walls_geoms = crop_to.intersection(single_geoms.walls)
+            new_all_walls_geoms = crop_to.intersection(single_geoms.all_walls)
+            new_short_walls_geoms = tuple((altitude, geom) for altitude, geom in tuple(
+                (altitude, crop_to.intersection(geom))
+                for altitude, geom in single_geoms.short_walls
+            ) if not geom.is_empty)
+
+            new_altitudeareas = []
+            for altitudearea in single_geoms.altitudeareas:
+                new_geometry = crop_to.intersection(unwrap_geom(altitudearea.geometry))
+                if new_geometry.is_empty:
+                    continue
+                new_geometry_prep = prepared.prep(new_geometry)
+
+                new_altitudearea = AltitudeAreaGeometries()
+                new_altitudearea.geometry = new_geometry
+                new_altitudearea.altitude = altitudearea.altitude
+                new_altitudearea.points = altitudearea.points
+
+                new_colors = {}
+                for color, areas in altitudearea.colors.items():
+                    new_areas = {}
+                    for access_restriction, area in areas.items():
+                        if not new_geometry_prep.intersects(area):
+                            continue
+                        new_area = new_geometry.intersection(area)
+                        if not new_area.is_empty:
+                            new_areas[access_restriction] = new_area
+                    if new_areas:
+                        new_colors[color] = new_areas
+                new_altitudearea.colors = new_colors
+
+                new_altitudearea_obstacles = {}
+                for height, height_obstacles in altitudearea.obstacles.items():
+                    new_height_obstacles = {}
+                    for color, color_obstacles in height_obstacles.items():
+                        new_color_obstacles = []
+                        for obstacle in color_obstacles:
+                            obstacle = obstacle.buffer(0)
+                            if new_geometry_prep.intersects(obstacle):
+                                new_color_obstacles.append(
+                                    obstacle.intersection(unwrap_geom(altitudearea.geometry))
+                                )
+                        if new_color_obstacles:
+                            new_height_obstacles[color] = new_color_obstacles
+                    if new_height_obstacles:
+                        new_altitudearea_obstacles[height] = new_height_obstacles
+                new_altitudearea.obstacles = new_altitudearea_obstacles
+
+                new_altitudeareas.append(new_altitudearea)
+
+            if new_walls_geoms.is_empty and not new_altitudeareas:
+                continue
+
+            new_heightareas = tuple(
+                (area, height) for area, height in ((crop_to.intersection(unwrap_geom(area)), height)
+                                                    for area, height in single_geoms.heightareas)
+                if not area.is_empty
+            )
+
+            for access_restriction, area in single_geoms.access_restriction_affected.items():
+                new_area = crop_to.intersection(area)
+                if not new_area.is_empty:
+                    access_restriction_affected.setdefault(access_restriction, []).append(new_area)
+
+            new_restricted_spaces_indoors = {}
+            for access_restriction, area in single_geoms.restricted_spaces_indoors.items():
+                new_area = crop_to.intersection(area)
+                if not new_area.is_empty:
+                    new_restricted_spaces_indoors[access_restriction] = new_area
+
+            new_restricted_spaces_outdoors = {}
+            for access_restriction, area in single_geoms.restricted_spaces_outdoors.items():
+                new_area = crop_to.intersection(area)
+                if not new_area.is_empty:
+                    new_restricted_spaces_outdoors[access_restriction] = new_area
+
+            composite_geoms = CompositeLevelGeometries(
+                pk=single_geoms.pk,
+                on_top_of_id=single_geoms.on_top_of_id,
+                short_label=single_geoms.short_label,
+                level_index=single_geoms.level_index,
+                base_altitude=single_geoms.base_altitude,
+                default_height=single_geoms.default_height,
+                door_height=single_geoms.door_height,
+                min_altitude=(min(area.min_altitude for area in new_altitudeareas)
+                                          if new_altitudeareas else single_geoms.base_altitude),
+                max_altitude=(max(area.max_altitude for area in new_altitudeareas)
+                                          if new_altitudeareas else single_geoms.base_altitude),
+                max_height=(min(height for area, height in new_heightareas)
+                                        if new_heightareas else single_geoms.default_height),
+                lower_bound=single_geoms.lower_bound,
+                upper_bound=plan.upper_bounds.get(single_geoms.pk, 0),  # might be wrong but only needed for 3d
+                heightareas=new_heightareas,
+                altitudeareas=new_altitudeareas,
+
+                buildings=new_buildings_geoms,
+                holes=new_holes_geoms,
+                doors=new_doors_geoms,
+                walls=new_walls_geoms,
+                all_walls=new_all_walls_geoms,
+                short_walls=new_short_walls_geoms,
+
+                restricted_spaces_indoors=new_restricted_spaces_indoors,
+                restricted_spaces_outdoors=new_restricted_spaces_outdoors,
+
+                ramps=tuple(
+                    ramp for ramp in (crop_to.intersection(unwrap_geom(ramp)) for ramp in single_geoms.ramps)
+                    if not ramp.is_empty
+                ),
+
+                affected_area=unary_union((
+                    *(altitudearea.geometry for altitudearea in new_altitudeareas),
+                    crop_to.intersection(new_walls_geoms.buffer(1)),
+                    *((new_holes_geoms.buffer(1),) if new_holes_geoms else ()),
+                )),
+
+                doors_extended=None,
+                faces=None,
+                vertices=None,
+                walls_base=None,
+                walls_bottom=None,
+                walls_extended=None,
+            )
+
+            composite_geoms.build_mesh(interpolator if level_pk == plan.level_pk else None)
+
+            render_data.levels.append(composite_geoms)
+
+        render_data.save(update_cache_key, plan.level_pk, theme)
+        if settings.RENDER_CHUNK_SIZE:
+            LevelRenderChunks.build(render_data, settings.RENDER_CHUNK_SIZE).save(update_cache_key, plan.level_pk,
+                                                                                  theme)
+
+        if collect_restrictions:
+            access_restriction_affected = {
+                access_restriction: unary_union(areas)
+                for access_restriction, areas in access_restriction_affected.items()
+            }
         else:
-            name = 'render_data_level_%d_theme_%d.pickle' % (level_pk, theme_pk)
-        return settings.CACHE_ROOT / update_cache_key / name
+            access_restriction_affected = None
+
+        return plan.level_pk, theme, access_restriction_affected, time.perf_counter() - start
+
+
+ChunkKey = tuple[int, int]
+SlotKey = tuple
+
+
+def cut_into_chunks(slots: dict[SlotKey, Geometry | HybridGeometry],
+                    chunk_size: int) -> dict[ChunkKey, dict[SlotKey, Geometry | HybridGeometry]]:
+    """
+    Cut the given geometries along a grid of square chunks.
+    Returns the non-empty pieces for every chunk. HybridGeometries are cut in 2D only and lose their faces.
+    """
+    slots = {key: geometry for key, geometry in slots.items() if not geometry.is_empty}
+    if not slots:
+        return {}
+    geometries = np.array([unwrap_geom(geometry.geom if isinstance(geometry, HybridGeometry) else geometry)
+                           for geometry in slots.values()], dtype=object)
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    chunk_xs, chunk_ys = np.meshgrid(np.arange(int(minx // chunk_size), int(maxx // chunk_size) + 1),
+                                     np.arange(int(miny // chunk_size), int(maxy // chunk_size) + 1))
+    chunk_xs, chunk_ys = chunk_xs.ravel(), chunk_ys.ravel()
+    boxes = shapely.box(chunk_xs * chunk_size, chunk_ys * chunk_size,
+                        (chunk_xs + 1) * chunk_size, (chunk_ys + 1) * chunk_size)
+
+    chunks: dict[ChunkKey, dict[SlotKey, Geometry | HybridGeometry]] = {}
+    for (key, original), geometry in zip(slots.items(), geometries):
+        shapely.prepare(geometry)
+        hits = np.flatnonzero(shapely.intersects(geometry, boxes))
+        for i, piece in zip(hits.tolist(), shapely.intersection(geometry, boxes[hits])):
+            if geometry.area and piece.geom_type not in ('Polygon', 'MultiPolygon'):
+                # only touching the chunk border doesn't count
+                piece = unary_union([part for part in shapely.get_parts(piece) if part.area])
+            if piece.is_empty:
+                continue
+            if isinstance(original, HybridGeometry):
+                piece = HybridGeometry(piece, (), crop_ids=original.crop_ids)
+            chunks.setdefault((int(chunk_xs[i]), int(chunk_ys[i])), {})[key] = piece
+    return chunks
+
+
+def merge_chunks(chunks: Iterable[dict[SlotKey, Geometry | HybridGeometry]]
+                 ) -> dict[SlotKey, Geometry | HybridGeometry]:
+    """
+    Merge the pieces of the given chunks back together.
+    """
+    pieces: dict[SlotKey, list[Geometry | HybridGeometry]] = {}
+    for chunk in chunks:
+        for key, piece in chunk.items():
+            pieces.setdefault(key, []).append(piece)
+    return {
+        key: (key_pieces[0] if len(key_pieces) == 1 else
+              hybrid_union(key_pieces) if isinstance(key_pieces[0], HybridGeometry) else unary_union(key_pieces))
+        for key, key_pieces in pieces.items()
+    }
+
+
+@dataclass
+class ChunkedLevelGeometries:
+    """
+    The geometries of a CompositeLevelGeometries that are needed for 2D rendering, cut into chunks.
+    """
+    template: CompositeLevelGeometries
+    keys: tuple[SlotKey, ...]
+    altitudes: tuple[tuple[int | None, list | None], ...]
+    chunks: dict[ChunkKey, dict[SlotKey, Geometry | HybridGeometry]]
 
     @classmethod
-    def get(cls, level, theme):
-        # get the current render data from local variable if no new processed mapupdate exists.
-        # this is much faster than any other possible cache
-        cache_key = MapUpdate.current_processed_geometry_cache_key()
-        level_pk = level.pk if isinstance(level, Level) else level
-        theme_pk = theme.pk if isinstance(theme, Theme) else theme
-        key = f'{level_pk}_{theme_pk}'
-        if getattr(cls.cached, 'key', None) != cache_key:
-            cls.cached.key = cache_key
-            cls.cached.data = {}
-        else:
-            result = cls.cached.data.get(key, None)
-            if result is not None:
-                return result
+    def build(cls, geoms: CompositeLevelGeometries, chunk_size: int) -> Self:
+        slots: dict[SlotKey, Geometry | HybridGeometry] = {
+            ('walls', ): geoms.walls,
+            ('all_walls', ): geoms.all_walls,
+            ('doors', ): geoms.doors,
+            ('affected_area', ): geoms.affected_area,
+        }
+        for i, short_wall in enumerate(geoms.short_walls):
+            slots['short_walls', i] = short_wall
+        for access_restriction, area in geoms.restricted_spaces_indoors.items():
+            slots['restricted_spaces_indoors', access_restriction] = area
+        for access_restriction, area in geoms.restricted_spaces_outdoors.items():
+            slots['restricted_spaces_outdoors', access_restriction] = area
+        for i, altitudearea in enumerate(geoms.altitudeareas):
+            slots['altitudearea', i] = altitudearea.geometry
+            for color, areas in altitudearea.colors.items():
+                for access_restriction, area in areas.items():
+                    slots['color', i, color, access_restriction] = area
+            for height, height_obstacles in altitudearea.obstacles.items():
+                for color, color_obstacles in height_obstacles.items():
+                    for j, obstacle in enumerate(color_obstacles):
+                        slots['obstacle', i, height, color, j] = obstacle
+
+        empty = HybridGeometry(empty_geometry_collection, ())
+        return cls(
+            template=replace(
+                geoms,
+                buildings=empty_geometry_collection, holes=None, heightareas=(), ramps=(), altitudeareas=[],
+                walls=empty, all_walls=empty, short_walls=(), doors=empty, affected_area=empty_geometry_collection,
+                restricted_spaces_indoors={}, restricted_spaces_outdoors={},
+                doors_extended=None, vertices=None, faces=None, walls_base=None, walls_bottom=None,
+                walls_extended=None,
+            ),
+            keys=tuple(slots.keys()),
+            altitudes=tuple((altitudearea.altitude, altitudearea.points) for altitudearea in geoms.altitudeareas),
+            chunks=cut_into_chunks(slots, chunk_size),
+        )
+
+    def get_geometries(self, chunk_keys: Iterable[ChunkKey]) -> CompositeLevelGeometries:
+        """
+        Assemble the geometries of the given chunks, in the same order as the original.
+        """
+        slots = merge_chunks(self.chunks[chunk_key] for chunk_key in chunk_keys if chunk_key in self.chunks)
+        if not slots:
+            return self.template
+
+        fields = {}
+        short_walls = []
+        restricted_spaces = {'restricted_spaces_indoors': {}, 'restricted_spaces_outdoors': {}}
+        altitudeareas: dict[int, AltitudeAreaGeometries] = {}
+        for key in self.keys:
+            geometry = slots.get(key)
+            if geometry is None:
+                continue
+            kind, *path = key
+            if kind == 'short_walls':
+                short_walls.append(geometry)
+            elif kind in restricted_spaces:
+                restricted_spaces[kind][path[0]] = geometry
+            elif kind in ('altitudearea', 'color', 'obstacle'):
+                altitudearea = altitudeareas.get(path[0])
+                if altitudearea is None:
+                    altitudearea = AltitudeAreaGeometries()
+                    altitudearea.altitude, altitudearea.points = self.altitudes[path[0]]
+                    altitudearea.geometry = HybridGeometry(empty_geometry_collection, ())
+                    altitudearea.colors = {}
+                    altitudearea.obstacles = {}
+                    altitudeareas[path[0]] = altitudearea
+                if kind == 'altitudearea':
+                    altitudearea.geometry = geometry
+                elif kind == 'color':
+                    altitudearea.colors.setdefault(path[1], {})[path[2]] = geometry
+                else:
+                    altitudearea.obstacles.setdefault(path[1], {}).setdefault(path[2], []).append(geometry)
+            else:
+                fields[kind] = geometry
 
-        result = pickle.load(open(cls._level_filename(cache_key, level_pk, theme_pk), 'rb'))
+        return replace(self.template, altitudeareas=list(altitudeareas.values()), short_walls=tuple(short_walls),
+                       **restricted_spaces, **fields)
 
-        cls.cached.data[key] = result
-        return result
 
-    def save(self, update_cache_key, level_pk, theme_pk):
-        return pickle.dump(self, open(self._level_filename(update_cache_key, level_pk, theme_pk), 'wb'))
+@dataclass
+class LevelRenderChunks(LevelFileMixin):
+    """
+    The LevelRenderData for 2D rendering, cut into square chunks.
+    Rendering a small area only has to look at the pieces of the chunks it touches instead of whole levels.
+    """
+    chunk_size: int
+    base_altitude: float
+    lowest_important_level: int
+    levels: list[ChunkedLevelGeometries]
+    darken_area: dict[ChunkKey, dict[SlotKey, Geometry]]
+    darken_much: bool
+
+    filename_prefix = 'render_chunks'
+    cached = LocalContext()
+
+    @classmethod
+    def build(cls, render_data: LevelRenderData, chunk_size: int) -> Self:
+        return cls(
+            chunk_size=chunk_size,
+            base_altitude=render_data.base_altitude,
+            lowest_important_level=render_data.lowest_important_level,
+            levels=[ChunkedLevelGeometries.build(geoms, chunk_size) for geoms in render_data.levels],
+            darken_area=cut_into_chunks({('darken_area', ): render_data.darken_area}, chunk_size)
+            if render_data.darken_area is not None else {},
+            darken_much=render_data.darken_much,
+        )
+
+    def get_render_data(self, minx, miny, maxx, maxy) -> LevelRenderData:
+        """
+        Assemble LevelRenderData containing everything within the given bounds and a bit more.
+        """
+        chunk_keys = tuple(
+            (x, y)
+            for x in range(int(minx // self.chunk_size), int(maxx // self.chunk_size) + 1)
+            for y in range(int(miny // self.chunk_size), int(maxy // self.chunk_size) + 1)
+        )
+        darken_area = merge_chunks(self.darken_area[chunk_key] for chunk_key in chunk_keys
+                                   if chunk_key in self.darken_area).get(('darken_area', ))
+        return LevelRenderData(
+            base_altitude=self.base_altitude,
+            lowest_important_level=self.lowest_important_level,
+            levels=[level.get_geometries(chunk_keys) for level in self.levels],
+            darken_area=darken_area,
+            darken_much=self.darken_much,
+        )
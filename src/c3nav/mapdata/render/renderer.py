@@ -1,5 +1,6 @@
 from itertools import chain
 
+from django.conf import settings
 from django.utils.functional import cached_property
 from shapely import prepared
 from shapely.geometry import box
@@ -7,7 +8,7 @@ from shapely.geometry import box
 from c3nav.mapdata.models import Level, Source
 from c3nav.mapdata.render.engines.base import FillAttribs, StrokeAttribs
 from c3nav.mapdata.render.geometry import hybrid_union
-from c3nav.mapdata.render.renderdata import LevelRenderData
+from c3nav.mapdata.render.renderdata import LevelRenderChunks, LevelRenderData
 from c3nav.mapdata.render.theme import ColorManager
 from c3nav.mapdata.render.utils import get_full_levels, get_min_altitude
 from c3nav.mapdata.utils.color import color_to_rgb, rgb_to_color
@@ -33,6 +34,11 @@ class MapRenderer:
     def bbox(self):
         return box(self.minx-1, self.miny-1, self.maxx+1, self.maxy+1)
 
+    def _use_chunks(self, engine_cls):
+        # chunks only contain 2d geometries and only make sense if we only need a few of them
+        return (settings.RENDER_CHUNK_SIZE and not engine_cls.is_3d and not hasattr(engine_cls, 'custom_render') and
+                max(self.maxx - self.minx, self.maxy - self.miny) <= settings.RENDER_CHUNK_SIZE * 2)
+
     def render(self, engine_cls, theme, center=True):
         color_manager = ColorManager.for_theme(theme)
         # add no access restriction to “unlocked“ access restrictions so lookup gets easier
@@ -40,7 +46,17 @@ class MapRenderer:
 
         bbox = prepared.prep(self.bbox)
 
-        level_render_data = LevelRenderData.get(self.level, theme)
+        level_render_data = None
+        if self._use_chunks(engine_cls):
+            try:
+                render_chunks = LevelRenderChunks.get(self.level, theme)
+            except FileNotFoundError:
+                # render data was built before chunks existed
+                pass
+            else:
+                level_render_data = render_chunks.get_render_data(*self.bbox.bounds)
+        if level_render_data is None:
+            level_render_data = LevelRenderData.get(self.level, theme)
 
         engine = engine_cls(self.width, self.height, self.minx, self.miny, float(level_render_data.base_altitude),
                             scale=self.scale, buffer=1, background=color_manager.background,
@@ -75,6 +91,7 @@ class MapRenderer:
                 tuple(area for access_restriction, area in geoms.restricted_spaces_outdoors.items()
                       if access_restriction not in access_permissions)
             ).union(add_walls)
+            engine.add_restricted_areas(crop_areas)
 
             if not_full_levels:
                 engine.add_geometry(geoms.walls_base, fill=FillAttribs(color_manager.wall_fill), category='walls')
@@ -2,6 +2,7 @@ import logging
 import time
 
 from celery.exceptions import MaxRetriesExceededError
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
 from django.utils.formats import date_format
@@ -49,6 +50,17 @@ def process_map_updates(self):
             'id': updates[-1].pk,
         })
 
+        if settings.TILE_PRERENDER and settings.CACHE_TILES and settings.HAS_CELERY:
+            if any(update.geometries_changed for update in updates):
+                prerender_tiles.delay(since=updates[0].pk - 1)
+
+
+@app.task(bind=True, max_retries=10)
+def prerender_tiles(self, since=None):
+    logger.info('Prerendering outdated tiles...')
+    from c3nav.mapdata.render.prerender import prerender_tiles as prerender_outdated_tiles
+    prerender_outdated_tiles(since=since)
+
 
 @app.task(bind=True, max_retries=10)
 def delete_map_cache_key(self, cache_key):
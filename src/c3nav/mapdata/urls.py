@@ -2,7 +2,8 @@ from django.urls import path, register_converter
 
 from c3nav.mapdata.converters import (AccessPermissionsConverter, ArchiveFileExtConverter, HistoryFileExtConverter,
                                       HistoryModeConverter, SignedIntConverter)
-from c3nav.mapdata.views import get_cache_package, map_history, preview_location, preview_route, tile
+from c3nav.mapdata.views import (get_cache_package, get_cache_package_delta, map_history, preview_location,
+                                 preview_route, tile, vector_tile)
 from c3nav.site.converters import LocationConverter
 
 register_converter(LocationConverter, 'loc')
@@ -18,6 +19,10 @@ urlpatterns = [
     path('preview/r/<loc:slug>/<loc:slug2>.png', preview_route, name='mapdata.preview.route'),
     path('<int:level>/<sint:zoom>/<sint:x>/<sint:y>/<int:theme>/<a_perms:access_permissions>.png', tile,
          name='mapdata.tile'),
+    path('<int:level>/<sint:zoom>/<sint:x>/<sint:y>/<int:theme>.mvt', vector_tile, name='mapdata.vector_tile'),
+    path('<int:level>/<sint:zoom>/<sint:x>/<sint:y>/<int:theme>/<a_perms:access_permissions>.mvt', vector_tile,
+         name='mapdata.vector_tile'),
     path('history/<int:level>/<h_mode:mode>.<h_fileext:filetype>', map_history, name='mapdata.map_history'),
     path('cache/package.<archive_fileext:filetype>', get_cache_package, name='mapdata.cache_package'),
+    path('cache/package-delta.tar.zst', get_cache_package_delta, name='mapdata.cache_package_delta'),
 ]
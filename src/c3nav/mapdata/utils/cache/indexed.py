@@ -44,7 +44,11 @@ class GeometryIndexed:
         return instance
 
     @classmethod
-    def read(cls, f):
+    def read(cls, f, buffer=None, offset=0):
+        """
+        Read from the given file. If a buffer (like an mmap) is given, only the header is read from the file and the
+        data becomes a read-only view into the buffer at the given offset, without copying it.
+        """
         variant_id, resolution, x, y, width, height = struct.unpack('<BBhhHH', f.read(10))
         if variant_id != cls.variant_id:
             raise ValueError('variant id does not match')
@@ -56,8 +60,14 @@ class GeometryIndexed:
         }
         cls._read_metadata(f, kwargs)
 
-        # noinspection PyTypeChecker
-        kwargs['data'] = np.fromstring(f.read(width*height*cls.dtype().itemsize), cls.dtype).reshape((height, width))
+        if buffer is not None:
+            data = np.frombuffer(buffer, dtype=cls.dtype, count=width*height, offset=offset)
+        else:
+            # read directly into the array to avoid copying the data
+            data = np.empty(width*height, dtype=cls.dtype)
+            if f.readinto(data) != data.nbytes:
+                raise ValueError('unexpected end of data')
+        kwargs['data'] = data.reshape((height, width))
         return cls(**kwargs)
 
     @classmethod
@@ -74,9 +84,12 @@ class GeometryIndexed:
             self.write(f)
 
     def write(self, f):
+        self.write_header(f)
+        f.write(self.data.tobytes('C'))
+
+    def write_header(self, f):
         f.write(struct.pack('<BBhhHH', self.variant_id, self.resolution, self.x, self.y, *reversed(self.data.shape)))
         self._write_metadata(f)
-        f.write(self.data.tobytes('C'))
 
     def _write_metadata(self, f):
         pass
@@ -110,7 +123,12 @@ class GeometryIndexed:
         self.x = minx
         self.y = miny
 
-    def get_geometry_cells(self, geometry, bounds=None):
+    def get_geometry_cells(self, geometry, bounds=None, touches=True):
+        """
+        Get a boolean array of all cells that are covered by the given geometry.
+        If touches is True, every cell that intersects the geometry (even if only touching it) is included,
+        otherwise only cells whose center lies within the geometry are included.
+        """
         if bounds is None:
             bounds = self._get_geometry_bounds(geometry)
         minx, miny, maxx, maxy = bounds
@@ -121,19 +139,66 @@ class GeometryIndexed:
         maxx = min(maxx, self.x + width)
         maxy = min(maxy, self.y + height)
 
-        from shapely import prepared
-        from shapely.geometry import box
-
         cells = np.zeros_like(self.data, dtype=bool)
-        prep = prepared.prep(geometry)
-        res = self.resolution
-        for iy, y in enumerate(range(miny * res, maxy * res, res), start=miny - self.y):
-            for ix, x in enumerate(range(minx * res, maxx * res, res), start=minx - self.x):
-                if prep.intersects(box(x, y, x + res, y + res)):
-                    cells[iy, ix] = True
+        if minx >= maxx or miny >= maxy:
+            return cells
+
+        import shapely
+        shapely.prepare(geometry)
 
+        # cells with their center inside the geometry
+        res = self.resolution
+        center_x, center_y = np.meshgrid((np.arange(minx, maxx) + 0.5) * res, (np.arange(miny, maxy) + 0.5) * res)
+        covered = shapely.contains_xy(geometry, center_x, center_y)
+
+        if touches:
+            # any other cell that intersects the geometry has to intersect its boundary, so only those are tested
+            candidates = self._get_boundary_cells(geometry, minx, miny, maxx, maxy) & ~covered
+            iy, ix = np.nonzero(candidates)
+            if iy.size:
+                boxes = shapely.box((ix + minx) * res, (iy + miny) * res, (ix + minx + 1) * res, (iy + miny + 1) * res)
+                intersects = shapely.intersects(geometry, boxes)
+                covered[iy[intersects], ix[intersects]] = True
+
+        cells[miny - self.y:maxy - self.y, minx - self.x:maxx - self.x] = covered
         return cells
 
+    def _get_boundary_cells(self, geometry, minx, miny, maxx, maxy):
+        """
+        Get all cells within the given bounds that might intersect the boundary of the given geometry,
+        including all their neighbors. This is conservative, the result needs to be checked exactly.
+        """
+        import shapely
+
+        parts = shapely.get_parts(shapely.get_parts(geometry))
+        polygons = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+        linear = np.concatenate((shapely.get_rings(parts[polygons]), parts[~polygons]))
+        coords, index = shapely.get_coordinates(linear, return_index=True)
+
+        # sample all segments, so that at least one sample lies in every cell they pass through
+        same_part = index[:-1] == index[1:]
+        starts = coords[:-1][same_part]
+        vectors = coords[1:][same_part] - starts
+        counts = np.ceil(np.hypot(vectors[:, 0], vectors[:, 1]) / (self.resolution / 4)).astype(np.int64) + 1
+        segments = np.repeat(np.arange(len(starts)), counts)
+        steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        factors = steps / np.repeat(np.maximum(counts - 1, 1), counts)
+        samples = np.vstack((coords, starts[segments] + vectors[segments] * factors[:, np.newaxis]))
+
+        # mark sampled cells with one cell of padding on each side, then dilate by one cell
+        sample_x = np.floor(samples[:, 0] / self.resolution).astype(np.int64) - minx + 1
+        sample_y = np.floor(samples[:, 1] / self.resolution).astype(np.int64) - miny + 1
+        height, width = maxy - miny, maxx - minx
+        valid = (sample_x >= 0) & (sample_x < width + 2) & (sample_y >= 0) & (sample_y < height + 2)
+        sampled = np.zeros((height + 2, width + 2), dtype=bool)
+        sampled[sample_y[valid], sample_x[valid]] = True
+
+        result = np.zeros((height, width), dtype=bool)
+        for dy in range(3):
+            for dx in range(3):
+                result |= sampled[dy:dy + height, dx:dx + width]
+        return result
+
     @property
     def bounds(self):
         height, width = self.data.shape
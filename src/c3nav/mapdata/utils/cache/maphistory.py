@@ -60,7 +60,9 @@ class MapHistory(LevelGeometryIndexed):
             self.data[affected] = i
 
     def write(self, *args, **kwargs):
-        self.simplify()
+        # read-only (memory-mapped) histories have been simplified before they were saved
+        if self.data.flags.writeable:
+            self.simplify()
         super().write(*args, **kwargs)
 
     def composite(self, other, mask_geometry):
@@ -1,10 +1,12 @@
+import json
+import mmap
 import os
 import struct
 from collections import namedtuple
 from io import BytesIO
 from pathlib import Path
 from tarfile import TarFile, TarInfo
-from typing import BinaryIO, Optional, Self, NamedTuple
+from typing import BinaryIO, Iterator, Optional, Self, NamedTuple
 
 from pyzstd import CParameter, ZstdError, ZstdFile
 
@@ -17,6 +19,14 @@ except ImportError:
 
 ZSTD_MAGIC_NUMBER = b"\x28\xb5\x2f\xfd"
 
+# uncompressed package layout that can be memory-mapped:
+# 8 bytes: magic number
+# for each history and restrictions raster: header, then data aligned to MMAP_ALIGNMENT bytes
+# json index with bounds, metadata and the offsets of every raster's header and data
+# 8 bytes (uint64): offset of the json index
+MMAP_MAGIC_NUMBER = b"C3NAVMAP"
+MMAP_ALIGNMENT = 64
+
 
 class CachePackageLevel(NamedTuple):
     history: MapHistory
@@ -29,6 +39,11 @@ class CachePackage:
         self.bounds = bounds
         self.levels = {} if levels is None else levels
         self.theme_ids = []
+        # only set for delta packages
+        self.delta_base: Optional[str] = None
+        self.removed_levels: set[tuple[int, int | None]] = set()
+        # stored in memory-mappable packages, so processes opening the file know where it came from
+        self.metadata: dict = {}
 
     def add_level(self, level_id: int, theme_id, history: MapHistory, restrictions: AccessRestrictionAffected,
                   level_restriction: int | None):
@@ -48,10 +63,38 @@ class CachePackage:
         else:
             return settings.CACHE_ROOT / update_cache_key / 'package.tar'
 
-    def save(self, update_cache_key, filename=None, compression=None):
-        if filename is None:
-            filename = self.get_filename(update_cache_key, compression=compression)
+    @staticmethod
+    def get_delta_filename(update_cache_key, base_update_cache_key):
+        from django.conf import settings
+        return settings.CACHE_ROOT / update_cache_key / f'package.delta.{base_update_cache_key}.tar.zst'
+
+    @staticmethod
+    def _level_key(level_id, theme_id):
+        if theme_id is None:
+            return '%d' % level_id
+        return '%d_%d' % (level_id, theme_id)
+
+    def _get_files(self) -> dict[str, bytes]:
+        files = {
+            'bounds': struct.pack('<iiii', *(int(i*100) for i in self.bounds)),
+        }
+        for (level_id, theme_id), level_data in self.levels.items():
+            key = self._level_key(level_id, theme_id)
+            files['global_restrictions_%s' % key] = struct.pack('<B'+('I'*len(level_data.global_restrictions)),
+                                                                len(level_data.global_restrictions),
+                                                                *level_data.global_restrictions)
+            files['history_%s' % key] = self._geometryindexed_bytes(level_data.history)
+            files['restrictions_%s' % key] = self._geometryindexed_bytes(level_data.restrictions)
+        return files
+
+    @staticmethod
+    def _geometryindexed_bytes(obj: GeometryIndexed) -> bytes:
+        data = BytesIO()
+        obj.write(data)
+        return data.getvalue()
 
+    @classmethod
+    def _write_files(cls, filename, files: dict[str, bytes], compression=None):
         filemode = 'w'
         fileobj = None
         if compression == 'zst':
@@ -64,88 +107,218 @@ class CachePackage:
 
         try:
             with TarFile.open(filename, filemode, fileobj=fileobj) as f:
-                self._add_bytesio(f, 'bounds',
-                                  BytesIO(struct.pack('<iiii', *(int(i*100) for i in self.bounds))))
-
-                for (level_id, theme_id), level_data in self.levels.items():
-                    if theme_id is None:
-                        key = '%d' % level_id
-                    else:
-                        key = '%d_%d' % (level_id, theme_id)
-                    self._add_bytesio(f, 'global_restrictions_%s' % key,
-                                      BytesIO(struct.pack('<B'+('I'*len(level_data.global_restrictions)),
-                                                          len(level_data.global_restrictions),
-                                                          *level_data.global_restrictions)))
-                    self._add_geometryindexed(f, 'history_%s' % key, level_data.history)
-                    self._add_geometryindexed(f, 'restrictions_%s' % key, level_data.restrictions)
+                for name, data in files.items():
+                    tarinfo = TarInfo(name=name)
+                    tarinfo.size = len(data)
+                    f.addfile(tarinfo, BytesIO(data))
         finally:
             if fileobj is not None:
                 fileobj.close()
 
-    def _add_bytesio(self, f: TarFile, filename: str, data: BytesIO):
-        data.seek(0, os.SEEK_END)
-        tarinfo = TarInfo(name=filename)
-        tarinfo.size = data.tell()
-        data.seek(0)
-        f.addfile(tarinfo, data)
-
-    def _add_geometryindexed(self, f: TarFile, filename: str, obj: GeometryIndexed):
-        data = BytesIO()
-        obj.write(data)
-        self._add_bytesio(f, filename, data)
+    def save(self, update_cache_key, filename=None, compression=None):
+        if filename is None:
+            filename = self.get_filename(update_cache_key, compression=compression)
+        self._write_files(filename, self._get_files(), compression=compression)
 
     def save_all(self, update_cache_key, filename=None):
         for compression in (None, 'gz', 'xz', 'zst'):
             self.save(update_cache_key, filename, compression)
+        if filename is None:
+            self.save_mmap(self.get_mmap_filename(update_cache_key))
+
+    @staticmethod
+    def get_mmap_filename(update_cache_key):
+        from django.conf import settings
+        return settings.CACHE_ROOT / update_cache_key / 'package.mmap'
+
+    def save_mmap(self, filename):
+        """
+        Save the package in the uncompressed layout for open_mmap.
+        The file is written under a temporary name and then atomically replaces the given file.
+        """
+        filename = Path(filename)
+        tmp_filename = filename.parent / (filename.name + '.%d.tmp' % os.getpid())
+
+        def add_raster(f, obj: GeometryIndexed):
+            header_offset = f.tell()
+            obj.write_header(f)
+            f.write(bytes(-f.tell() % MMAP_ALIGNMENT))
+            data_offset = f.tell()
+            f.write(obj.data.tobytes('C'))
+            return header_offset, data_offset
+
+        with open(tmp_filename, 'wb') as f:
+            f.write(MMAP_MAGIC_NUMBER)
+            levels = []
+            for (level_id, theme_id), level_data in self.levels.items():
+                levels.append({
+                    'level': level_id,
+                    'theme': theme_id,
+                    'global_restrictions': sorted(level_data.global_restrictions),
+                    'history': add_raster(f, level_data.history),
+                    'restrictions': add_raster(f, level_data.restrictions),
+                })
+            index_offset = f.tell()
+            f.write(json.dumps({'bounds': self.bounds, 'metadata': self.metadata, 'levels': levels}).encode())
+            f.write(struct.pack('<Q', index_offset))
+        os.replace(tmp_filename, filename)
 
     @classmethod
-    def read(cls, f: BinaryIO) -> Self:
-        # test if it's a zstd compressed archive
-        # read magic bytes
-        magic_number = f.read(4)
-        f.seek(0)
-        if magic_number == ZSTD_MAGIC_NUMBER:
-            # Seams to be a zstd file. To make sure we try to read the first 512 bytes.
-            _f = f
-            try:
-                f = ZstdFile(f, 'rb')
-                f.read(512)  # tar block size
-                f.seek(0)
-            except ZstdError:
-                # Not a zst file or a broken file. Let's give Tarfile a try with the original file
-                f = _f
+    def open_mmap(cls, filename) -> Self:
+        """
+        Open a package saved with save_mmap. The rasters are read-only views into the memory-mapped file,
+        so all processes that open the same file share one copy of them and opening it takes almost no time.
+        """
+        with open(filename, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(MMAP_MAGIC_NUMBER)] != MMAP_MAGIC_NUMBER:
+            raise ValueError('Not a memory-mappable cache package.')
+        index_offset = struct.unpack('<Q', buffer[-8:])[0]
+        index = json.loads(buffer[index_offset:-8])
 
-        f = TarFile.open(fileobj=f)
-        files = {info.name: info for info in f.getmembers()}
+        def read_raster(raster_cls, offsets):
+            header_offset, data_offset = offsets
+            return raster_cls.read(BytesIO(buffer[header_offset:data_offset]), buffer=buffer, offset=data_offset)
+
+        levels = {}
+        for level in index['levels']:
+            levels[(level['level'], level['theme'])] = CachePackageLevel(
+                history=read_raster(MapHistory, level['history']),
+                restrictions=read_raster(AccessRestrictionAffected, level['restrictions']),
+                global_restrictions=frozenset(level['global_restrictions']),
+            )
+        package = cls(tuple(index['bounds']), levels)
+        package.metadata = index.get('metadata', {})
+        return package
+
+    def save_delta(self, update_cache_key, base_update_cache_key, filename=None):
+        """
+        Save a delta package that turns the package of the given base update into this one.
+        It only contains the levels that changed, so tileservers don't have to download everything.
+        Raises FileNotFoundError if the base package doesn't exist (anymore).
+        """
+        if filename is None:
+            filename = self.get_delta_filename(update_cache_key, base_update_cache_key)
+
+        with self.get_filename(base_update_cache_key).open('rb') as f:
+            base_files = self._read_files(f)
+        base_levels = {name[8:] for name in base_files if name.startswith('history_')}
+
+        files = self._get_files()
+        levels = {name[8:] for name in files if name.startswith('history_')}
+        for key in levels & base_levels:
+            names = ('global_restrictions_%s' % key, 'history_%s' % key, 'restrictions_%s' % key)
+            if all(files[name] == base_files[name] for name in names):
+                for name in names:
+                    files.pop(name)
+        files['delta_base'] = base_update_cache_key.encode()
+        files['removed_levels'] = '\n'.join(sorted(base_levels - levels)).encode()
+
+        # write to a temporary file first, since deltas might also be created on demand by multiple processes
+        tmp_filename = filename.parent / (filename.name + '.%d.tmp' % os.getpid())
+        self._write_files(tmp_filename, files, compression='zst')
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def _iter_files(f: BinaryIO, stream=False) -> Iterator[tuple[str, BinaryIO]]:
+        """
+        Yield the name and a file object of every file in the archive, in archive order.
+        In stream mode, each file object can only be read until the next file is yielded.
+        """
+        if stream:
+            # a non-seekable zstd compressed stream, decompress it while reading it
+            f = TarFile.open(fileobj=ZstdFile(f, 'rb'), mode='r|')
+        else:
+            # test if it's a zstd compressed archive
+            # read magic bytes
+            magic_number = f.read(4)
+            f.seek(0)
+            if magic_number == ZSTD_MAGIC_NUMBER:
+                # Seams to be a zstd file. To make sure we try to read the first 512 bytes.
+                _f = f
+                try:
+                    f = ZstdFile(f, 'rb')
+                    f.read(512)  # tar block size
+                    f.seek(0)
+                except ZstdError:
+                    # Not a zst file or a broken file. Let's give Tarfile a try with the original file
+                    f = _f
 
-        bounds = tuple(i/100 for i in struct.unpack('<iiii', f.extractfile(files['bounds']).read()))
+            f = TarFile.open(fileobj=f)
+
+        for info in f:
+            if info.isfile():
+                yield info.name, f.extractfile(info)
+
+    @classmethod
+    def _read_files(cls, f: BinaryIO, stream=False) -> dict[str, bytes]:
+        return {name: fileobj.read() for name, fileobj in cls._iter_files(f, stream=stream)}
+
+    @classmethod
+    def read(cls, f: BinaryIO, stream=False) -> Self:
+        """
+        Read a cache package or a delta package. Use stream to read a zstd compressed package from a non-seekable
+        file-like object (like a HTTP response) without buffering all of it.
+        Every file is parsed as soon as it is read, so only one of them is held in memory in its raw form.
+        """
+        bounds = None
+        delta_base = None
+        removed_levels = None
+        levels_data: dict[str, dict] = {}
+        for name, fileobj in cls._iter_files(f, stream=stream):
+            if name == 'bounds':
+                bounds = tuple(i/100 for i in struct.unpack('<iiii', fileobj.read()))
+            elif name == 'delta_base':
+                delta_base = fileobj.read().decode()
+            elif name == 'removed_levels':
+                removed_levels = fileobj.read().decode()
+            elif name.startswith('global_restrictions_'):
+                global_restrictions_data = fileobj.read()
+                levels_data.setdefault(name[20:], {})['global_restrictions'] = frozenset(
+                    struct.unpack('<'+('I'*global_restrictions_data[0]), global_restrictions_data[1:])
+                )
+            elif name.startswith('history_'):
+                levels_data.setdefault(name[8:], {})['history'] = MapHistory.read(fileobj)
+            elif name.startswith('restrictions_'):
+                levels_data.setdefault(name[13:], {})['restrictions'] = AccessRestrictionAffected.read(fileobj)
 
         levels = {}
-        for filename in files:
-            if not filename.startswith('history_'):
-                continue
-            key = filename[8:]
+        for key, level_data in levels_data.items():
             if '_' in key:
                 [level_id, theme_id] = [int(x) for x in key.split('_', 1)]
             else:
                 level_id = int(key)
                 theme_id = None
-            global_restrictions_data = f.extractfile(files['global_restrictions_%s' % key]).read()
-            levels[(level_id, theme_id)] = CachePackageLevel(
-                history=MapHistory.read(f.extractfile(files['history_%s' % key])),
-                restrictions=AccessRestrictionAffected.read(f.extractfile(files['restrictions_%s' % key])),
-                global_restrictions=frozenset(
-                    struct.unpack('<'+('I'*global_restrictions_data[0]), global_restrictions_data[1:])
-                )
-            )
+            levels[(level_id, theme_id)] = CachePackageLevel(**level_data)
+
+        package = cls(bounds, levels)
+        if delta_base is not None:
+            package.delta_base = delta_base
+            package.removed_levels = set()
+            for key in removed_levels.split():
+                level_id, *theme_id = (int(x) for x in key.split('_', 1))
+                package.removed_levels.add((level_id, theme_id[0] if theme_id else None))
+        return package
 
-        return cls(bounds, levels)
+    def apply_delta(self, delta: Self) -> Self:
+        """
+        Returns a new package with the given delta package applied. Levels are shared with this package.
+        """
+        if delta.delta_base is None:
+            raise ValueError('Not a delta package.')
+        levels = {key: level_data for key, level_data in self.levels.items() if key not in delta.removed_levels}
+        levels.update(delta.levels)
+        return type(self)(delta.bounds, levels)
 
     @classmethod
     def open(cls, update_cache_key=None, package: Optional[str | os.PathLike] = None) -> Self:
         if package is None:
             if update_cache_key is None:
                 raise ValueError
+            try:
+                return cls.open_mmap(cls.get_mmap_filename(update_cache_key))
+            except FileNotFoundError:
+                pass
             package = cls.get_filename(update_cache_key)
         elif not hasattr(package, 'open'):
             package = Path(package)
@@ -1,5 +1,7 @@
+from collections import Counter
 from operator import itemgetter
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
 from django.utils import timezone
@@ -20,6 +22,24 @@ def increment_cache_key(cache_key):
         cache.set(cache_key, 1, None)
 
 
+def increment_cache_keys(cache_keys):
+    """ increment every distinct cache key by the number of times it was given, in one round trip on redis """
+    counts = Counter(cache_keys)
+    if settings.CACHES['default']['BACKEND'] == 'django.core.cache.backends.redis.RedisCache':
+        # incrby creates missing keys, so there is no need to set them first
+        pipeline = cache._cache.get_client(write=True).pipeline(transaction=False)
+        for cache_key, count in counts.items():
+            pipeline.incrby(cache.make_key(cache_key), count)
+        pipeline.execute()
+        return
+
+    for cache_key, count in counts.items():
+        try:
+            cache.incr(cache_key, count)
+        except ValueError:
+            cache.set(cache_key, count, None)
+
+
 def stats_snapshot(reset=True):
     last_now = cache.get('apistats_last_reset', '', None)
     now = timezone.now()
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, Optional
+
+
+class TileStore:
+    """
+    Stores rendered tiles in a single SQLite database instead of one directory per tile.
+    Tiles are keyed by (level, zoom, x, y, access_cache_key, theme_key) and remember the base cache key they were
+    rendered for, so outdated tiles are simply overwritten instead of having to be deleted.
+    Tile images are stored by their content hash, so identical tiles (like empty background tiles) are stored once.
+    Images that are no longer used by any tile are deleted when their last tile is overwritten.
+    Usable from multiple threads and processes.
+    """
+    def __init__(self, filename: str | os.PathLike):
+        self.filename = Path(filename)
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # connections can't be shared between threads or forked processes
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(self.filename.parent, exist_ok=True)
+            connection = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS tile_data ('
+                               'hash BLOB PRIMARY KEY, data BLOB NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                               'level INTEGER, zoom INTEGER, x INTEGER, y INTEGER, '
+                               'access_cache_key TEXT, theme_key TEXT, base_cache_key TEXT NOT NULL, '
+                               'hash BLOB NOT NULL, '
+                               'PRIMARY KEY (level, zoom, x, y, access_cache_key, theme_key)) WITHOUT ROWID')
+            # to find out whether an image is still used when a tile is replaced
+            connection.execute('CREATE INDEX IF NOT EXISTS tiles_hash ON tiles (hash)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, level, zoom, x, y, theme_key, base_cache_key, access_cache_key) -> Optional[bytes]:
+        row = self.connection.execute(
+            'SELECT tiles.base_cache_key, tile_data.data FROM tiles JOIN tile_data ON tiles.hash = tile_data.hash '
+            'WHERE level=? AND zoom=? AND x=? AND y=? AND access_cache_key=? AND theme_key=?',
+            (level, zoom, x, y, access_cache_key, theme_key)
+        ).fetchone()
+        if row is None or row[0] != base_cache_key:
+            return None
+        return row[1]
+
+    def contains(self, level, zoom, x, y, theme_key, base_cache_key, access_cache_key) -> bool:
+        return self.connection.execute(
+            'SELECT 1 FROM tiles WHERE level=? AND zoom=? AND x=? AND y=? AND access_cache_key=? AND theme_key=? '
+            'AND base_cache_key=?',
+            (level, zoom, x, y, access_cache_key, theme_key, base_cache_key)
+        ).fetchone() is not None
+
+    def put(self, level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data: bytes):
+        self.put_many(((level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data), ))
+
+    def put_many(self, tiles: Iterable[tuple[int, int, int, int, str, str, str, bytes]]):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data in tiles:
+                data_hash = hashlib.blake2b(data, digest_size=16).digest()
+                old_row = connection.execute(
+                    'SELECT hash FROM tiles WHERE level=? AND zoom=? AND x=? AND y=? AND access_cache_key=? '
+                    'AND theme_key=?',
+                    (level, zoom, x, y, access_cache_key, theme_key)
+                ).fetchone()
+                connection.execute('INSERT OR IGNORE INTO tile_data (hash, data) VALUES (?, ?)', (data_hash, data))
+                connection.execute(
+                    'INSERT OR REPLACE INTO tiles '
+                    '(level, zoom, x, y, access_cache_key, theme_key, base_cache_key, hash) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (level, zoom, x, y, access_cache_key, theme_key, base_cache_key, data_hash)
+                )
+                if old_row is not None and old_row[0] != data_hash:
+                    connection.execute('DELETE FROM tile_data WHERE hash=? AND NOT EXISTS '
+                                       '(SELECT 1 FROM tiles WHERE tiles.hash=tile_data.hash)', old_row)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def clean(self) -> int:
+        """
+        Delete tile images that are no longer referenced by any tile. Returns the number of deleted images.
+        Only needed for tile stores written before unused images were deleted on write.
+        """
+        return self.connection.execute(
+            'DELETE FROM tile_data WHERE hash NOT IN (SELECT hash FROM tiles)'
+        ).rowcount
+
+    def stats(self) -> tuple[int, int]:
+        """
+        Returns the number of tiles and the number of distinct tile images.
+        """
+        return (self.connection.execute('SELECT COUNT(*) FROM tiles').fetchone()[0],
+                self.connection.execute('SELECT COUNT(*) FROM tile_data').fetchone()[0])
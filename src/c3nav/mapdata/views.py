@@ -1,6 +1,9 @@
 import base64
+import fcntl
 import os
+import re
 from collections import Counter
+from io import BytesIO
 from shutil import rmtree
 from typing import Optional
 from wsgiref.util import FileWrapper
@@ -12,15 +15,17 @@ from django.http import Http404, HttpResponse, HttpResponseNotModified, Streamin
 from django.shortcuts import get_object_or_404
 from django.utils.http import content_disposition_header
 from django.views.decorators.http import etag
+from PIL import Image
 from shapely import LineString, Point, box, unary_union
 
 from c3nav.mapdata.middleware import no_language
 from c3nav.mapdata.models import Level, MapUpdate
 from c3nav.mapdata.models.access import AccessPermission
-from c3nav.mapdata.render.engines import ImageRenderEngine
+from c3nav.mapdata.render.engines import ImageRenderEngine, VectorTileEngine
 from c3nav.mapdata.render.engines.base import FillAttribs, StrokeAttribs
+from c3nav.mapdata.render.prerender import count_tile_access
 from c3nav.mapdata.render.renderer import MapRenderer
-from c3nav.mapdata.utils.cache import CachePackage, MapHistory
+from c3nav.mapdata.utils.cache import CachePackage, MapHistory, TileStore
 from c3nav.mapdata.utils.locations import visible_locations_for_request
 from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, build_tile_access_cookie,
                                        build_tile_etag, get_tile_bounds, parse_tile_access_cookie)
@@ -31,6 +36,8 @@ PREVIEW_IMG_WIDTH = 1200
 PREVIEW_IMG_HEIGHT = 628
 PREVIEW_MIN_Y = 100
 
+tile_store = TileStore(settings.TILE_STORE_FILE) if settings.TILE_STORE == 'sqlite' else None
+
 
 def set_tile_access_cookie(request, response):
     access_permissions = AccessPermission.get_for_request(request)
@@ -330,9 +337,193 @@ def preview_route(request, slug, slug2):
                          render_preview)
 
 
+def get_tile_directory(level, zoom, x, y, access_cache_key):
+    return settings.TILES_ROOT / str(level) / str(zoom) / str(x) / str(y) / access_cache_key
+
+
+def get_tile_store_theme_key(theme_key, filetype):
+    # png tiles were stored before other tile types existed
+    return theme_key if filetype == 'png' else f'{theme_key}.{filetype}'
+
+
+def get_tile_last_update_filename(filetype):
+    # every tile type has its own last update, since their base cache keys can differ
+    return 'last_update' if filetype == 'png' else f'last_update.{filetype}'
+
+
+def get_tile_cache_update_key(level, zoom, x, y, filetype):
+    cache_key = 'mapdata:tile-cache-update:%d-%d-%d-%d' % (level, zoom, x, y)
+    return cache_key if filetype == 'png' else f'{cache_key}:{filetype}'
+
+
+def get_cached_tile(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, use_cache=True, filetype='png'):
+    if tile_store is not None:
+        return tile_store.get(level, zoom, x, y, get_tile_store_theme_key(theme_key, filetype),
+                              base_cache_key, access_cache_key)
+
+    tile_directory = get_tile_directory(level, zoom, x, y, access_cache_key)
+    last_update_file = tile_directory / get_tile_last_update_filename(filetype)
+
+    # get tile cache last update
+    tile_cache_update = None
+    if use_cache:
+        tile_cache_update = cache.get(get_tile_cache_update_key(level, zoom, x, y, filetype), None)
+    if tile_cache_update is None:
+        try:
+            tile_cache_update = last_update_file.read_text()
+        except FileNotFoundError:
+            pass
+
+    if tile_cache_update != base_cache_key:
+        if filetype == 'png':
+            try:
+                old_tile_directory = tile_directory.rename(tile_directory.parent /
+                                                           (tile_directory.name + '_old_tile_dir'))
+                rmtree(old_tile_directory)
+            except FileNotFoundError:
+                pass
+        else:
+            # only remove tiles of this type, the png tiles in this directory might still be up to date
+            for old_file in (last_update_file, *tile_directory.glob(f'*.{filetype}')):
+                old_file.unlink(missing_ok=True)
+        return None
+
+    try:
+        return (tile_directory / f'{theme_key}.{filetype}').read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def is_tile_cached(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, filetype='png'):
+    # like get_cached_tile, but without reading the tile or removing outdated tiles
+    if tile_store is not None:
+        return tile_store.contains(level, zoom, x, y, get_tile_store_theme_key(theme_key, filetype),
+                                   base_cache_key, access_cache_key)
+
+    tile_directory = get_tile_directory(level, zoom, x, y, access_cache_key)
+    try:
+        tile_cache_update = (tile_directory / get_tile_last_update_filename(filetype)).read_text()
+    except FileNotFoundError:
+        return False
+    return tile_cache_update == base_cache_key and (tile_directory / f'{theme_key}.{filetype}').exists()
+
+
+def write_cached_tile(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data, filetype='png'):
+    if tile_store is not None:
+        tile_store.put(level, zoom, x, y, get_tile_store_theme_key(theme_key, filetype),
+                       base_cache_key, access_cache_key, data)
+        return
+
+    tile_directory = get_tile_directory(level, zoom, x, y, access_cache_key)
+    os.makedirs(tile_directory, exist_ok=True)
+    (tile_directory / f'{theme_key}.{filetype}').write_bytes(data)
+    (tile_directory / get_tile_last_update_filename(filetype)).write_text(base_cache_key)
+    cache.set(get_tile_cache_update_key(level, zoom, x, y, filetype), base_cache_key, 60)
+
+
+def render_metatile(cache_package, level_data, level, zoom, x, y, theme, requested_access_permissions,
+                    base_cache_key, access_cache_key, access_permissions_from_url=False):
+    """
+    Render the metatile (a block of TILE_METATILE_SIZE×TILE_METATILE_SIZE tiles) containing the given tile once,
+    slice it into tiles and put all of them into the tile cache. Returns the given tile.
+    Concurrent requests for the same metatile wait for the running render instead of starting their own.
+    If the access permissions came from the url, they were already reduced to the restrictions affecting the given
+    tile, so other tiles are only cached if the restrictions affecting them are a subset of those.
+    """
+    theme_key = str(theme)
+    size = settings.TILE_METATILE_SIZE
+    meta_x, meta_y = x - x % size, y - y % size
+
+    lock_directory = settings.TILES_ROOT / str(level) / str(zoom)
+    os.makedirs(lock_directory, exist_ok=True)
+    with open(lock_directory / ('metatile_%d_%d.lock' % (meta_x, meta_y)), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        # maybe the metatile was rendered while we were waiting
+        data = get_cached_tile(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, use_cache=False)
+        if data is not None:
+            return data
+
+        minx, miny, maxx, maxy = get_tile_bounds(zoom, meta_x, meta_y + size - 1)
+        maxx, maxy = get_tile_bounds(zoom, meta_x + size - 1, meta_y)[2:]
+        access_permissions = requested_access_permissions & (
+            set(level_data.restrictions[minx:maxx, miny:maxy]) | level_data.global_restrictions
+        )
+
+        renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
+        image = Image.open(BytesIO(renderer.render(ImageRenderEngine, theme=theme).render()))
+
+        requested_minx, requested_miny, requested_maxx, requested_maxy = get_tile_bounds(zoom, x, y)
+        requested_tile_restrictions = (
+            set(level_data.restrictions[requested_minx:requested_maxx, requested_miny:requested_maxy]) |
+            level_data.global_restrictions
+        )
+
+        for tile_x in range(meta_x, meta_x + size):
+            for tile_y in range(meta_y, meta_y + size):
+                tile_minx, tile_miny, tile_maxx, tile_maxy = get_tile_bounds(zoom, tile_x, tile_y)
+                if not cache_package.bounds_valid(tile_minx, tile_miny, tile_maxx, tile_maxy):
+                    continue
+
+                is_requested_tile = (tile_x == x and tile_y == y)
+                if not is_requested_tile:
+                    tile_restrictions = (set(level_data.restrictions[tile_minx:tile_maxx, tile_miny:tile_maxy]) |
+                                         level_data.global_restrictions)
+                    if access_permissions_from_url and not tile_restrictions <= requested_tile_restrictions:
+                        # we don't know which of the other restrictions will be in the url when this tile is
+                        # requested, so we don't know its access cache key
+                        continue
+
+                # tiles overlap by one pixel
+                left, top = (tile_x - meta_x) * 256, (tile_y - meta_y) * 256
+                f = BytesIO()
+                image.crop((left, top, left + 257, top + 257)).save(f, 'PNG')
+                tile_data = f.getvalue()
+
+                if is_requested_tile:
+                    data = tile_data
+                    tile_access_cache_key = access_cache_key
+                else:
+                    # restrictions that don't affect a tile don't change how it looks
+                    tile_access_cache_key = build_access_cache_key(requested_access_permissions & tile_restrictions)
+                tile_base_cache_key = build_base_cache_key(
+                    level_data.history.last_update(tile_minx, tile_miny, tile_maxx, tile_maxy)
+                )
+                write_cached_tile(level, zoom, tile_x, tile_y, theme_key, tile_base_cache_key,
+                                  tile_access_cache_key, tile_data)
+
+    return data
+
+
+def get_tile_access_permissions(request, level_data, minx, miny, maxx, maxy, access_permissions: Optional[set]):
+    """
+    Decode the access permissions of a tile request, from the tile access cookie or from the url.
+    Returns the access permissions that affect this tile and all requested access permissions.
+    """
+    if access_permissions is None:
+        try:
+            cookie = request.COOKIES[settings.TILE_ACCESS_COOKIE_NAME]
+        except KeyError:
+            access_permissions = set()
+            requested_access_permissions = set()
+        else:
+            access_permissions = parse_tile_access_cookie(cookie, settings.SECRET_TILE_KEY)
+            requested_access_permissions = set(access_permissions)
+            access_permissions &= set(level_data.restrictions[minx:maxx, miny:maxy]) | level_data.global_restrictions
+    else:
+        access_permissions = access_permissions - {0}
+        requested_access_permissions = access_permissions
+
+    if not all((r in access_permissions) for r in level_data.global_restrictions):
+        raise Http404
+
+    return access_permissions, requested_access_permissions
+
+
 @no_language()
 def tile(request, level, zoom, x, y, theme, access_permissions: Optional[set] = None):
-    if access_permissions is not None:
+    access_permissions_from_url = access_permissions is not None
+    if access_permissions_from_url:
         enforce_tile_secret_auth(request)
     elif settings.TILE_CACHE_SERVER:
         return HttpResponse('use %s instead of /map/' % settings.TILE_CACHE_SERVER,
@@ -362,20 +553,9 @@ def tile(request, level, zoom, x, y, theme, access_permissions: Optional[set] =
     if level_data is None:
         raise Http404
 
-    # decode access permissions
-    if access_permissions is None:
-        try:
-            cookie = request.COOKIES[settings.TILE_ACCESS_COOKIE_NAME]
-        except KeyError:
-            access_permissions = set()
-        else:
-            access_permissions = parse_tile_access_cookie(cookie, settings.SECRET_TILE_KEY)
-            access_permissions &= set(level_data.restrictions[minx:maxx, miny:maxy]) | level_data.global_restrictions
-    else:
-        access_permissions = access_permissions - {0}
-
-    if not all((r in access_permissions) for r in level_data.global_restrictions):
-        raise Http404
+    access_permissions, requested_access_permissions = get_tile_access_permissions(
+        request, level_data, minx, miny, maxx, maxy, access_permissions
+    )
 
     # build cache keys
     last_update = level_data.history.last_update(minx, miny, maxx, maxy)
@@ -386,50 +566,31 @@ def tile(request, level, zoom, x, y, theme, access_permissions: Optional[set] =
     tile_etag = build_tile_etag(level, zoom, x, y, theme_key, base_cache_key, access_cache_key,
                                 settings.SECRET_TILE_KEY)
     if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if settings.TILE_ACCESS_STATS:
+        count_tile_access(level, zoom, x, y)
+
     if if_none_match == tile_etag:
         return HttpResponseNotModified()
 
     data = None
-    tile_directory, last_update_file, tile_file, tile_cache_update_cache_key = '', '', '', ''
 
     # get tile cache last update
     if settings.CACHE_TILES:
-        tile_directory = settings.TILES_ROOT / str(level) / str(zoom) / str(x) / str(y) / access_cache_key
-        last_update_file = tile_directory / 'last_update'
-        tile_file = tile_directory / f'{theme_key}.png'
-
-        # get tile cache last update
-        tile_cache_update_cache_key = 'mapdata:tile-cache-update:%d-%d-%d-%d' % (level, zoom, x, y)
-        tile_cache_update = cache.get(tile_cache_update_cache_key, None)
-        if tile_cache_update is None:
-            try:
-                tile_cache_update = last_update_file.read_text()
-            except FileNotFoundError:
-                pass
-
-        if tile_cache_update != base_cache_key:
-            try:
-                old_tile_directory = tile_directory.rename(tile_directory.parent /
-                                                           (tile_directory.name + '_old_tile_dir'))
-                rmtree(old_tile_directory)
-            except FileNotFoundError:
-                pass
-        else:
-            try:
-                data = tile_file.read_bytes()
-            except FileNotFoundError:
-                pass
+        data = get_cached_tile(level, zoom, x, y, theme_key, base_cache_key, access_cache_key)
 
     if data is None:
-        renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
-        image = renderer.render(ImageRenderEngine, theme=theme)
-        data = image.render()
+        if settings.CACHE_TILES and settings.TILE_METATILE_SIZE > 1:
+            data = render_metatile(cache_package, level_data, level, zoom, x, y, theme,
+                                   requested_access_permissions, base_cache_key, access_cache_key,
+                                   access_permissions_from_url=access_permissions_from_url)
+        else:
+            renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom,
+                                   access_permissions=access_permissions)
+            image = renderer.render(ImageRenderEngine, theme=theme)
+            data = image.render()
 
-        if settings.CACHE_TILES:
-            os.makedirs(tile_directory, exist_ok=True)
-            tile_file.write_bytes(data)
-            last_update_file.write_text(base_cache_key)
-            cache.set(tile_cache_update_cache_key, base_cache_key, 60)
+            if settings.CACHE_TILES:
+                write_cached_tile(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data)
 
     response = HttpResponse(data, 'image/png')
     response['ETag'] = tile_etag
@@ -441,6 +602,64 @@ def tile(request, level, zoom, x, y, theme, access_permissions: Optional[set] =
     return response
 
 
+@no_language()
+def vector_tile(request, level, zoom, x, y, theme, access_permissions: Optional[set] = None):
+    if access_permissions is not None:
+        enforce_tile_secret_auth(request)
+
+    zoom = int(zoom)
+    if not (-2 <= zoom <= 5):
+        raise Http404
+
+    cache_package = CachePackage.open_cached()
+
+    # vector tiles don't need to overlap
+    x = int(x)
+    y = int(y)
+    minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+    pixel_size = (maxx - minx) / 257
+    maxx -= pixel_size
+    miny += pixel_size
+    if not cache_package.bounds_valid(minx, miny, maxx, maxy):
+        raise Http404
+
+    theme = None if theme == 0 else int(theme)
+    theme_key = str(theme)
+
+    level = int(level)
+    level_data = cache_package.levels.get((level, theme))
+    if level_data is None:
+        raise Http404
+
+    access_permissions, requested_access_permissions = get_tile_access_permissions(
+        request, level_data, minx, miny, maxx, maxy, access_permissions
+    )
+
+    base_cache_key = build_base_cache_key(level_data.history.last_update(minx, miny, maxx, maxy))
+    access_cache_key = build_access_cache_key(access_permissions)
+
+    tile_etag = build_tile_etag(level, zoom, x, y, theme_key + '.mvt', base_cache_key, access_cache_key,
+                                settings.SECRET_TILE_KEY)
+    if request.META.get('HTTP_IF_NONE_MATCH') == tile_etag:
+        return HttpResponseNotModified()
+
+    data = None
+    if settings.CACHE_TILES:
+        data = get_cached_tile(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, filetype='mvt')
+
+    if data is None:
+        renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
+        data = renderer.render(VectorTileEngine, theme=theme).render()
+        if settings.CACHE_TILES:
+            write_cached_tile(level, zoom, x, y, theme_key, base_cache_key, access_cache_key, data, filetype='mvt')
+
+    response = HttpResponse(data, 'application/vnd.mapbox-vector-tile')
+    response['ETag'] = tile_etag
+    response['Cache-Control'] = 'no-cache'
+    response['Vary'] = 'Cookie'
+    return response
+
+
 @etag(lambda *args, **kwargs: MapUpdate.current_processed_cache_key())
 @no_language()
 def map_history(request, level, mode, filetype):
@@ -492,6 +711,47 @@ def get_cache_package(request, filetype):
     return response
 
 
+@etag(lambda *args, **kwargs: MapUpdate.current_processed_geometry_cache_key())
+@no_language()
+def get_cache_package_delta(request):
+    """
+    Serve a delta package relative to the package the client has (given by If-None-Match), if possible.
+    Otherwise, the full zstd compressed package is served. Delta packages have an X-Cache-Package-Delta-Base header.
+    """
+    processed_geometry_update = str(MapUpdate.last_processed_geometry_update()[0])
+
+    enforce_tile_secret_auth(request)
+
+    update_cache_key = MapUpdate.current_processed_geometry_cache_key()
+    base_update_cache_key = request.headers.get('If-None-Match', '').removeprefix('W/').strip('"')
+
+    delta_filename = None
+    if re.fullmatch(r'[0-9a-z]+_[0-9a-z]+', base_update_cache_key):
+        delta_filename = CachePackage.get_delta_filename(update_cache_key, base_update_cache_key)
+        if not delta_filename.exists():
+            # deltas to the previous package are created during map update processing, others on demand
+            try:
+                CachePackage.open_cached().save_delta(update_cache_key, base_update_cache_key)
+            except FileNotFoundError:
+                delta_filename = None
+
+    filename = delta_filename or CachePackage.get_filename(update_cache_key, 'zst')
+    try:
+        size = filename.stat().st_size
+        f = filename.open('rb')
+    except FileNotFoundError:
+        raise Http404
+
+    response = StreamingHttpResponse(FileWrapper(f), content_type='application/zstd')
+    response.file_to_stream = f
+    response.block_size = 8192
+    response['Content-Length'] = size
+    response['X-Processed-Geometry-Update'] = processed_geometry_update
+    if delta_filename is not None:
+        response['X-Cache-Package-Delta-Base'] = base_update_cache_key
+    return response
+
+
 def prometheus_exporter(request):
     """Exports the API metrics for Prometheus"""
 
@@ -1,4 +1,4 @@
-from typing import Annotated, Union
+from typing import Annotated, Sequence, Union
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
@@ -6,12 +6,13 @@ from ninja import Field as APIField
 from ninja import Router as APIRouter
 from pydantic_extra_types.mac_address import MacAddress
 
-from c3nav.api.auth import auth_responses
+from c3nav.api.auth import auth_responses, validate_responses
+from c3nav.api.exceptions import APIRequestValidationFailed
 from c3nav.api.schema import BaseSchema
 from c3nav.mapdata.models.access import AccessPermission
 from c3nav.mapdata.schemas.models import CustomLocationSchema
 from c3nav.mapdata.tasks import update_ap_names_bssid_mapping
-from c3nav.mapdata.utils.cache.stats import increment_cache_key
+from c3nav.mapdata.utils.cache.stats import increment_cache_key, increment_cache_keys
 from c3nav.routing.locator import Locator
 from c3nav.routing.schemas import LocateWifiPeerSchema, LocateIBeaconPeerSchema
 
@@ -51,26 +52,55 @@ def get_position(request, parameters: LocateRequestSchema):
         # todo: validation error, seriously? this shouldn't happen anyways
         raise
 
-    if request.user_permissions.passive_ap_name_scanning:
-        bssid_mapping = {}
-        for peer in parameters.wifi_peers:
-            if not peer.ap_name:
-                continue
-            bssid_mapping.setdefault(peer.ap_name, set()).add(peer.bssid)
-        if bssid_mapping:
-            update_ap_names_bssid_mapping.delay(
-                map_name={str(name): [str(b) for b in bssids] for name, bssids in bssid_mapping.items()},
-                user_id=request.user.pk
-            )
+    _update_ap_names(request, (parameters.wifi_peers, ))
 
     return {
         "location": location
     }
 
 
+@positioning_api_router.post('/locate-batch/', summary="determine multiple positions",
+                             description="determine positions for multiple sets of wireless measurements at once, "
+                                         "for example from different devices. results are in the same order.",
+                             response={200: list[PositioningResult], **validate_responses, **auth_responses})
+def get_positions(request, parameters: list[LocateRequestSchema]):
+    if len(parameters) > settings.POSITIONING_BATCH_MAX_SCANS:
+        raise APIRequestValidationFailed('Too many scans, the maximum is %d.' % settings.POSITIONING_BATCH_MAX_SCANS)
+
+    locations = Locator.load().locate_many(tuple(item.wifi_peers for item in parameters),
+                                           permissions=AccessPermission.get_for_request(request))
+    increment_cache_keys(['apistats__locate_batch'] + [
+        'apistats__locate__%s' % location.rounded_pk for location in locations if location is not None
+    ])
+
+    _update_ap_names(request, tuple(item.wifi_peers for item in parameters))
+
+    return [
+        {"location": location}
+        for location in locations
+    ]
+
+
+def _update_ap_names(request, wifi_peer_lists: Sequence[list[LocateWifiPeerSchema]]):
+    if not request.user_permissions.passive_ap_name_scanning:
+        return
+    bssid_mapping = {}
+    for wifi_peers in wifi_peer_lists:
+        for peer in wifi_peers:
+            if not peer.ap_name:
+                continue
+            bssid_mapping.setdefault(peer.ap_name, set()).add(peer.bssid)
+    if bssid_mapping:
+        update_ap_names_bssid_mapping.delay(
+            map_name={str(name): [str(b) for b in bssids] for name, bssids in bssid_mapping.items()},
+            user_id=request.user.pk
+        )
+
+
 if settings.METRICS:
     from c3nav.mapdata.metrics import APIStatsCollector
     APIStatsCollector.add_stat('locate', 'location')
+    APIStatsCollector.add_stat('locate_batch')
 
 
 @positioning_api_router.get('/locate-test/', summary="debug position",
@@ -1,10 +1,14 @@
+import hashlib
 from enum import StrEnum
 from typing import Annotated, Any, Optional, Union
 
+import numpy as np
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models import Model
 from django.urls import reverse
+from django.utils.translation import get_language
 from django.utils.translation import gettext_lazy as _
 from ninja import Field as APIField
 from ninja import Router as APIRouter
@@ -16,13 +20,14 @@ from c3nav.api.exceptions import APIRequestValidationFailed
 from c3nav.api.schema import BaseSchema
 from c3nav.api.utils import NonEmptyStr
 from c3nav.mapdata.api.base import api_stats_clean_location_value
+from c3nav.mapdata.models import MapUpdate
 from c3nav.mapdata.models.access import AccessPermission
 from c3nav.mapdata.models.locations import Position
 from c3nav.mapdata.schemas.model_base import AnyLocationID, Coordinates3D, TitledSchema, DjangoModelSchema
 from c3nav.mapdata.schemas.models import SlimLocationSchema, SpaceSchema, LevelSchema, SlimSpaceLocationSchema, \
     SlimLevelLocationSchema
 from c3nav.mapdata.utils.cache.stats import increment_cache_key
-from c3nav.mapdata.utils.locations import visible_locations_for_request
+from c3nav.mapdata.utils.locations import get_location_by_id_for_request, visible_locations_for_request
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
 from c3nav.routing.forms import RouteForm
 from c3nav.routing.models import RouteOptions
@@ -228,14 +233,39 @@ def get_route(request, parameters: RouteParametersSchema):
     if parameters.options_override is not None:
         _new_update_route_options(options, parameters.options_override)
 
-    visible_locations = visible_locations_for_request(request)
+    permissions = AccessPermission.get_for_request(request)
 
     try:
-        route = Router.load().get_route(origin=form.cleaned_data['origin'],
-                                        destination=form.cleaned_data['destination'],
-                                        permissions=AccessPermission.get_for_request(request),
-                                        options=options,
-                                        visible_locations=visible_locations)
+        router = Router.load()
+        locations = router.get_route_locations(origin=form.cleaned_data['origin'],
+                                               destination=form.cleaned_data['destination'],
+                                               permissions=permissions)
+
+        # visible locations and translated descriptions differ between requests with the same route
+        cache_key = None
+        route_cache_key = router.get_route_cache_key(locations, options) if settings.ROUTE_CACHE_TIMEOUT else None
+        if route_cache_key is not None:
+            # hashed, since the permissions can be any number of access restrictions
+            permissions_key = hashlib.blake2b(','.join(str(i) for i in sorted(permissions)).encode(),
+                                              digest_size=16).hexdigest()
+            cache_key = 'routing:route:%s:%s:%s:%s' % (
+                MapUpdate.current_processed_cache_key(), get_language(), permissions_key, route_cache_key,
+            )
+
+        result = cache.get(cache_key) if cache_key else None
+        if result is not None:
+            increment_cache_key('apistats__route_cache__hit')
+        else:
+            route = router.get_route(origin=form.cleaned_data['origin'],
+                                     destination=form.cleaned_data['destination'],
+                                     permissions=permissions,
+                                     options=options,
+                                     visible_locations=visible_locations_for_request(request),
+                                     locations=locations)
+            result = RouteSchema.model_validate(route).model_dump(mode='json')
+            if cache_key:
+                increment_cache_key('apistats__route_cache__miss')
+                cache.set(cache_key, result, settings.ROUTE_CACHE_TIMEOUT)
     except NotYetRoutable:
         return NoRouteResponse(
             request=parameters,
@@ -275,7 +305,67 @@ def get_route(request, parameters: RouteParametersSchema):
             'destination': parameters.destination,
             'options': options.serialize_string(),
         }),
-        result=route,
+        result=result,
+    )
+
+
+class RouteMatrixParametersSchema(BaseSchema):
+    origins: list[AnyLocationID] = APIField(min_length=1)
+    destinations: list[AnyLocationID] = APIField(min_length=1)
+    options_override: Optional[UpdateRouteOptionsSchema] = APIField(
+        None,
+        title="override routing options",
+    )
+
+
+class RouteMatrixResponse(BaseSchema):
+    request: RouteMatrixParametersSchema
+    options: RouteOptionsSchema
+    distances: list[list[Optional[float]]] = APIField(
+        title="distances",
+        description="distance in meters for every origin (rows) to every destination (columns), null if unreachable",
+    )
+    durations: list[list[Optional[int]]] = APIField(
+        title="durations",
+        description="duration in seconds for every origin (rows) to every destination (columns), null if unreachable",
+    )
+
+
+@routing_api_router.post('/matrix/', summary="query route matrix", auth=APIKeyAuth(is_readonly=True),
+                         description="query distances and durations between many origins and destinations at once",
+                         response={200: RouteMatrixResponse, **validate_responses, **auth_responses})
+def get_route_matrix(request, parameters: RouteMatrixParametersSchema):
+    if len(parameters.origins) * len(parameters.destinations) > settings.ROUTE_MATRIX_MAX_PAIRS:
+        raise APIRequestValidationFailed('Too many origin/destination pairs, the maximum is %d.' %
+                                         settings.ROUTE_MATRIX_MAX_PAIRS)
+
+    locations = {}
+    for location_id in set(parameters.origins) | set(parameters.destinations):
+        location = get_location_by_id_for_request(location_id, request)
+        if location is None:
+            raise APIRequestValidationFailed('Unknown location: %s' % location_id)
+        locations[location_id] = location
+
+    options = RouteOptions.get_for_request(request)
+    if parameters.options_override is not None:
+        _new_update_route_options(options, parameters.options_override)
+
+    matrix = Router.load().get_route_matrix(
+        origins=tuple(locations[location_id] for location_id in parameters.origins),
+        destinations=tuple(locations[location_id] for location_id in parameters.destinations),
+        permissions=AccessPermission.get_for_request(request),
+        options=options,
+    )
+
+    increment_cache_key('apistats__route_matrix')
+
+    return RouteMatrixResponse(
+        request=parameters,
+        options=_new_serialize_route_options(options),
+        distances=[[None if np.isnan(value) else round(value, 2) for value in row]
+                   for row in matrix.distances.tolist()],
+        durations=[[None if np.isnan(value) else round(value) for value in row]
+                   for row in matrix.durations.tolist()],
     )
 
 
@@ -285,6 +375,8 @@ if settings.METRICS:
     APIStatsCollector.add_stat('route_tuple', ['origin', 'destination'])
     APIStatsCollector.add_stat('route_origin', ['origin'])
     APIStatsCollector.add_stat('route_destination', ['destination'])
+    APIStatsCollector.add_stat('route_matrix')
+    APIStatsCollector.add_stat('route_cache', ['result'])
 
 
 def _new_serialize_route_options(options):
@@ -0,0 +1,191 @@
+import math
+import random
+import resource
+import time
+from decimal import Decimal
+
+import numpy as np
+from shapely import Polygon, box
+
+from c3nav.mapdata.models import Level, Space, WayType
+from c3nav.mapdata.utils.locations import CustomLocation
+from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
+from c3nav.routing.router import (Router, RouterAltitudeArea, RouterEdge, RouterLevel, RouterNode, RouterRestriction,
+                                  RouterSpace, RouterWayType)
+
+# side length of the square synthetic spaces, in meters
+SPACE_SIZE = 10
+LEVEL_HEIGHT = 5
+
+
+class SyntheticRouteOptions(dict):
+    """
+    Default route options for synthetic routers. RouteOptions can't be used, since it looks up waytypes in the
+    database. Supports everything the router needs from route options.
+    """
+    walk_factor = 1
+
+    def __init__(self, mode='fastest'):
+        super().__init__(mode=mode, walk_speed='default', restrictions='normal')
+
+    def serialize_string(self):
+        return ','.join('%s=%s' % item for item in self.items())
+
+
+def generate_router(levels=3, spaces=100, nodes=20, stairs=10, elevators=2, restrictions=5, seed=0) -> Router:
+    """
+    Generate a router for a synthetic venue without using the database.
+    Every level has the given number of square spaces in a grid, with the given number of nodes per space.
+    Neighboring spaces are connected by a door and the levels are connected by stairs and elevators at random
+    positions. Each restriction restricts one random space.
+    """
+    rng = random.Random(seed)
+    columns = math.ceil(math.sqrt(spaces))
+
+    waytypes = (
+        RouterWayType(None),
+        RouterWayType(WayType(pk=1, speed=Decimal('0.5'), speed_up=Decimal('0.4'), extra_seconds=0, walk=True)),
+        RouterWayType(WayType(pk=2, speed=Decimal('1'), speed_up=Decimal('1'), extra_seconds=30, walk=False)),
+    )
+    stairs_waytype, elevator_waytype = 1, 2
+
+    router_levels: dict[int, RouterLevel] = {}
+    router_spaces: dict[int, RouterSpace] = {}
+    router_nodes: list[RouterNode] = []
+    edges: list[RouterEdge] = []
+    # node indices per level and grid position
+    grid_nodes: dict[tuple[int, int], list[int]] = {}
+
+    def connect(from_node: int, to_node: int, waytype: int = 0):
+        edges.append(RouterEdge.create(router_nodes[from_node], router_nodes[to_node], waytype))
+        edges.append(RouterEdge.create(router_nodes[to_node], router_nodes[from_node], waytype))
+
+    for level_i in range(levels):
+        level_pk = level_i + 1
+        altitude = level_i * LEVEL_HEIGHT
+        level = RouterLevel(Level(pk=level_pk, base_altitude=Decimal(altitude), level_index=str(level_i),
+                                  short_label=str(level_i)))
+        router_levels[level_pk] = level
+
+        for space_i in range(spaces):
+            space_pk = level_i * spaces + space_i + 1
+            minx, miny = (space_i % columns) * SPACE_SIZE, (space_i // columns) * SPACE_SIZE
+            geometry = box(minx, miny, minx + SPACE_SIZE, miny + SPACE_SIZE)
+
+            space_nodes = []
+            for i in range(nodes):
+                node = RouterNode(i=len(router_nodes), pk=len(router_nodes) + 1,
+                                  x=minx + rng.uniform(0.5, SPACE_SIZE - 0.5),
+                                  y=miny + rng.uniform(0.5, SPACE_SIZE - 0.5),
+                                  space=space_pk, altitude=altitude)
+                router_nodes.append(node)
+                space_nodes.append(node.i)
+
+            # connect every node with its nearest neighbors
+            xy = np.array(tuple((router_nodes[i].x, router_nodes[i].y) for i in space_nodes))
+            distances = np.linalg.norm(xy[:, np.newaxis] - xy[np.newaxis, :], axis=2)
+            neighbors = {tuple(sorted((a, b)))
+                         for a, nearest in enumerate(np.argsort(distances, axis=1)[:, 1:4].tolist()) for b in nearest}
+            for a, b in sorted(neighbors):
+                connect(space_nodes[a], space_nodes[b])
+
+            router_spaces[space_pk] = RouterSpace(
+                Space(pk=space_pk, level_id=level_pk, geometry=geometry),
+                nodes=set(space_nodes),
+                altitudeareas=[RouterAltitudeArea(geometry=geometry, clear_geometry=Polygon(),
+                                                  altitude=Decimal(altitude), points=(),
+                                                  nodes=frozenset(space_nodes))],
+            )
+            level.spaces.add(space_pk)
+            level.nodes.update(space_nodes)
+            grid_nodes[level_i, space_i] = space_nodes
+
+            # doors to the spaces to the left and below
+            for neighbor_i in ((space_i - 1) if space_i % columns else None,
+                               (space_i - columns) if space_i >= columns else None):
+                if neighbor_i is None:
+                    continue
+                neighbor_nodes = grid_nodes[level_i, neighbor_i]
+                neighbor_xy = np.array(tuple((router_nodes[i].x, router_nodes[i].y) for i in neighbor_nodes))
+                distances = np.linalg.norm(xy[:, np.newaxis] - neighbor_xy[np.newaxis, :], axis=2)
+                a, b = np.unravel_index(distances.argmin(), distances.shape)
+                connect(space_nodes[a], neighbor_nodes[b])
+
+    # stairs connect two neighboring levels, elevators connect all levels
+    for level_i in range(levels - 1):
+        for space_i in rng.sample(range(spaces), min(stairs, spaces)):
+            connect(rng.choice(grid_nodes[level_i, space_i]), rng.choice(grid_nodes[level_i + 1, space_i]),
+                    stairs_waytype)
+    for space_i in rng.sample(range(spaces), min(elevators, spaces)):
+        elevator_nodes = [rng.choice(grid_nodes[level_i, space_i]) for level_i in range(levels)]
+        for from_node, to_node in zip(elevator_nodes[:-1], elevator_nodes[1:]):
+            connect(from_node, to_node, elevator_waytype)
+
+    router_restrictions: dict[int, RouterRestriction] = {}
+    for restriction_pk, space_pk in enumerate(rng.sample(tuple(router_spaces), min(restrictions, len(router_spaces))),
+                                              start=1):
+        router_spaces[space_pk].src.access_restriction_id = restriction_pk
+        router_restrictions[restriction_pk] = RouterRestriction(spaces={space_pk})
+
+    return Router.create(levels=router_levels, spaces=router_spaces, areas={}, pois={}, groups={},
+                         restrictions=router_restrictions, nodes=router_nodes, waytypes=waytypes, edges=edges)
+
+
+def get_max_rss() -> float:
+    """ memory high-water mark of this process in MiB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def random_custom_location(router: Router, rng: random.Random) -> CustomLocation:
+    space = router.spaces[rng.choice(tuple(router.spaces))]
+    minx, miny, maxx, maxy = space.geometry.bounds
+    return CustomLocation(router.levels[space.level_id].src, rng.uniform(minx, maxx), rng.uniform(miny, maxy))
+
+
+def run_benchmark(router: Router, route_options, queries=1000, describe_share=0.2, warmup=10,
+                  permissions: frozenset[int] = frozenset(), seed=0) -> dict:
+    """
+    Replay a random mix of get_route (between spaces and coordinates) and describe_custom_location queries.
+    Returns latency percentiles per query type in milliseconds and the number of failed queries.
+    """
+    rng = random.Random(seed)
+
+    def random_location():
+        if rng.random() < 0.5:
+            return router.spaces[rng.choice(tuple(router.spaces))].src
+        return random_custom_location(router, rng)
+
+    workload = []
+    for i in range(warmup + queries):
+        if rng.random() < describe_share:
+            location = random_custom_location(router, rng)
+            location.permissions = permissions
+            workload.append(('describe_custom_location', (location, )))
+        else:
+            workload.append(('get_route', (random_location(), random_location())))
+
+    durations = {'get_route': [], 'describe_custom_location': []}
+    failed = {'get_route': 0, 'describe_custom_location': 0}
+    for i, (kind, args) in enumerate(workload):
+        start = time.perf_counter()
+        try:
+            if kind == 'get_route':
+                router.get_route(*args, permissions=permissions, options=route_options, visible_locations={})
+            else:
+                router.describe_custom_location(*args)
+        except (LocationUnreachable, NoRouteFound, NotYetRoutable):
+            if i >= warmup:
+                failed[kind] += 1
+        if i >= warmup:
+            durations[kind].append(time.perf_counter() - start)
+
+    return {
+        kind: {
+            'count': len(kind_durations),
+            'failed': failed[kind],
+            'mean_ms': float(np.mean(kind_durations) * 1000) if kind_durations else None,
+            'p50_ms': float(np.percentile(kind_durations, 50) * 1000) if kind_durations else None,
+            'p99_ms': float(np.percentile(kind_durations, 99) * 1000) if kind_durations else None,
+        }
+        for kind, kind_durations in durations.items()
+    }
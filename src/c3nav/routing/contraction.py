@@ -0,0 +1,221 @@
+import heapq
+from dataclasses import dataclass
+from itertools import count
+from typing import Iterable, Optional
+
+import numpy as np
+from django.utils.functional import cached_property
+from scipy.sparse import csr_matrix
+
+
+@dataclass
+class ContractionHierarchy:
+    """
+    A contraction hierarchy over one fixed set of edge weights.
+    Every node gets a rank, shortcut edges are added so that every shortest path can be found by only going upwards
+    in rank from the origin and upwards in rank from the destination (against edge direction).
+    This is only valid for exactly the restrictions and route options the edge weights were calculated for.
+    """
+    rank: np.ndarray
+    upwards: csr_matrix  # edges from lower to higher rank
+    downwards: csr_matrix  # edges from higher to lower rank, reversed
+    shortcuts: dict[tuple[int, int], int]  # shortcut edge -> node it bypasses
+    restrictions_key: str
+    options_key: str
+
+    @classmethod
+    def build(cls, graph: csr_matrix, restrictions_key: str, options_key: str,
+              witness_limit: int = 50) -> "ContractionHierarchy":
+        num_nodes = graph.shape[0]
+        outgoing: list[dict[int, float]] = [{} for i in range(num_nodes)]
+        incoming: list[dict[int, float]] = [{} for i in range(num_nodes)]
+        graph = graph.tocoo()
+        for from_node, to_node, weight in zip(graph.row.tolist(), graph.col.tolist(), graph.data.tolist()):
+            if from_node == to_node or weight == np.inf:
+                continue
+            if weight < outgoing[from_node].get(to_node, np.inf):
+                outgoing[from_node][to_node] = weight
+                incoming[to_node][from_node] = weight
+
+        edges = {(from_node, to_node): weight
+                 for from_node, to_nodes in enumerate(outgoing) for to_node, weight in to_nodes.items()}
+        shortcuts: dict[tuple[int, int], int] = {}
+        contracted = [False] * num_nodes
+        contracted_neighbors = [0] * num_nodes
+        rank = np.zeros(num_nodes, dtype=np.int32)
+
+        def witness_distances(origin: int, ignore: int, targets: set[int], max_distance: float) -> dict[int, float]:
+            # local dijkstra that ignores the node that is being contracted, limited in distance and settled nodes
+            distances = {origin: 0}
+            heap = [(0, origin)]
+            settled = 0
+            targets = set(targets)
+            while heap and targets and settled < witness_limit:
+                distance, node = heapq.heappop(heap)
+                if distance > distances[node]:
+                    continue
+                if distance > max_distance:
+                    break
+                targets.discard(node)
+                settled += 1
+                for next_node, weight in outgoing[node].items():
+                    if next_node == ignore or contracted[next_node]:
+                        continue
+                    next_distance = distance + weight
+                    if next_distance < distances.get(next_node, np.inf):
+                        distances[next_node] = next_distance
+                        heapq.heappush(heap, (next_distance, next_node))
+            return distances
+
+        def needed_shortcuts(node: int) -> tuple[list[tuple[int, int, float]], int]:
+            incoming_edges = tuple((n, w) for n, w in incoming[node].items() if not contracted[n])
+            outgoing_edges = tuple((n, w) for n, w in outgoing[node].items() if not contracted[n])
+            result = []
+            for from_node, in_weight in incoming_edges:
+                targets = {to_node for to_node, out_weight in outgoing_edges if to_node != from_node}
+                if not targets:
+                    continue
+                max_out_weight = max(out_weight for to_node, out_weight in outgoing_edges if to_node != from_node)
+                distances = witness_distances(from_node, node, targets, in_weight + max_out_weight)
+                for to_node, out_weight in outgoing_edges:
+                    if to_node == from_node:
+                        continue
+                    weight = in_weight + out_weight
+                    if distances.get(to_node, np.inf) > weight:
+                        result.append((from_node, to_node, weight))
+            return result, len(incoming_edges) + len(outgoing_edges)
+
+        def priority(shortcuts_for_node: list, removed_edges: int, node: int) -> int:
+            # edge difference
+            return len(shortcuts_for_node) - removed_edges + contracted_neighbors[node]
+
+        # contract nodes by priority, with lazy updates of the priority
+        heap = [(priority(*needed_shortcuts(node), node), node) for node in range(num_nodes)]
+        heapq.heapify(heap)
+        current_rank = count()
+        while heap:
+            node_priority, node = heapq.heappop(heap)
+            shortcuts_for_node, removed_edges = needed_shortcuts(node)
+            new_priority = priority(shortcuts_for_node, removed_edges, node)
+            if heap and new_priority > heap[0][0]:
+                heapq.heappush(heap, (new_priority, node))
+                continue
+
+            for from_node, to_node, weight in shortcuts_for_node:
+                if weight < outgoing[from_node].get(to_node, np.inf):
+                    outgoing[from_node][to_node] = weight
+                    incoming[to_node][from_node] = weight
+                    edges[from_node, to_node] = weight
+                    shortcuts[from_node, to_node] = node
+
+            contracted[node] = True
+            rank[node] = next(current_rank)
+            for neighbor in set(incoming[node].keys()) | set(outgoing[node].keys()):
+                contracted_neighbors[neighbor] += 1
+
+        upwards = tuple((from_node, to_node, weight) for (from_node, to_node), weight in edges.items()
+                        if rank[from_node] < rank[to_node])
+        downwards = tuple((to_node, from_node, weight) for (from_node, to_node), weight in edges.items()
+                          if rank[from_node] > rank[to_node])
+
+        return cls(
+            rank=rank,
+            upwards=cls._build_matrix(upwards, num_nodes),
+            downwards=cls._build_matrix(downwards, num_nodes),
+            shortcuts=shortcuts,
+            restrictions_key=restrictions_key,
+            options_key=options_key,
+        )
+
+    @staticmethod
+    def _build_matrix(edges: tuple[tuple[int, int, float], ...], num_nodes: int) -> csr_matrix:
+        if not edges:
+            return csr_matrix((num_nodes, num_nodes), dtype=np.float64)
+        from_nodes, to_nodes, weights = zip(*edges)
+        return csr_matrix((np.array(weights, dtype=np.float64), (np.array(from_nodes), np.array(to_nodes))),
+                          shape=(num_nodes, num_nodes))
+
+    @staticmethod
+    def _adjacency(matrix: csr_matrix) -> tuple[tuple[tuple[int, float], ...], ...]:
+        indptr = matrix.indptr.tolist()
+        indices = matrix.indices.tolist()
+        data = matrix.data.tolist()
+        return tuple(tuple(zip(indices[start:end], data[start:end])) for start, end in zip(indptr, indptr[1:]))
+
+    @cached_property
+    def upwards_adjacency(self):
+        return self._adjacency(self.upwards)
+
+    @cached_property
+    def downwards_adjacency(self):
+        return self._adjacency(self.downwards)
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result.pop('upwards_adjacency', None)
+        result.pop('downwards_adjacency', None)
+        return result
+
+    def can_handle(self, restrictions_key: str, options_key: str) -> bool:
+        return restrictions_key == self.restrictions_key and options_key == self.options_key
+
+    def query(self, origin_nodes: Iterable[int],
+              destination_nodes: Iterable[int]) -> Optional[tuple[int, int, tuple[int, ...]]]:
+        """
+        Find the shortest path from any origin node to any destination node using a bidirectional search.
+        Returns origin node, destination node and the nodes along the path, or None if there is no path.
+        """
+        distances = ({int(node): 0 for node in origin_nodes}, {int(node): 0 for node in destination_nodes})
+        predecessors = ({node: None for node in distances[0]}, {node: None for node in distances[1]})
+        heaps = ([(0, node) for node in distances[0]], [(0, node) for node in distances[1]])
+        adjacencies = (self.upwards_adjacency, self.downwards_adjacency)
+
+        best_distance = np.inf
+        meeting_node = None
+        for node in distances[0].keys() & distances[1].keys():
+            best_distance, meeting_node = 0, node
+
+        while any(heap and heap[0][0] < best_distance for heap in heaps):
+            for direction in (0, 1):
+                heap = heaps[direction]
+                if not heap or heap[0][0] >= best_distance:
+                    continue
+                distance, node = heapq.heappop(heap)
+                if distance > distances[direction][node]:
+                    continue
+                other_distance = distances[1-direction].get(node)
+                if other_distance is not None and distance + other_distance < best_distance:
+                    best_distance, meeting_node = distance + other_distance, node
+                for next_node, weight in adjacencies[direction][node]:
+                    next_distance = distance + weight
+                    if next_distance < distances[direction].get(next_node, np.inf):
+                        distances[direction][next_node] = next_distance
+                        predecessors[direction][next_node] = node
+                        heapq.heappush(heap, (next_distance, next_node))
+
+        if meeting_node is None:
+            return None
+
+        # collect path in the hierarchy, still containing shortcuts
+        forward = [meeting_node]
+        while predecessors[0][forward[-1]] is not None:
+            forward.append(predecessors[0][forward[-1]])
+        forward.reverse()
+        backward = [meeting_node]
+        while predecessors[1][backward[-1]] is not None:
+            backward.append(predecessors[1][backward[-1]])
+        hierarchy_path = forward + backward[1:]
+
+        # unpack shortcuts
+        path = [hierarchy_path[0]]
+        stack = list(zip(hierarchy_path[-2::-1], hierarchy_path[:0:-1]))
+        while stack:
+            from_node, to_node = stack.pop()
+            via = self.shortcuts.get((from_node, to_node))
+            if via is None:
+                path.append(to_node)
+            else:
+                stack.append((via, to_node))
+                stack.append((from_node, via))
+
+        return path[0], path[-1], tuple(path)
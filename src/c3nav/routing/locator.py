@@ -3,7 +3,7 @@ import pickle
 from dataclasses import dataclass, field
 from enum import StrEnum
 from functools import cached_property, reduce
-from typing import Annotated, NamedTuple, Union
+from typing import Annotated, ClassVar, NamedTuple, Union
 from typing import Optional, Self, Sequence, TypeAlias
 from uuid import UUID
 
@@ -12,6 +12,7 @@ from annotated_types import Lt
 from django.conf import settings
 from pydantic.types import NonNegativeInt
 from pydantic_extra_types.mac_address import MacAddress
+from scipy.sparse import csr_matrix
 from shapely import Point
 
 from c3nav.mapdata.models import MapUpdate, Space
@@ -219,20 +220,34 @@ class Locator:
         }
 
     def locate(self, raw_scan_data: list[LocateWifiPeerSchema], permissions=None):
+        return self.locate_many((raw_scan_data, ), permissions)[0]
+
+    def locate_many(self, raw_scan_datas: Sequence[list[LocateWifiPeerSchema]], permissions=None):
         # todo: support for ibeacons
-        scan_data = self.convert_raw_scan_data(raw_scan_data)
-        if not scan_data:
-            return None
+        scan_datas = [self.convert_raw_scan_data(raw_scan_data) for raw_scan_data in raw_scan_datas]
+        results = [None] * len(scan_datas)
 
-        result = self.locate_range(scan_data, permissions)
-        if result is not None:
-            return result
+        # scans that can't be located by ranging or beacon positions are located by rssi together
+        rssi_scans = []
+        for i, scan_data in enumerate(scan_datas):
+            if not scan_data:
+                continue
 
-        result = self.locate_by_beacon_positions(scan_data, permissions)
-        if result is not None:
-            return result
+            results[i] = self.locate_range(scan_data, permissions)
+            if results[i] is not None:
+                continue
+
+            results[i] = self.locate_by_beacon_positions(scan_data, permissions)
+            if results[i] is not None:
+                continue
 
-        return self.locate_rssi(scan_data, permissions)
+            rssi_scans.append(i)
+
+        if rssi_scans:
+            rssi_results = self.locate_rssi_many(tuple(scan_datas[i] for i in rssi_scans), permissions)
+            for i, result in zip(rssi_scans, rssi_results):
+                results[i] = result
+        return results
 
     def locate_by_beacon_positions(self, scan_data: ScanData, permissions=None):
         scan_data_we_can_use = [
@@ -296,34 +311,39 @@ class Locator:
             icon='my_location'
         )
 
+    @cached_property
+    def fingerprints(self) -> "LocatorFingerprints":
+        # built on first use instead of in _rebuild, so it doesn't cost rebuild time and pickle size until needed
+        return LocatorFingerprints.create(self.spaces.values(), num_peers=len(self.peers))
+
     def locate_rssi(self, scan_data: ScanData, permissions=None):
+        return self.locate_rssi_many((scan_data, ), permissions)[0]
+
+    def locate_rssi_many(self, scan_datas: Sequence[ScanData], permissions=None):
+        # rssi based locations are not returned for now, so don't spend time scoring them
+        return [None] * len(scan_datas)
+
+    def get_rssi_locations(self, scan_datas: Sequence[ScanData], permissions=None) -> list[Optional[CustomLocation]]:
+        """
+        Get the best matching measurement point for every scan as a location with its score.
+        """
         router = Router.load()
         restrictions = router.get_restrictions(permissions)
 
-        # get visible spaces
-        spaces = tuple(space for pk, space in self.spaces.items() if pk not in restrictions.spaces)
-
-        # find best point
-        best_peer_id = max(scan_data.items(), key=lambda v: v[1].rssi)[0]
-        best_location = None
-        best_score = float('inf')
-        for space in spaces:
-            point, score = space.get_best_point(scan_data, needed_peer_id=best_peer_id)
-            if point is None:
+        # find best point in all visible spaces
+        best_peer_ids = tuple(max(scan_data.items(), key=lambda v: v[1].rssi)[0] for scan_data in scan_datas)
+        all_candidates = self.fingerprints.get_best_points_many(scan_datas, needed_peer_ids=best_peer_ids,
+                                                                excluded_spaces=restrictions.spaces, k=1)
+        results = []
+        for candidates in all_candidates:
+            if not candidates:
+                results.append(None)
                 continue
-            if score < best_score:
-                location = CustomLocation(router.spaces[space.pk].level, point.x, point.y,
-                                          permissions=permissions, icon='my_location')
-                best_location = location
-                best_score = score
-
-        if best_location is not None:
-            best_location.score = best_score
-
-        if best_location is not None:
-            return None
-
-        return best_location
+            location = CustomLocation(router.spaces[candidates[0].space_id].level, candidates[0].x, candidates[0].y,
+                                      permissions=permissions, icon='my_location')
+            location.score = candidates[0].score
+            results.append(location)
+        return results
 
     @cached_property
     def least_squares_func(self):
@@ -497,33 +517,133 @@ class LocatorSpace:
             levels=levels,
         )
 
-    def get_best_point(self, scan_values: ScanData,
-                       needed_peer_id=None) -> tuple[LocatorPoint, float] | tuple[None, None]:
-        # check if this space knows the needed peer id, otherwise no results here
-        if needed_peer_id not in self.peer_ids:
-            return None, None
-
-        # peers that this space knows
-        peer_ids = frozenset(scan_values.keys()) & self.peer_ids
-        penalty = 0
-        for peer_id, value in scan_values.items():
-            if peer_id not in self.peer_ids:
-                penalty += (value.rssi - no_signal)**2
-
-        peers = tuple(self.peer_lookup[peer_id] for peer_id in peer_ids)
-        values = np.array(tuple(scan_values[peer_id].rssi for peer_id in peer_ids), dtype=np.int64)
-
-        # acceptable points need to have a value for the needed_peer_id
-        points = tuple(
-            np.argwhere(self.levels[:, self.peer_lookup[needed_peer_id]] > 0).ravel()
+
+class LocatorCandidate(NamedTuple):
+    space_id: int
+    x: float
+    y: float
+    score: float
+
+
+@dataclass
+class LocatorFingerprints:
+    """
+    Measurement points of all spaces in one sparse matrix (points × peers), so a scan can be scored against all of
+    them at once. Stored values are the difference to no_signal, so peers missing at a point don't take up space.
+    """
+    space_ids: np.array
+    space_peers: csr_matrix
+    point_spaces: np.array
+    point_xy: np.array
+    levels: csr_matrix
+    levels_squared: csr_matrix
+
+    # number of scans that are scored at once
+    scan_chunk_size: ClassVar[int] = 64
+
+    @classmethod
+    def create(cls, spaces: Sequence[LocatorSpace], num_peers: int):
+        spaces = tuple(spaces)
+        rows, columns, data = [], [], []
+        space_peer_rows, space_peer_columns = [], []
+        point_spaces, point_xy = [], []
+        offset = 0
+        for space_i, space in enumerate(spaces):
+            peers = np.array(tuple(space.peer_lookup.keys()), dtype=np.int64)
+            space_peer_rows.append(np.full(len(peers), fill_value=space_i, dtype=np.int64))
+            space_peer_columns.append(peers)
+
+            point_i, peer_i = np.nonzero(space.levels != no_signal)
+            rows.append(point_i + offset)
+            columns.append(peers[peer_i])
+            data.append(space.levels[point_i, peer_i] - no_signal)
+
+            point_spaces.append(np.full(len(space.points), fill_value=space_i, dtype=np.int64))
+            point_xy.extend((point.x, point.y) for point in space.points)
+            offset += len(space.points)
+
+        def concatenate(arrays, dtype=np.int64):
+            return np.concatenate(arrays) if arrays else np.empty((0, ), dtype=dtype)
+
+        levels = csr_matrix(
+            (concatenate(data).astype(np.float64), (concatenate(rows), concatenate(columns))),
+            shape=(offset, num_peers),
+        )
+        return cls(
+            space_ids=np.array(tuple(space.pk for space in spaces), dtype=np.int64),
+            space_peers=csr_matrix(
+                (np.ones(sum(len(peers) for peers in space_peer_columns), dtype=np.bool_),
+                 (concatenate(space_peer_rows), concatenate(space_peer_columns))),
+                shape=(len(spaces), num_peers),
+            ),
+            point_spaces=concatenate(point_spaces),
+            point_xy=np.array(point_xy, dtype=np.float64).reshape((-1, 2)),
+            levels=levels,
+            levels_squared=levels.multiply(levels).tocsr(),
         )
-        if not points:
-            return None, None
-
-        scores = (np.sum(
-            (self.levels[np.array(points, dtype=np.uint32).reshape((-1, 1)), peers] - values)**2,
-            axis=1
-        )+penalty) / len(scan_values)
-        best_point_i = np.argmin(scores).ravel()[0]
-        best_point = points[best_point_i]
-        return self.points[best_point], scores[best_point_i]
+
+    def get_best_points(self, scan_values: ScanData, needed_peer_id: int,
+                        excluded_spaces=frozenset(), k=1) -> list[LocatorCandidate]:
+        """
+        Get the k measurement points that match the scan best, lowest score first.
+        Only points in spaces that know the needed peer and aren't excluded are considered.
+        """
+        return self.get_best_points_many((scan_values, ), (needed_peer_id, ), excluded_spaces=excluded_spaces, k=k)[0]
+
+    def get_best_points_many(self, scans: Sequence[ScanData], needed_peer_ids: Sequence[int],
+                             excluded_spaces=frozenset(), k=1) -> list[list[LocatorCandidate]]:
+        """
+        Like get_best_points, but scores multiple scans at once.
+        Scans are scored in chunks, so the dense points × scans arrays don't get too big.
+        """
+        if not self.levels.shape[0] or not scans:
+            return [[] for scan_values in scans]
+
+        visible_spaces = np.ones(self.space_ids.shape, dtype=np.bool_)
+        if excluded_spaces:
+            visible_spaces = ~np.isin(self.space_ids, tuple(excluded_spaces))
+
+        results = []
+        for start in range(0, len(scans), self.scan_chunk_size):
+            chunk = slice(start, start + self.scan_chunk_size)
+            results.extend(self._get_best_points_chunk(scans[chunk], needed_peer_ids[chunk], visible_spaces, k))
+        return results
+
+    def _get_best_points_chunk(self, scans: Sequence[ScanData], needed_peer_ids: Sequence[int],
+                               visible_spaces: np.ndarray, k: int) -> list[list[LocatorCandidate]]:
+        # the score of a point is the mean of (level - rssi)**2 over all scanned peers, with level being
+        # no_signal + stored value. expanding the square gives us two sparse matrix products, one column per scan.
+        offsets = np.zeros((self.levels.shape[1], len(scans)), dtype=np.float64)
+        scanned = np.zeros((self.levels.shape[1], len(scans)), dtype=np.float64)
+        for scan_i, scan_values in enumerate(scans):
+            peer_ids = np.fromiter(scan_values.keys(), dtype=np.int64, count=len(scan_values))
+            offsets[peer_ids, scan_i] = no_signal - np.fromiter((value.rssi for value in scan_values.values()),
+                                                                dtype=np.float64, count=len(scan_values))
+            scanned[peer_ids, scan_i] = 1
+        scores = (
+            np.sum(offsets**2, axis=0) + 2 * (self.levels @ offsets) + self.levels_squared @ scanned
+        ) / np.fromiter((len(scan_values) for scan_values in scans), dtype=np.float64, count=len(scans))
+
+        # acceptable points are in visible spaces that know the needed peer and have a value for it
+        needed_peer_ids = np.array(needed_peer_ids, dtype=np.int64)
+        spaces_mask = self.space_peers[:, needed_peer_ids].toarray() & visible_spaces[:, np.newaxis]
+        points_mask = spaces_mask[self.point_spaces] & (self.levels[:, needed_peer_ids].toarray() != -no_signal)
+
+        results = []
+        for scan_i in range(len(scans)):
+            candidates = np.flatnonzero(points_mask[:, scan_i])
+            candidate_scores = scores[candidates, scan_i]
+            if k < candidates.size:
+                best = np.argpartition(candidate_scores, k-1)[:k]
+                candidates, candidate_scores = candidates[best], candidate_scores[best]
+            order = np.lexsort((candidates, candidate_scores))
+            results.append([
+                LocatorCandidate(
+                    space_id=int(self.space_ids[self.point_spaces[point_i]]),
+                    x=float(self.point_xy[point_i, 0]),
+                    y=float(self.point_xy[point_i, 1]),
+                    score=float(candidate_scores[i]),
+                )
+                for i, point_i in zip(order, candidates[order])
+            ])
+        return results
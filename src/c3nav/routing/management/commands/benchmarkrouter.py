@@ -0,0 +1,193 @@
+import json
+import random
+import time
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext_lazy as _
+
+from c3nav.mapdata.models import MapUpdate
+from c3nav.mapdata.models.access import AccessRestriction
+from c3nav.routing.benchmark import SyntheticRouteOptions, generate_router, get_max_rss, run_benchmark
+from c3nav.routing.contraction import ContractionHierarchy
+from c3nav.routing.exceptions import NoRouteFound
+from c3nav.routing.models import RouteOptions
+from c3nav.routing.router import Router
+
+
+class Command(BaseCommand):
+    help = ('benchmark routing with and without contraction hierarchies and replay random route and describe '
+            'queries, on the current router or a synthetic venue')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=1000, help=_('number of random queries per mode'))
+        parser.add_argument('--seed', type=int, default=0,
+                            help=_('random seed for query selection and the synthetic venue'))
+        parser.add_argument('--load', type=str, default=None, metavar='DIRECTORY',
+                            help=_('load the router from this cache directory (containing router.pickle) '
+                                   'instead of the current router'))
+        parser.add_argument('--rebuild', action='store_const', const=True, default=False,
+                            help=_('rebuild the router of the current map update instead of loading it'))
+        parser.add_argument('--synthetic', action='store_const', const=True, default=False,
+                            help=_('generate a router for a synthetic venue instead of loading it'))
+        parser.add_argument('--levels', type=int, default=3, help=_('number of synthetic levels'))
+        parser.add_argument('--spaces', type=int, default=100, help=_('number of synthetic spaces per level'))
+        parser.add_argument('--nodes', type=int, default=20, help=_('number of synthetic nodes per space'))
+        parser.add_argument('--stairs', type=int, default=10,
+                            help=_('number of synthetic stairs between two neighboring levels'))
+        parser.add_argument('--elevators', type=int, default=2, help=_('number of synthetic elevators'))
+        parser.add_argument('--restrictions', type=int, default=5, help=_('number of synthetic restricted spaces'))
+        parser.add_argument('--describe-share', type=float, default=0.2,
+                            help=_('share of describe_custom_location queries in the replay, '
+                                   'the rest are get_route queries'))
+        parser.add_argument('--warmup', type=int, default=10,
+                            help=_('number of replay queries to run before measuring'))
+        parser.add_argument('--json', action='store_const', const=True, default=False,
+                            help=_('output the results as json'))
+        parser.add_argument('--output', type=str, default=None, help=_('write the results as json to this file'))
+
+    def handle(self, *args, **options):
+        if sum(bool(options[key]) for key in ('load', 'rebuild', 'synthetic')) > 1:
+            raise CommandError(_('Only one of --load, --rebuild and --synthetic can be used.'))
+
+        synthetic = options['synthetic']
+        result = {
+            'parameters': {key: options[key] for key in ('queries', 'describe_share', 'warmup', 'seed')},
+            'rebuild_seconds': None,
+            'load_seconds': None,
+        }
+
+        start = time.perf_counter()
+        if synthetic:
+            if min(options['levels'], options['spaces'], options['nodes']) < 1:
+                raise CommandError(_('A synthetic venue needs at least one level, space and node.'))
+            result['source'] = 'synthetic'
+            result['parameters'].update({key: options[key] for key in ('levels', 'spaces', 'nodes', 'stairs',
+                                                                       'elevators', 'restrictions')})
+            router = generate_router(levels=options['levels'], spaces=options['spaces'], nodes=options['nodes'],
+                                     stairs=options['stairs'], elevators=options['elevators'],
+                                     restrictions=options['restrictions'], seed=options['seed'])
+            result['rebuild_seconds'] = time.perf_counter() - start
+        elif options['rebuild']:
+            result['source'] = 'rebuild'
+            router = Router.rebuild(MapUpdate.last_processed_update())
+            result['rebuild_seconds'] = time.perf_counter() - start
+        elif options['load']:
+            result['source'] = options['load']
+            dirname = Path(options['load'])
+            router = Router.load_files(dirname / 'router.pickle', dirname / 'router', dirname / 'router_ch.pickle')
+            result['load_seconds'] = time.perf_counter() - start
+        else:
+            result['source'] = 'current'
+            router = Router.load()
+            result['load_seconds'] = time.perf_counter() - start
+
+        result['router'] = {
+            'levels': len(router.levels),
+            'spaces': len(router.spaces),
+            'nodes': len(router.nodes),
+            'edges': int(router.graph.nnz),
+            'restrictions': len(router.restrictions),
+        }
+        result['max_rss_mib_after_build'] = get_max_rss()
+
+        # synthetic routers have no access restrictions in the database, so nothing is public there
+        restrictions = router.get_restrictions(set() if synthetic else AccessRestriction.get_all_public())
+        if not router.contraction_hierarchies:
+            if synthetic:
+                for mode in ('fastest', 'shortest'):
+                    route_options = self._get_route_options(mode, synthetic)
+                    router.contraction_hierarchies[mode] = ContractionHierarchy.build(
+                        router.get_graph(restrictions, route_options),
+                        restrictions_key=restrictions.cache_key,
+                        options_key=route_options.serialize_string(),
+                    )
+            else:
+                router.build_contraction_hierarchies()
+
+        result['shortest_path'] = self._compare_contraction_hierarchies(router, restrictions, synthetic,
+                                                                        options['queries'], options['seed'])
+        result['replay'] = run_benchmark(router, self._get_route_options('fastest', synthetic),
+                                         queries=options['queries'], describe_share=options['describe_share'],
+                                         warmup=options['warmup'], seed=options['seed'])
+        result['max_rss_mib'] = get_max_rss()
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(result, indent=2) + '\n')
+        elif options['json']:
+            self.stdout.write(json.dumps(result, indent=2))
+        else:
+            self._write_results(result)
+
+    @staticmethod
+    def _get_route_options(mode, synthetic):
+        if synthetic:
+            return SyntheticRouteOptions(mode)
+        route_options = RouteOptions()
+        route_options['mode'] = mode
+        return route_options
+
+    def _compare_contraction_hierarchies(self, router, restrictions, synthetic, num_queries, seed) -> dict:
+        rng = random.Random(seed)
+        num_nodes = len(router.nodes)
+        queries = tuple((np.array((rng.randrange(num_nodes), ), dtype=np.int32),
+                         np.array((rng.randrange(num_nodes), ), dtype=np.int32))
+                        for i in range(num_queries))
+
+        hierarchies = router.contraction_hierarchies
+        results_by_mode = {}
+        for mode in hierarchies:
+            route_options = self._get_route_options(mode, synthetic)
+            durations = {}
+            results = {}
+            for name, use_hierarchy in (('dijkstra', False), ('contraction hierarchy', True)):
+                router.contraction_hierarchies = hierarchies if use_hierarchy else {}
+                results[name] = []
+                start = time.perf_counter()
+                for origin_nodes, destination_nodes in queries:
+                    try:
+                        results[name].append(router.shortest_path(origin_nodes, destination_nodes,
+                                                                  restrictions, route_options)[2])
+                    except NoRouteFound:
+                        results[name].append(None)
+                durations[name] = time.perf_counter() - start
+            router.contraction_hierarchies = hierarchies
+
+            graph = router.get_graph(restrictions, route_options)
+            mismatches = sum(
+                (self._path_length(graph, a) if a else None) != (self._path_length(graph, b) if b else None)
+                for a, b in zip(results['dijkstra'], results['contraction hierarchy'])
+            )
+            results_by_mode[mode] = {
+                'queries': len(queries),
+                **{'%s_ms' % name.replace(' ', '_'): duration / len(queries) * 1000
+                   for name, duration in durations.items()},
+                'speedup': durations['dijkstra'] / durations['contraction hierarchy'],
+                'mismatches': mismatches,
+            }
+        return results_by_mode
+
+    def _write_results(self, result):
+        self.stdout.write('router (%s): %d levels, %d spaces, %d nodes, %d edges, %d restrictions' % (
+            result['source'], *result['router'].values()
+        ))
+        for mode, mode_result in result['shortest_path'].items():
+            self.stdout.write('%s: %d queries' % (mode, mode_result['queries']))
+            self.stdout.write('  dijkstra: %.3f ms per query' % mode_result['dijkstra_ms'])
+            self.stdout.write('  contraction hierarchy: %.3f ms per query' % mode_result['contraction_hierarchy_ms'])
+            self.stdout.write('  speedup: %.1fx, mismatching path lengths: %d' % (
+                mode_result['speedup'], mode_result['mismatches']
+            ))
+        for kind, kind_result in result['replay'].items():
+            if not kind_result['count']:
+                continue
+            self.stdout.write('%s: %d queries, %d failed, %.3f ms mean, %.3f ms p50, %.3f ms p99' % (
+                kind, kind_result['count'], kind_result['failed'],
+                kind_result['mean_ms'], kind_result['p50_ms'], kind_result['p99_ms'],
+            ))
+        self.stdout.write('max rss: %.1f MiB' % result['max_rss_mib'])
+
+    @staticmethod
+    def _path_length(graph, path):
+        return round(sum(graph[from_node, to_node] for from_node, to_node in zip(path, path[1:])), 3)
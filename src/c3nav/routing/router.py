@@ -1,8 +1,10 @@
+import hashlib
 import logging
 import operator
+import os
 import pickle
-from collections import deque, namedtuple
-from dataclasses import dataclass, field
+from collections import OrderedDict, deque, namedtuple
+from dataclasses import dataclass, field, replace
 from functools import reduce
 from itertools import chain
 from operator import itemgetter
@@ -10,19 +12,22 @@ from typing import Optional, TypeVar, Generic, Mapping, Any, Sequence, TypeAlias
 
 import numpy as np
 from django.conf import settings
-from django.core.cache import cache
 from django.utils.functional import cached_property, Promise
-from shapely import prepared
+from scipy.sparse import csr_matrix
+import shapely
+from shapely import prepared, STRtree
 from shapely.geometry import LineString, Point, Polygon, MultiPolygon
 from shapely.ops import unary_union
 from twisted.protocols.amp import Decimal
 
 from c3nav.mapdata.models import AltitudeArea, Area, GraphEdge, Level, LocationGroup, MapUpdate, Space, WayType
+from c3nav.mapdata.models.access import AccessRestriction
 from c3nav.mapdata.models.geometry.level import AltitudeAreaPoint
 from c3nav.mapdata.models.geometry.space import POI, CrossDescription, LeaveDescription
 from c3nav.mapdata.models.locations import CustomLocationProxyMixin, Location
 from c3nav.mapdata.utils.geometry import assert_multipolygon, get_rings, good_representative_point, unwrap_geom
 from c3nav.mapdata.utils.locations import CustomLocation
+from c3nav.routing.contraction import ContractionHierarchy
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
 from c3nav.routing.models import RouteOptions
 from c3nav.routing.route import Route
@@ -55,10 +60,54 @@ class Router:
     pois: dict[int, "RouterPoint"]
     groups: dict[int, "RouterGroup"]
     restrictions: dict[int, "RouterRestriction"]
-    nodes: deque["RouterNode"]
-    edges: dict[EdgeIndex, "RouterEdge"]
+    nodes: "RouterNodes"
     waytypes: dict[int, "RouterWayType"]
-    graph: np.ndarray
+    graph: csr_matrix
+    edge_waytypes: np.ndarray
+    edge_rises: np.ndarray
+    edge_distances: np.ndarray
+    edge_restrictions: np.ndarray
+    contraction_hierarchies: dict[str, ContractionHierarchy] = field(default_factory=dict)
+
+    # these are stored as separate .npy files, so they can be memory-mapped and shared between processes
+    array_attributes: ClassVar = ('graph', 'nodes', 'edge_waytypes', 'edge_rises', 'edge_distances',
+                                  'edge_restrictions')
+
+    def __getstate__(self):
+        # arrays and contraction hierarchies are stored in separate files
+        result = self.__dict__.copy()
+        for name in self.array_attributes + ('contraction_hierarchies', 'edges', 'edge_from', 'edge_keys',
+                                             'space_trees', 'restriction_sets', 'weighted_graphs'):
+            result.pop(name, None)
+        return result
+
+    def get_arrays(self) -> dict[str, np.ndarray]:
+        return {
+            'graph_data': self.graph.data,
+            'graph_indices': self.graph.indices,
+            'graph_indptr': self.graph.indptr,
+            'edge_waytypes': self.edge_waytypes,
+            'edge_rises': self.edge_rises,
+            'edge_distances': self.edge_distances,
+            'edge_restrictions': self.edge_restrictions,
+            'node_pks': self.nodes.pks,
+            'node_spaces': self.nodes.spaces,
+            'node_xyz': self.nodes.xyz,
+        }
+
+    def set_arrays(self, arrays: dict[str, np.ndarray]):
+        num_nodes = len(arrays['graph_indptr']) - 1
+        self.graph = csr_matrix((arrays['graph_data'], arrays['graph_indices'], arrays['graph_indptr']),
+                                shape=(num_nodes, num_nodes), copy=False)
+        self.edge_waytypes = arrays['edge_waytypes']
+        self.edge_rises = arrays['edge_rises']
+        self.edge_distances = arrays['edge_distances']
+        self.edge_restrictions = arrays['edge_restrictions']
+        self.nodes = RouterNodes(pks=arrays['node_pks'], spaces=arrays['node_spaces'], xyz=arrays['node_xyz'])
+
+    @cached_property
+    def edges(self) -> "RouterEdges":
+        return RouterEdges(self)
 
     @staticmethod
     def get_altitude_in_areas(areas, point):
@@ -79,8 +128,25 @@ class Router:
         groups: dict[int, RouterGroup] = {}
         restrictions: dict[int, RouterRestriction] = {}
         nodes: deque[RouterNode] = deque()
+
+        # space geometries from the last rebuild, to only recalculate geometries of spaces that changed
+        previous_geometries = cls.load_geometries(MapUpdate.last_processed_update(force=True, lock=False))
+        geometries: dict[int, RouterSpaceGeometries] = {}
+
+        # same for the node data of each space, which is recalculated if the space or anything in it changed
+        previous_space_nodes = cls.load_space_nodes(MapUpdate.last_processed_update(force=True, lock=False))
+        space_nodes_cache: dict[int, RouterSpaceNodes] = {}
+        reused_space_nodes = 0
+
         for level in levels_query:
-            buildings_geom = unary_union(tuple(unwrap_geom(building.geometry) for building in level.buildings.all()))
+            buildings = tuple(unwrap_geom(building.geometry) for building in level.buildings.all())
+            buildings_geom = None
+
+            altitudeareas = tuple(level.altitudeareas.all())
+            altitudeareas_keys = {}
+            for area in altitudeareas:
+                altitudeareas_keys[area.pk] = RouterSpaceGeometries.build_key(area.geometry)
+                area.geometry = unwrap_geom(area.geometry).buffer(0)
 
             nodes_before_count = len(nodes)
 
@@ -93,20 +159,45 @@ class Router:
                 )
 
             for space in level.spaces.all():
-                # create space geometries
-                accessible_geom = space.geometry.difference(unary_union(
+                # create space geometries, or reuse them from the last rebuild if none of their sources changed
+                cutouts = (
                     tuple(unwrap_geom(column.geometry)
                           for column in space.columns.all()
                           if column.access_restriction_id is None) +
-                    tuple(unwrap_geom(hole.geometry) for hole in space.holes.all()) +
-                    ((buildings_geom, ) if space.outside else ())
-                ))
-                obstacles_geom = unary_union(
+                    tuple(unwrap_geom(hole.geometry) for hole in space.holes.all())
+                )
+                obstacles = (
                     tuple(unwrap_geom(obstacle.geometry) for obstacle in space.obstacles.all()) +
                     tuple(unwrap_geom(lineobstacle.buffered_geometry) for lineobstacle in space.lineobstacles.all())
                 )
-                clear_geom = unary_union(tuple(get_rings(accessible_geom.difference(obstacles_geom))))
-                clear_geom_prep = prepared.prep(clear_geom)
+                space_geometries_key = RouterSpaceGeometries.build_key(
+                    space.geometry, b'cutouts', *cutouts, b'buildings', *(buildings if space.outside else ()),
+                    b'obstacles', *obstacles
+                )
+                space_geometries = previous_geometries.get(space.pk)
+                if space_geometries is not None and space_geometries.key == space_geometries_key:
+                    space_geometries = RouterSpaceGeometries(
+                        key=space_geometries_key,
+                        accessible_geom=space_geometries.accessible_geom,
+                        obstacles_geom=space_geometries.obstacles_geom,
+                        clear_geom=space_geometries.clear_geom,
+                        previous_altitudeareas=space_geometries.altitudeareas,
+                    )
+                else:
+                    if space.outside and buildings_geom is None:
+                        buildings_geom = unary_union(buildings)
+                    accessible_geom = space.geometry.difference(unary_union(
+                        cutouts + ((buildings_geom, ) if space.outside else ())
+                    ))
+                    obstacles_geom = unary_union(obstacles)
+                    space_geometries = RouterSpaceGeometries(
+                        key=space_geometries_key,
+                        accessible_geom=accessible_geom,
+                        obstacles_geom=obstacles_geom,
+                        clear_geom=unary_union(tuple(get_rings(accessible_geom.difference(obstacles_geom)))),
+                    )
+                geometries[space.pk] = space_geometries
+                accessible_geom = space_geometries.accessible_geom
 
                 for group in space.groups.all():
                     groups.setdefault(group.pk, RouterGroup()).spaces.add(space.pk)
@@ -114,121 +205,175 @@ class Router:
                 if space.access_restriction_id:
                     restrictions.setdefault(space.access_restriction_id, RouterRestriction()).spaces.add(space.pk)
 
+                space_nodes_offset = len(nodes)
                 space_nodes = tuple(RouterNode.from_graph_node(node, i)
-                                    for i, node in enumerate(space.graphnodes.all()))
-                for i, node in enumerate(space_nodes, start=len(nodes)):
-                    node.i = i
+                                    for i, node in enumerate(space.graphnodes.all(), start=space_nodes_offset))
                 nodes.extend(space_nodes)
 
                 space_obj = space
                 space = RouterSpace(space)
                 space.nodes = set(node.i for node in space_nodes)
 
+                space_areas = []
                 for area in space_obj.areas.all():
                     for group in area.groups.all():
                         groups.setdefault(group.pk, RouterGroup()).areas.add(area.pk)
                     area._prefetched_objects_cache = {}
+                    space_areas.append(RouterArea(area))
 
-                    area = RouterArea(area)
-                    area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
-                    area.nodes = set(node.i for node in area_nodes)
-                    for node in area_nodes:
-                        node.areas.add(area.pk)
-                    if not area.nodes and space_nodes:
-                        nearest_node = min(space_nodes, key=lambda node: area.geometry.distance(node.point))
-                        area.nodes.add(nearest_node.i)
-                    areas[area.pk] = area
-                    space.areas.add(area.pk)
-
-                for area in level.altitudeareas.all():
-                    area.geometry = unwrap_geom(area.geometry).buffer(0)
-                    if not space.geometry_prep.intersects(unwrap_geom(area.geometry)):
-                        continue
-                    for subgeom in assert_multipolygon(accessible_geom.intersection(unwrap_geom(area.geometry))):
-                        if subgeom.is_empty:
-                            continue
-                        area_clear_geom = unary_union(tuple(get_rings(subgeom.difference(obstacles_geom))))
-                        if area_clear_geom.is_empty:
-                            continue
-                        area = RouterAltitudeArea(
-                            geometry=subgeom,
-                            clear_geometry=area_clear_geom,
-                            altitude=area.altitude,
-                            points=area.points
-                        )
+                space_pois = []
+                for poi in space_obj.pois.all():
+                    for group in poi.groups.all():
+                        groups.setdefault(group.pk, RouterGroup()).pois.add(poi.pk)
+                    poi._prefetched_objects_cache = {}
+                    space_pois.append(RouterPoint(poi))
+
+                restricted_columns = tuple(column for column in space_obj.columns.all()
+                                           if column.access_restriction_id is not None)
+                space_altitudeareas = tuple(area for area in altitudeareas
+                                            if space.geometry_prep.intersects(area.geometry))
+
+                # create node data, or reuse it from the last rebuild if none of its sources changed
+                space_nodes_key = RouterSpaceGeometries.build_key(
+                    space_geometries_key, str(level.base_altitude).encode(),
+                    b'nodes', *(f'{node.pk}:{node.x}:{node.y}'.encode() for node in space_nodes),
+                    b'areas', *chain.from_iterable((str(area.pk).encode(), area.geometry) for area in space_areas),
+                    b'altitudeareas', *chain.from_iterable(
+                        (altitudeareas_keys[area.pk], f'{area.altitude}:{area.points!r}'.encode())
+                        for area in space_altitudeareas
+                    ),
+                    b'pois', *chain.from_iterable((str(poi.pk).encode(), poi.geometry) for poi in space_pois),
+                    b'columns', *chain.from_iterable((str(column.access_restriction_id).encode(), column.geometry)
+                                                     for column in restricted_columns),
+                )
+                space_nodes_data = previous_space_nodes.get(space.pk)
+                if space_nodes_data is not None and space_nodes_data.key == space_nodes_key:
+                    space_nodes_data = space_nodes_data.moved(space_nodes_offset)
+                    reused_space_nodes += 1
+                    for area in space_altitudeareas:
+                        # keep the altitude area geometries for the next rebuild
+                        space_geometries.get_altitudearea_geometries(altitudeareas_keys[area.pk], area.geometry)
+                    for node, altitude, node_areas in zip(space_nodes, space_nodes_data.altitudes,
+                                                          space_nodes_data.node_areas):
+                        node.altitude = altitude
+                        node.areas = set(node_areas)
+                    for area in space_areas:
+                        area.nodes = set(space_nodes_data.area_nodes[area.pk])
+                    space.altitudeareas = list(space_nodes_data.altitudeareas)
+                    for poi in space_pois:
+                        poi.altitude, poi.nodes_addition = space_nodes_data.pois[poi.pk]
+                        poi.nodes = set(poi.nodes_addition.keys())
+                else:
+                    clear_geom_prep = prepared.prep(space_geometries.clear_geom)
+
+                    for area in space_areas:
                         area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
                         area.nodes = set(node.i for node in area_nodes)
                         for node in area_nodes:
-                            altitude = area.get_altitude(node)
-                            if node.altitude is None or node.altitude < altitude:
-                                node.altitude = altitude
-
-                        space.altitudeareas.append(area)
-
-                for node in space_nodes:
-                    if node.altitude is not None:
-                        continue
-                    logger.warning('Node %d in space %d is not inside an altitude area' % (node.pk, space.pk))
-                    node_altitudearea = min(space.altitudeareas,
-                                            key=lambda a: a.geometry.distance(node.point), default=None)
-                    if node_altitudearea:
-                        node.altitude = node_altitudearea.get_altitude(node)
-                    else:
-                        node.altitude = float(level.base_altitude)
-                        logger.info('Space %d has no altitude areas' % space.pk)
-
-                for area in space.altitudeareas:
-                    # create fallback nodes
-                    if not area.nodes and space_nodes:
-                        fallback_point = good_representative_point(area.clear_geometry)
-                        fallback_node = RouterNode(
-                            i=None,
-                            pk=None,
-                            x=fallback_point.x,
-                            y=fallback_point.y,
-                            space=space.pk,
-                            altitude=area.get_altitude(fallback_point)
-                        )
-                        # todo: check waytypes here
-                        for node in space_nodes:
-                            line = LineString([(node.x, node.y), (fallback_node.x, fallback_node.y)])
-                            if line.length < 5 and not clear_geom_prep.intersects(line):
-                                area.fallback_nodes[node.i] = RouterNodeAndEdge(
+                            node.areas.add(area.pk)
+                        if not area.nodes and space_nodes:
+                            nearest_node = min(space_nodes, key=lambda node: area.geometry.distance(node.point))
+                            area.nodes.add(nearest_node.i)
+
+                    for area in space_altitudeareas:
+                        for subgeom, area_clear_geom in space_geometries.get_altitudearea_geometries(
+                            altitudeareas_keys[area.pk], area.geometry
+                        ):
+                            area = RouterAltitudeArea(
+                                geometry=subgeom,
+                                clear_geometry=area_clear_geom,
+                                altitude=area.altitude,
+                                points=area.points
+                            )
+                            area_nodes = tuple(node for node in space_nodes
+                                               if area.geometry_prep.intersects(node.point))
+                            area.nodes = set(node.i for node in area_nodes)
+                            if area_nodes:
+                                altitudes = area.get_altitudes(tuple((node.x, node.y) for node in area_nodes))
+                                for node, altitude in zip(area_nodes, altitudes.tolist()):
+                                    if node.altitude is None or node.altitude < altitude:
+                                        node.altitude = altitude
+
+                            space.altitudeareas.append(area)
+
+                    for node in space_nodes:
+                        if node.altitude is not None:
+                            continue
+                        logger.warning('Node %d in space %d is not inside an altitude area' % (node.pk, space.pk))
+                        node_altitudearea = min(space.altitudeareas,
+                                                key=lambda a: a.geometry.distance(node.point), default=None)
+                        if node_altitudearea:
+                            node.altitude = node_altitudearea.get_altitude(node)
+                        else:
+                            node.altitude = float(level.base_altitude)
+                            logger.info('Space %d has no altitude areas' % space.pk)
+
+                    for area in space.altitudeareas:
+                        # create fallback nodes
+                        if not area.nodes and space_nodes:
+                            fallback_point = good_representative_point(area.clear_geometry)
+                            fallback_node = RouterNode(
+                                i=None,
+                                pk=None,
+                                x=fallback_point.x,
+                                y=fallback_point.y,
+                                space=space.pk,
+                                altitude=area.get_altitude(fallback_point)
+                            )
+                            # todo: check waytypes here
+                            for node in space_nodes:
+                                line = LineString([(node.x, node.y), (fallback_node.x, fallback_node.y)])
+                                if line.length < 5 and not clear_geom_prep.intersects(line):
+                                    area.fallback_nodes[node.i] = RouterNodeAndEdge(
+                                        node=fallback_node,
+                                        edge=RouterEdge.create(from_node=fallback_node, to_node=node, waytype=0)
+                                    )
+                            if not area.fallback_nodes:
+                                nearest_node = min(space_nodes, key=lambda node: fallback_point.distance(node.point))
+                                area.fallback_nodes[nearest_node.i] = RouterNodeAndEdge(
                                     node=fallback_node,
-                                    edge=RouterEdge.create(from_node=fallback_node, to_node=node, waytype=0)
+                                    edge=RouterEdge.create(from_node=fallback_node, to_node=nearest_node, waytype=0)
                                 )
-                        if not area.fallback_nodes:
-                            nearest_node = min(space_nodes, key=lambda node: fallback_point.distance(node.point))
-                            area.fallback_nodes[nearest_node.i] = RouterNodeAndEdge(
-                                node=fallback_node,
-                                edge=RouterEdge.create(from_node=fallback_node, to_node=nearest_node, waytype=0)
-                            )
 
-                for poi in space_obj.pois.all():
-                    for group in poi.groups.all():
-                        groups.setdefault(group.pk, RouterGroup()).pois.add(poi.pk)
-                    poi._prefetched_objects_cache = {}
+                    for poi in space_pois:
+                        try:
+                            altitudearea = space.altitudearea_for_point(poi.geometry)
+                            poi.altitude = altitudearea.get_altitude(poi.geometry)
+                            poi_nodes = altitudearea.nodes_for_point(poi.geometry, all_nodes=nodes)
+                        except LocationUnreachable:
+                            poi_nodes = {}
+                        poi.nodes = set(i for i in poi_nodes.keys())
+                        poi.nodes_addition = poi_nodes
+
+                    column_nodes = []
+                    for column in restricted_columns:
+                        column.geometry_prep = prepared.prep(unwrap_geom(column.geometry))
+                        column_nodes.append((column.access_restriction_id, frozenset(
+                            node.i for node in space_nodes if column.geometry_prep.intersects(node.point)
+                        )))
+
+                    space_nodes_data = RouterSpaceNodes(
+                        key=space_nodes_key,
+                        offset=space_nodes_offset,
+                        altitudes=tuple(node.altitude for node in space_nodes),
+                        node_areas=tuple(frozenset(node.areas) for node in space_nodes),
+                        area_nodes={area.pk: frozenset(area.nodes) for area in space_areas},
+                        altitudeareas=tuple(space.altitudeareas),
+                        pois={poi.pk: (poi.altitude, poi.nodes_addition) for poi in space_pois},
+                        column_nodes=tuple(column_nodes),
+                    )
+                space_nodes_cache[space.pk] = space_nodes_data
+
+                for area in space_areas:
+                    areas[area.pk] = area
+                    space.areas.add(area.pk)
 
-                    poi = RouterPoint(poi)
-                    try:
-                        altitudearea = space.altitudearea_for_point(poi.geometry)
-                        poi.altitude = altitudearea.get_altitude(poi.geometry)
-                        poi_nodes = altitudearea.nodes_for_point(poi.geometry, all_nodes=nodes)
-                    except LocationUnreachable:
-                        poi_nodes = {}
-                    poi.nodes = set(i for i in poi_nodes.keys())
-                    poi.nodes_addition = poi_nodes
+                for poi in space_pois:
                     pois[poi.pk] = poi
                     space.pois.add(poi.pk)
 
-                for column in space_obj.columns.all():
-                    if column.access_restriction_id is None:
-                        continue
-                    column.geometry_prep = prepared.prep(unwrap_geom(column.geometry))
-                    column_nodes = tuple(node for node in space_nodes if column.geometry_prep.intersects(node.point))
-                    column_nodes = set(node.i for node in column_nodes)
-                    restrictions.setdefault(column.access_restriction_id,
-                                            RouterRestriction()).additional_nodes.update(column_nodes)
+                for restriction_id, column_nodes in space_nodes_data.column_nodes:
+                    restrictions.setdefault(restriction_id, RouterRestriction()).additional_nodes.update(column_nodes)
 
                 space_obj._prefetched_objects_cache = {}
 
@@ -243,6 +388,11 @@ class Router:
             level.nodes = set(range(nodes_before_count, len(nodes)))
             levels[level.pk] = level
 
+        logger.info('Reused geometries for %d of %d spaces.' % (
+            sum(space_geometries.reused for space_geometries in geometries.values()), len(geometries)
+        ))
+        logger.info('Reused node data for %d of %d spaces.' % (reused_space_nodes, len(space_nodes_cache)))
+
         # add graph descriptions
         for description in LeaveDescription.objects.all():
             spaces[description.space_id].leave_descriptions[description.target_space_id] = description.description
@@ -273,55 +423,161 @@ class Router:
             )
             for edge in GraphEdge.objects.all()
         )
+
+        router = cls.create(levels=levels, spaces=spaces, areas=areas, pois=pois, groups=groups,
+                            restrictions=restrictions, nodes=nodes, waytypes=waytypes, edges=edges)
+        router.save(update)
+        pickle.dump(geometries, open(cls.build_geometries_filename(update), 'wb'))
+        pickle.dump(space_nodes_cache, open(cls.build_space_nodes_filename(update), 'wb'))
+
+        if settings.ROUTING_CONTRACTION_HIERARCHIES:
+            logger.info('Building contraction hierarchies...')
+            router.build_contraction_hierarchies()
+            pickle.dump(router.contraction_hierarchies,
+                        open(cls.build_contraction_hierarchies_filename(update), 'wb'))
+
+        return router
+
+    @classmethod
+    def create(cls, levels: dict[int, "RouterLevel"], spaces: dict[int, "RouterSpace"], areas: dict[int, "RouterArea"],
+               pois: dict[int, "RouterPoint"], groups: dict[int, "RouterGroup"],
+               restrictions: dict[int, "RouterRestriction"], nodes: Sequence["RouterNode"],
+               waytypes: Sequence["RouterWayType"], edges: Sequence["RouterEdge"]) -> "Router":
+        """
+        Build the graph arrays from the given nodes and edges and create the router.
+        Restricted edges are added to the given restrictions.
+        """
         edges = {(edge.from_node, edge.to_node): edge for edge in edges}
 
-        # build graph matrix
-        graph = np.full(shape=(len(nodes), len(nodes)), fill_value=np.inf, dtype=np.float32)
-        for edge in edges.values():
-            index = (edge.from_node, edge.to_node)
-            graph[index] = edge.distance
-            waytype = waytypes[edge.waytype]
-            (waytype.upwards_indices if edge.rise > 0 else waytype.nonupwards_indices).append(index)
+        # build sparse graph matrix, edges are stored in CSR order (sorted by from node, then to node)
+        edges_list = tuple(edges.values())
+        edge_from = np.fromiter((edge.from_node for edge in edges_list), dtype=np.int32, count=len(edges_list))
+        edge_to = np.fromiter((edge.to_node for edge in edges_list), dtype=np.int32, count=len(edges_list))
+        edge_order = np.lexsort((edge_to, edge_from))
+        edges_list = tuple(edges_list[i] for i in edge_order)
+        edge_from = edge_from[edge_order]
+        edge_to = edge_to[edge_order]
+
+        edge_distances = np.fromiter((edge.distance for edge in edges_list),
+                                     dtype=np.float32, count=len(edges_list))
+        edge_restrictions = np.fromiter((edge.access_restriction or 0 for edge in edges_list),
+                                        dtype=np.uint32, count=len(edges_list))
+        edge_waytypes = np.fromiter((edge.waytype for edge in edges_list), dtype=np.uint32, count=len(edges_list))
+        edge_rises = np.fromiter((np.nan if edge.rise is None else edge.rise for edge in edges_list),
+                                 dtype=np.float32, count=len(edges_list))
+
+        for i, edge in enumerate(edges_list):
             if edge.access_restriction:
-                restrictions.setdefault(edge.access_restriction, RouterRestriction()).edges.append(index)
+                restrictions.setdefault(edge.access_restriction, RouterRestriction()).edges.append(i)
 
         # respect slow_down_factor
+        graph_data = edge_distances.copy()
         for area in areas.values():
             if area.slow_down_factor != 1:
-                area_nodes = np.array(tuple(area.nodes), dtype=np.uint32)
-                graph[area_nodes.reshape((-1, 1)), area_nodes] *= float(area.slow_down_factor)
+                area_nodes = np.zeros(len(nodes), dtype=np.bool_)
+                area_nodes[np.array(tuple(area.nodes), dtype=np.uint32)] = True
+                graph_data[area_nodes[edge_from] & area_nodes[edge_to]] *= float(area.slow_down_factor)
 
-        # finalize waytype matrixes
-        for waytype in waytypes:
-            waytype.upwards_indices = np.array(waytype.upwards_indices, dtype=np.uint32).reshape((-1, 2))
-            waytype.nonupwards_indices = np.array(waytype.nonupwards_indices, dtype=np.uint32).reshape((-1, 2))
+        indptr = np.searchsorted(edge_from, np.arange(len(nodes)+1, dtype=np.int32)).astype(np.int32)
+        graph = csr_matrix((graph_data, edge_to, indptr), shape=(len(nodes), len(nodes)))
 
-        # finalize restriction edge matrixes
+        # finalize restriction edge arrays
         for restriction in restrictions.values():
-            restriction.edges = np.array(restriction.edges, dtype=np.uint32).reshape((-1, 2))
+            restriction.edges = np.array(restriction.edges, dtype=np.uint32)
 
-        router = cls(
+        return cls(
             levels=levels,
             spaces=spaces,
             areas=areas,
             pois=pois,
             groups=groups,
             restrictions=restrictions,
-            nodes=nodes,
-            edges=edges,
+            nodes=RouterNodes.from_nodes(nodes),
             waytypes=waytypes,
-            graph=graph
+            graph=graph,
+            edge_waytypes=edge_waytypes,
+            edge_rises=edge_rises,
+            edge_distances=edge_distances,
+            edge_restrictions=edge_restrictions,
         )
-        pickle.dump(router, open(cls.build_filename(update), 'wb'))
-        return router
+
+    def build_contraction_hierarchies(self):
+        """
+        Build a contraction hierarchy for each routing mode, for public routing with default route options.
+        """
+        restrictions = self.get_restrictions(AccessRestriction.get_all_public())
+        for mode in ('fastest', 'shortest'):
+            options = RouteOptions()
+            options['mode'] = mode
+            self.contraction_hierarchies[mode] = ContractionHierarchy.build(
+                self.get_graph(restrictions, options),
+                restrictions_key=restrictions.cache_key,
+                options_key=options.serialize_string(),
+            )
 
     @classmethod
     def build_filename(cls, update):
         return settings.CACHE_ROOT / MapUpdate.build_cache_key(*update) / 'router.pickle'
 
+    @classmethod
+    def build_arrays_dirname(cls, update):
+        return settings.CACHE_ROOT / MapUpdate.build_cache_key(*update) / 'router'
+
+    @classmethod
+    def build_geometries_filename(cls, update):
+        return settings.CACHE_ROOT / MapUpdate.build_cache_key(*update) / 'router_geometries.pickle'
+
+    @classmethod
+    def load_geometries(cls, update) -> dict[int, "RouterSpaceGeometries"]:
+        try:
+            return pickle.load(open(cls.build_geometries_filename(update), 'rb'))
+        except (FileNotFoundError, EOFError):
+            return {}
+
+    @classmethod
+    def build_space_nodes_filename(cls, update):
+        return settings.CACHE_ROOT / MapUpdate.build_cache_key(*update) / 'router_space_nodes.pickle'
+
+    @classmethod
+    def load_space_nodes(cls, update) -> dict[int, "RouterSpaceNodes"]:
+        try:
+            return pickle.load(open(cls.build_space_nodes_filename(update), 'rb'))
+        except (FileNotFoundError, EOFError):
+            return {}
+
+    @classmethod
+    def build_contraction_hierarchies_filename(cls, update):
+        return settings.CACHE_ROOT / MapUpdate.build_cache_key(*update) / 'router_ch.pickle'
+
+    def save(self, update):
+        dirname = self.build_arrays_dirname(update)
+        dirname.mkdir(exist_ok=True)
+        for name, array in self.get_arrays().items():
+            np.save(dirname / ('%s.npy' % name), np.ascontiguousarray(array))
+        pickle.dump(self, open(self.build_filename(update), 'wb'))
+
     @classmethod
     def load_nocache(cls, update):
-        return pickle.load(open(cls.build_filename(update), 'rb'))
+        return cls.load_files(cls.build_filename(update), cls.build_arrays_dirname(update),
+                              cls.build_contraction_hierarchies_filename(update))
+
+    @classmethod
+    def load_files(cls, filename, arrays_dirname, contraction_hierarchies_filename=None):
+        router = pickle.load(open(filename, 'rb'))
+
+        # memory-map all arrays read-only, so all worker processes share them through the page cache
+        router.set_arrays({
+            name.removesuffix('.npy'): np.load(arrays_dirname / name, mmap_mode='r')
+            for name in os.listdir(arrays_dirname) if name.endswith('.npy')
+        })
+
+        router.contraction_hierarchies = {}
+        if contraction_hierarchies_filename is not None:
+            try:
+                router.contraction_hierarchies = pickle.load(open(contraction_hierarchies_filename, 'rb'))
+            except FileNotFoundError:
+                pass
+        return router
 
     cached = LocalContext()
 
@@ -392,21 +648,36 @@ class Router:
             raise LocationUnreachable
         return result
 
+    @cached_property
+    def space_trees(self) -> dict[int, tuple[np.ndarray, np.ndarray, STRtree]]:
+        """ space ids, space geometries and a spatial index over them for each level """
+        result = {}
+        for level in self.levels.values():
+            space_ids = np.array(sorted(level.spaces), dtype=np.int64)
+            space_geometries = np.array(tuple(unwrap_geom(self.spaces[space].geometry) for space in space_ids.tolist()),
+                                        dtype=object)
+            result[level.pk] = (space_ids, space_geometries, STRtree(space_geometries))
+        return result
+
     def space_for_point(self, level: int, point: PointCompatible, restrictions, max_distance=20) -> Optional['RouterSpace']:
         point = Point(point.x, point.y)
-        level = self.levels[level]
+        space_ids, space_geometries, tree = self.space_trees[level]
         excluded_spaces = restrictions.spaces if restrictions else ()
-        for space in level.spaces:
-            if space in excluded_spaces:
-                continue
-            if self.spaces[space].geometry_prep.contains(point):
+
+        candidates = np.sort(tree.query(point, predicate='within'))
+        for space in space_ids[candidates].tolist():
+            if space not in excluded_spaces:
                 return self.spaces[space]
-        spaces = (self.spaces[space] for space in level.spaces if space not in excluded_spaces)
-        spaces = ((space, space.geometry.distance(point)) for space in spaces)
-        spaces = tuple((space, distance) for space, distance in spaces if distance < max_distance)
-        if not spaces:
+
+        candidates = tree.query(point, predicate='dwithin', distance=max_distance)
+        if excluded_spaces:
+            candidates = candidates[~np.isin(space_ids[candidates], tuple(excluded_spaces))]
+        if not candidates.size:
+            return None
+        distances = shapely.distance(space_geometries[candidates], point)
+        if distances.min() >= max_distance:
             return None
-        return min(spaces, key=operator.itemgetter(1))[0]
+        return self.spaces[int(space_ids[candidates[distances.argmin()]])]
 
     def altitude_for_point(self, space: int, point: PointCompatible) -> float:
         return self.spaces[space].altitudearea_for_point(point).get_altitude(point)
@@ -453,114 +724,333 @@ class Router:
                                          areas=areas, near_area=near_area, near_poi=near_poi, nearby=nearby)
 
     @cached_property
-    def shortest_path_func(self):
+    def dijkstra_func(self):
         # this is effectively a lazy import to save memory… todo: do we need that?
-        from scipy.sparse.csgraph import shortest_path
-        return shortest_path
-
-    def shortest_path(self, restrictions, options):
-        options_key = options.serialize_string()
-        cache_key = 'router:shortest_path:%s:%s:%s' % (MapUpdate.current_processed_cache_key(),
-                                                       restrictions.cache_key,
-                                                       options_key)
-        result = cache.get(cache_key)
-        if result:
-            distances, predecessors = result
-            return (np.frombuffer(distances, dtype=np.float64).reshape(self.graph.shape),
-                    np.frombuffer(predecessors, dtype=np.int32).reshape(self.graph.shape))
-
-        graph = self.graph.copy()
+        from scipy.sparse.csgraph import dijkstra
+        return dijkstra
+
+    @cached_property
+    def edge_from(self) -> np.ndarray:
+        """ origin node of every edge in the graph, in CSR order """
+        return np.repeat(np.arange(self.graph.shape[0], dtype=np.int32), np.diff(self.graph.indptr))
+
+    def nodes_mask(self, nodes) -> np.ndarray:
+        mask = np.zeros(self.graph.shape[0], dtype=np.bool_)
+        mask[np.fromiter(nodes, dtype=np.uint32)] = True
+        return mask
+
+    def get_restriction_masks(self, restrictions: "RouterRestrictionSet") -> "RouterRestrictionMasks":
+        """
+        Get the node and edge masks for the given restrictions.
+        They are calculated once per restriction set, and restriction sets are memoized by get_restrictions.
+        """
+        if restrictions.masks is None:
+            space_nodes = self.nodes_mask(chain.from_iterable(self.spaces[space].nodes
+                                                              for space in restrictions.spaces))
+            additional_nodes = self.nodes_mask(restrictions.additional_nodes)
+            excluded_nodes = space_nodes | additional_nodes
+            excluded_edges = excluded_nodes[self.edge_from] | excluded_nodes[self.graph.indices]
+            excluded_edges[restrictions.edges] = True
+            for mask in (space_nodes, additional_nodes, excluded_edges):
+                mask.flags.writeable = False
+            restrictions.masks = RouterRestrictionMasks(space_nodes=space_nodes, additional_nodes=additional_nodes,
+                                                        excluded_edges=excluded_edges)
+        return restrictions.masks
+
+    def get_graph(self, restrictions, options) -> csr_matrix:
+        """
+        Get the sparse graph with edge weights for the given restrictions and route options.
+        """
+        return self.get_weighted_graph(restrictions, options).graph
+
+    @cached_property
+    def weighted_graphs(self) -> OrderedDict[tuple[str, str], "RouterWeightedGraph"]:
+        return OrderedDict()
+
+    def get_weighted_graph(self, restrictions, options) -> "RouterWeightedGraph":
+        """
+        Get the weighted graph for the given restrictions and route options.
+        Weighted graphs are memoized, the least recently used ones are dropped.
+        """
+        cache_key = (restrictions.cache_key, options.serialize_string())
+        weighted_graph = self.weighted_graphs.get(cache_key)
+        if weighted_graph is not None:
+            self.weighted_graphs.move_to_end(cache_key)
+            return weighted_graph
+
+        weighted_graph = self.build_weighted_graph(restrictions, options)
+        self.weighted_graphs[cache_key] = weighted_graph
+        while len(self.weighted_graphs) > settings.ROUTING_GRAPH_CACHE_SIZE:
+            self.weighted_graphs.popitem(last=False)
+        return weighted_graph
+
+    def build_weighted_graph(self, restrictions, options) -> "RouterWeightedGraph":
+        """
+        Build the weighted graph for the given restrictions and route options.
+        All operations work on the per-edge arrays, so this scales with the number of edges.
+        """
+        data = self.graph.data.astype(np.float64)
+        upwards = self.edge_rises > 0
 
         # speeds of waytypes, if relevant
         if options['mode'] == 'fastest':
-            self.waytypes[0].speed = 1
-            self.waytypes[0].speed_up = 1
-            self.waytypes[0].extra_seconds = 0
-            self.waytypes[0].walk = True
-
-            for waytype in self.waytypes:
-                speed = float(waytype.speed)
-                speed_up = float(waytype.speed_up)
+            speeds = np.ones(len(self.waytypes), dtype=np.float64)
+            speeds_up = np.ones(len(self.waytypes), dtype=np.float64)
+            extra_seconds = np.zeros(len(self.waytypes), dtype=np.float64)
+            for i, waytype in enumerate(self.waytypes):
+                if not waytype.src:
+                    speeds[i] *= options.walk_factor
+                    speeds_up[i] *= options.walk_factor
+                    continue
+                speeds[i] = float(waytype.speed)
+                speeds_up[i] = float(waytype.speed_up)
                 if waytype.walk:
-                    speed *= options.walk_factor
-                    speed_up *= options.walk_factor
+                    speeds[i] *= options.walk_factor
+                    speeds_up[i] *= options.walk_factor
+                if waytype.extra_seconds:
+                    extra_seconds[i] = int(waytype.extra_seconds)
 
-                for indices, dir_speed in ((waytype.nonupwards_indices, speed), (waytype.upwards_indices, speed_up)):
-                    indices = tuple(indices.transpose().tolist())
-                    values = graph[indices]
-                    values /= dir_speed
-                    if waytype.extra_seconds:
-                        values += int(waytype.extra_seconds)
-                    graph[indices] = values
+            data /= np.where(upwards, speeds_up[self.edge_waytypes], speeds[self.edge_waytypes])
+            data += extra_seconds[self.edge_waytypes]
 
         # avoid waytypes as specified in settings
-        for waytype in self.waytypes[1:]:
+        avoid_up = np.zeros(len(self.waytypes), dtype=np.bool_)
+        avoid_down = np.zeros(len(self.waytypes), dtype=np.bool_)
+        for i, waytype in enumerate(self.waytypes[1:], start=1):
             value = options.get('waytype_%s' % waytype.pk, 'allow')
-            if value in ('avoid', 'avoid_up'):
-                graph[tuple(waytype.upwards_indices.transpose().tolist())] *= 100000
-            if value in ('avoid', 'avoid_down'):
-                graph[tuple(waytype.nonupwards_indices.transpose().tolist())] *= 100000
+            avoid_up[i] = value in ('avoid', 'avoid_up')
+            avoid_down[i] = value in ('avoid', 'avoid_down')
+        data[np.where(upwards, avoid_up[self.edge_waytypes], avoid_down[self.edge_waytypes])] *= 100000
 
         # prefer/avoid restrictions
         restrictions_setting = options.get("restrictions", "normal")
         if restrictions_setting != "normal":
             if restrictions_setting == "avoid":
-                factor = 100000
+                factor = 100000.0
             else:
-                graph *= 100000
+                data *= 100000
                 factor = 1/100000
-            all_restrictions = RouterRestrictionSet(self.restrictions)
-            space_nodes = tuple(reduce(operator.or_, (self.spaces[space].nodes
-                                                      for space in all_restrictions.spaces), set()))
-            graph[space_nodes, :] *= factor
-            graph[:, space_nodes] *= factor
+            space_nodes = self.get_restriction_masks(self.get_restrictions(set())).space_nodes
+            data *= factor ** (space_nodes[self.edge_from].astype(np.int8) + space_nodes[self.graph.indices])
             if restrictions.additional_nodes:
-                graph[tuple(restrictions.additional_nodes), :] *= factor
-                graph[:, tuple(restrictions.additional_nodes)] *= factor
-            graph[tuple(restrictions.edges.transpose().tolist())] *= factor
+                additional_nodes = self.get_restriction_masks(restrictions).additional_nodes
+                data *= factor ** (additional_nodes[self.edge_from].astype(np.int8)
+                                   + additional_nodes[self.graph.indices])
+            data[restrictions.edges] *= factor
 
         # exclude spaces and edges
-        space_nodes = tuple(reduce(operator.or_, (self.spaces[space].nodes for space in restrictions.spaces), set()))
-        graph[space_nodes, :] = np.inf
-        graph[:, space_nodes] = np.inf
-        if restrictions.additional_nodes:
-            graph[tuple(restrictions.additional_nodes), :] = np.inf
-            graph[:, tuple(restrictions.additional_nodes)] = np.inf
-        graph[tuple(restrictions.edges.transpose().tolist())] = np.inf
-
-        distances, predecessors = self.shortest_path_func(graph, directed=True, return_predecessors=True)
-        cache.set(cache_key, (distances.astype(np.float64).tobytes(),
-                              predecessors.astype(np.int32).tobytes()), 600)
-        return distances, predecessors
+        included = ~self.get_restriction_masks(restrictions).excluded_edges
+        graph = csr_matrix((data[included], (self.edge_from[included], self.graph.indices[included])),
+                           shape=self.graph.shape)
+
+        # lowest weight per meter, to get a lower bound for the weight of a path from the straight line distance
+        distances = self.edge_distances[included]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights_per_distance = data[included] / distances
+        min_weight_per_distance = float(weights_per_distance[distances > 0].min(initial=np.inf))
+        return RouterWeightedGraph(graph=graph, min_weight_per_distance=min_weight_per_distance)
+
+    def shortest_path(self, origin_nodes: np.ndarray, destination_nodes: np.ndarray,
+                      restrictions, options) -> tuple[int, int, tuple[int, ...]]:
+        """
+        Find the shortest path from any of the origin nodes to any of the destination nodes.
+        This runs a single multi-source dijkstra starting at all origin nodes at once, so only one distance and
+        predecessor array of the size of the graph is needed per query instead of the full all-pairs matrix.
+        If there is a contraction hierarchy for these restrictions and options, it's used instead.
+        Returns the origin node, destination node and the nodes along the path.
+        """
+        hierarchy = self.contraction_hierarchies.get(options['mode'])
+        if hierarchy is not None and hierarchy.can_handle(restrictions.cache_key, options.serialize_string()):
+            result = hierarchy.query(origin_nodes, destination_nodes)
+            if result is None:
+                raise NoRouteFound
+            return result
+
+        weighted_graph = self.get_weighted_graph(restrictions, options)
+
+        # dijkstra only settles nodes up to the limit, which starts at a lower bound for the path weight and grows
+        # until a destination is reached, so the search doesn't explore the whole graph for short routes.
+        # distances within the limit are exact, so the nearest reached destination is the nearest one overall.
+        origin_xyz = self.nodes.xyz[origin_nodes]
+        destination_xyz = self.nodes.xyz[destination_nodes]
+        bbox_gap = np.maximum(0, np.maximum(origin_xyz.min(axis=0) - destination_xyz.max(axis=0),
+                                            destination_xyz.min(axis=0) - origin_xyz.max(axis=0)))
+        limit = max(float(np.linalg.norm(bbox_gap)) * weighted_graph.min_weight_per_distance * 2, 1.0)
+        num_reached = 0
+        while True:
+            distances, predecessors, sources = self.dijkstra_func(weighted_graph.graph, directed=True,
+                                                                  indices=origin_nodes, return_predecessors=True,
+                                                                  min_only=True, limit=limit)
+            destination_node = int(destination_nodes[distances[destination_nodes].argmin()])
+            if distances[destination_node] != np.inf:
+                break
+            if limit == np.inf:
+                raise NoRouteFound
+            # if no new nodes were reached, remaining nodes can only be behind heavy edges, search without limit
+            last_num_reached, num_reached = num_reached, int(np.isfinite(distances).sum())
+            limit = np.inf if num_reached == last_num_reached else limit * 4
+        origin_node = int(sources[destination_node])
+
+        return origin_node, destination_node, self.recreate_path(predecessors, origin_node, destination_node)
 
-    def get_restrictions(self, permissions: set[int]) -> "RouterRestrictionSet":
-        return RouterRestrictionSet({
-            pk: restriction for pk, restriction in self.restrictions.items() if pk not in permissions
-        })
+    @staticmethod
+    def recreate_path(predecessors: np.ndarray, origin_node: int, destination_node: int) -> tuple[int, ...]:
+        path_nodes = deque((destination_node, ))
+        last_node = destination_node
+        while last_node != origin_node:
+            last_node = int(predecessors[last_node])
+            path_nodes.appendleft(last_node)
+        return tuple(path_nodes)
 
-    def get_route(self, origin: Location, destination: Location, permissions: set[int],
-                  options: RouteOptions, visible_locations: Mapping[int, Location]):
+    @cached_property
+    def edge_keys(self) -> np.ndarray:
+        """ from_node*num_nodes+to_node for every edge, sorted because edges are in CSR order """
+        return self.edge_from.astype(np.int64) * self.graph.shape[0] + self.graph.indices
+
+    def get_path_edges(self, path_nodes: Sequence[int]) -> np.ndarray:
+        """ indices of all edges along the given path """
+        path_nodes = np.array(path_nodes, dtype=np.int64)
+        return np.searchsorted(self.edge_keys, path_nodes[:-1] * self.graph.shape[0] + path_nodes[1:])
+
+    def get_edge_durations(self, walk_factor: float) -> np.ndarray:
+        """ duration in seconds for every edge, calculated like RouterWayType.get_duration does """
+        speeds = np.array(tuple((float(waytype.speed) if waytype.src else 1) for waytype in self.waytypes))
+        speeds_up = np.array(tuple((float(waytype.speed_up) if waytype.src else 1) for waytype in self.waytypes))
+        extra_seconds = np.array(tuple((float(waytype.extra_seconds) if waytype.src else 0)
+                                       for waytype in self.waytypes))
+        return (
+            self.edge_distances / (np.where(self.edge_rises > 0, speeds_up[self.edge_waytypes],
+                                            speeds[self.edge_waytypes]) * walk_factor)
+            + extra_seconds[self.edge_waytypes]
+        )
+
+    def get_route_matrix(self, origins: Sequence[Location], destinations: Sequence[Location], permissions: set[int],
+                         options: RouteOptions) -> "RouteMatrix":
+        """
+        Calculate distances and durations from every origin to every destination, without route descriptions.
+        Only one multi-source dijkstra is needed per origin. Unreachable pairs are nan.
+        """
         restrictions = self.get_restrictions(permissions)
+        graph = self.get_graph(restrictions, options)
+        edge_durations = self.get_edge_durations(options.walk_factor)
+        walk_factor = options.walk_factor
+
+        def get_locations_or_none(location: Location) -> Optional[RouterLocation]:
+            try:
+                return self.get_locations(location, restrictions)
+            except (LocationUnreachable, NotYetRoutable):
+                return None
+
+        destination_locations = tuple(
+            (locations, np.array(tuple(locations.nodes), dtype=np.int32)) if locations else (None, None)
+            for locations in (get_locations_or_none(destination) for destination in destinations)
+        )
 
-        # get possible origins and destinations
-        origins = self.get_locations(origin, restrictions)
-        destinations = self.get_locations(destination, restrictions)
+        def get_addition(location: RouterPoint, node: int) -> tuple[float, float]:
+            # distance and duration between a location and its node, like Route.serialize calculates it
+            distance = duration = 0
+            node_xyz = self.nodes.xyz[node]
+            addition = location.nodes_addition.get(node)
+            if addition and addition.edge:
+                distance += addition.edge.distance
+                duration += self.waytypes[addition.edge.waytype].get_duration(addition.edge, walk_factor)
+                node_xyz = addition.node.xyz
+            if isinstance(location, RouterPoint):
+                location_distance = np.linalg.norm(node_xyz - location.xyz)
+                distance += location_distance
+                duration += location_distance * walk_factor
+            return distance, duration
+
+        distances = np.full((len(origins), len(destinations)), np.nan)
+        durations = np.full((len(origins), len(destinations)), np.nan)
+        for i, origin in enumerate(origins):
+            origin_locations = get_locations_or_none(origin)
+            if origin_locations is None:
+                continue
+            node_distances, predecessors, sources = self.dijkstra_func(
+                graph, directed=True, indices=np.array(tuple(origin_locations.nodes), dtype=np.int32),
+                return_predecessors=True, min_only=True
+            )
+            for j, (locations, destination_nodes) in enumerate(destination_locations):
+                if locations is None:
+                    continue
+                destination_node = int(destination_nodes[node_distances[destination_nodes].argmin()])
+                if node_distances[destination_node] == np.inf:
+                    continue
+                origin_node = int(sources[destination_node])
+                path_edges = self.get_path_edges(self.recreate_path(predecessors, origin_node, destination_node))
+                origin_distance, origin_duration = get_addition(
+                    origin_locations.get_location_for_node(origin_node), origin_node
+                )
+                destination_distance, destination_duration = get_addition(
+                    locations.get_location_for_node(destination_node), destination_node
+                )
+                distances[i, j] = self.edge_distances[path_edges].sum() + origin_distance + destination_distance
+                durations[i, j] = edge_durations[path_edges].sum() + origin_duration + destination_duration
 
-        # calculate shortest path matrix
-        distances, predecessors = self.shortest_path(restrictions, options=options)
+        return RouteMatrix(distances=distances, durations=durations)
 
-        # find shortest path for our origins and destinations
-        origin_nodes = np.array(tuple(origins.nodes))
-        destination_nodes = np.array(tuple(destinations.nodes))
-        origin_node, destination_node = np.unravel_index(
-            distances[origin_nodes.reshape((-1, 1)), destination_nodes].argmin(),
-            (len(origin_nodes), len(destination_nodes))
+    @cached_property
+    def restriction_sets(self) -> OrderedDict[str, "RouterRestrictionSet"]:
+        """ least recently used restriction sets by their cache key """
+        return OrderedDict()
+
+    def get_restrictions(self, permissions: set[int]) -> "RouterRestrictionSet":
+        restricted = sorted(pk for pk in self.restrictions if pk not in permissions)
+        cache_key = RouterRestrictionSet.build_cache_key(restricted)
+        restrictions = self.restriction_sets.get(cache_key)
+        if restrictions is not None:
+            self.restriction_sets.move_to_end(cache_key)
+            return restrictions
+
+        restrictions = RouterRestrictionSet({pk: self.restrictions[pk] for pk in restricted}, cache_key=cache_key)
+        self.restriction_sets[cache_key] = restrictions
+        while len(self.restriction_sets) > settings.ROUTING_RESTRICTION_CACHE_SIZE:
+            self.restriction_sets.popitem(last=False)
+        return restrictions
+
+    def get_route_locations(self, origin: Location, destination: Location,
+                            permissions: set[int]) -> "RouteLocations":
+        """ get restrictions and possible origins and destinations for a route query """
+        restrictions = self.get_restrictions(permissions)
+        return RouteLocations(
+            restrictions=restrictions,
+            origins=self.get_locations(origin, restrictions),
+            destinations=self.get_locations(destination, restrictions),
         )
-        origin_node = origin_nodes[origin_node]
-        destination_node = destination_nodes[destination_node]
 
-        if distances[origin_node, destination_node] == np.inf:
-            raise NoRouteFound
+    @staticmethod
+    def get_route_cache_key(locations: "RouteLocations", options: RouteOptions) -> Optional[str]:
+        """
+        Fingerprint of a route query, built from the restrictions, the route options and the possible origins and
+        destinations with their nodes. Returns None if the route should not be cached.
+        """
+        key = hashlib.blake2b(digest_size=16)
+        key.update(('%s;%s;' % (locations.restrictions.cache_key, options.serialize_string())).encode())
+        for route_location in (locations.origins, locations.destinations):
+            for location in route_location.locations:
+                if isinstance(location.src, CustomLocationProxyMixin):
+                    # positions move all the time
+                    return None
+                key.update(('%s,' % location.pk).encode())
+            key.update(np.array(sorted(route_location.nodes), dtype=np.int64).tobytes())
+            key.update(b';')
+        return key.hexdigest()
+
+    def get_route(self, origin: Location, destination: Location, permissions: set[int],
+                  options: RouteOptions, visible_locations: Mapping[int, Location],
+                  locations: Optional["RouteLocations"] = None):
+        if locations is None:
+            locations = self.get_route_locations(origin, destination, permissions)
+        restrictions, origins, destinations = locations
+
+        # find shortest path for our origins and destinations
+        origin_node, destination_node, path_nodes = self.shortest_path(
+            origin_nodes=np.array(tuple(origins.nodes), dtype=np.int32),
+            destination_nodes=np.array(tuple(destinations.nodes), dtype=np.int32),
+            restrictions=restrictions,
+            options=options,
+        )
 
         # get best origin and destination
         origin = origins.get_location_for_node(origin_node)
@@ -569,18 +1059,11 @@ class Router:
         if origin is None or destination is None:
             raise ValueError
 
-        # recreate path
-        path_nodes = deque((destination_node, ))
-        last_node = destination_node
-        while last_node != origin_node:
-            last_node = predecessors[origin_node, last_node]
-            path_nodes.appendleft(last_node)
-
         return Route(
             router=self,
             origin=origin,
             destination=destination,
-            path_nodes=tuple(path_nodes),
+            path_nodes=path_nodes,
             options=options,
             origin_addition=origin.nodes_addition.get(origin_node),
             destination_addition=destination.nodes_addition.get(destination_node),
@@ -590,6 +1073,116 @@ class Router:
         )
 
 
+class RouterWeightedGraph(NamedTuple):
+    graph: csr_matrix
+    min_weight_per_distance: float
+
+
+class RouteMatrix(NamedTuple):
+    distances: np.ndarray
+    durations: np.ndarray
+
+
+@dataclass
+class RouterSpaceGeometries:
+    """
+    Geometries derived from a space and its related objects.
+    These are kept between router rebuilds and only recalculated if the geometries they are based on changed.
+    """
+    key: bytes
+    accessible_geom: Polygon | MultiPolygon
+    obstacles_geom: Polygon | MultiPolygon
+    clear_geom: Polygon | MultiPolygon
+    altitudeareas: dict[bytes, tuple[tuple[Polygon, Polygon | MultiPolygon], ...]] = field(default_factory=dict)
+    previous_altitudeareas: dict[bytes, tuple[tuple[Polygon, Polygon | MultiPolygon], ...]] | None = None
+
+    @staticmethod
+    def build_key(*parts: bytes | Polygon | MultiPolygon) -> bytes:
+        key = hashlib.sha256()
+        for part in parts:
+            data = part if isinstance(part, bytes) else unwrap_geom(part).wkb
+            key.update(len(data).to_bytes(8, 'little'))
+            key.update(data)
+        return key.digest()
+
+    @property
+    def reused(self) -> bool:
+        return self.previous_altitudeareas is not None
+
+    def get_altitudearea_geometries(self, key: bytes, altitudearea_geom: Polygon | MultiPolygon):
+        """
+        Get accessible and clear geometries of this space within the given altitude area.
+        """
+        result = (self.previous_altitudeareas or {}).get(key)
+        if result is None:
+            result = []
+            for subgeom in assert_multipolygon(self.accessible_geom.intersection(altitudearea_geom)):
+                if subgeom.is_empty:
+                    continue
+                area_clear_geom = unary_union(tuple(get_rings(subgeom.difference(self.obstacles_geom))))
+                if area_clear_geom.is_empty:
+                    continue
+                result.append((subgeom, area_clear_geom))
+            result = tuple(result)
+        self.altitudeareas[key] = result
+        return result
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result['previous_altitudeareas'] = None
+        return result
+
+
+@dataclass
+class RouterSpaceNodes:
+    """
+    Node data derived from a space, its graph nodes, areas, altitude areas, points of interest and columns.
+    Like the space geometries, this is kept between router rebuilds and only recalculated if its sources changed.
+    Node indices are global, based on the space nodes starting at the given offset.
+    """
+    key: bytes
+    offset: int
+    altitudes: tuple[float, ...]
+    node_areas: tuple[frozenset[int], ...]
+    area_nodes: dict[int, frozenset[int]]
+    altitudeareas: tuple["RouterAltitudeArea", ...]
+    pois: dict[int, tuple[float | None, NodeConnectionsByNode]]
+    column_nodes: tuple[tuple[int, frozenset[int]], ...]
+
+    def moved(self, offset: int) -> "RouterSpaceNodes":
+        """
+        Get this node data with all node indices moved to the given offset.
+        """
+        delta = offset - self.offset
+        if not delta:
+            return self
+
+        def move_connections(connections: NodeConnectionsByNode) -> NodeConnectionsByNode:
+            return {
+                node + delta: RouterNodeAndEdge(
+                    node=connection.node,
+                    edge=None if connection.edge is None else replace(connection.edge,
+                                                                      to_node=connection.edge.to_node + delta),
+                )
+                for node, connection in connections.items()
+            }
+
+        return replace(
+            self,
+            offset=offset,
+            area_nodes={pk: frozenset(node + delta for node in area_nodes)
+                        for pk, area_nodes in self.area_nodes.items()},
+            altitudeareas=tuple(
+                replace(area, nodes=frozenset(node + delta for node in area.nodes),
+                        fallback_nodes=move_connections(area.fallback_nodes), nodes_tree=None)
+                for area in self.altitudeareas
+            ),
+            pois={pk: (altitude, move_connections(poi_nodes)) for pk, (altitude, poi_nodes) in self.pois.items()},
+            column_nodes=tuple((restriction_id, frozenset(node + delta for node in column_nodes))
+                               for restriction_id, column_nodes in self.column_nodes),
+        )
+
+
 CustomLocationDescription = namedtuple('CustomLocationDescription', ('space', 'altitude',
                                                                      'areas', 'near_area', 'near_poi', 'nearby'))
 
@@ -701,6 +1294,7 @@ class RouterAltitudeArea:
     points: Sequence[AltitudeAreaPoint]
     nodes: frozenset[int] = field(default_factory=frozenset)
     fallback_nodes: NodeConnectionsByNode = field(default_factory=dict)
+    nodes_tree: tuple[np.ndarray, np.ndarray, STRtree] | None = field(default=None, repr=False)
 
     @cached_property
     def geometry_prep(self):
@@ -711,31 +1305,47 @@ class RouterAltitudeArea:
         return prepared.prep(self.clear_geometry)
 
     def get_altitude(self, point: PointCompatible):
+        return self.get_altitudes((point.x, point.y))[0]
+
+    def get_altitudes(self, points) -> np.ndarray:
         # noinspection PyTypeChecker,PyCallByClass
-        return AltitudeArea.get_altitudes(self, (point.x, point.y))[0]
+        return AltitudeArea.get_altitudes(self, points)
+
+    def get_nodes_tree(self, all_nodes) -> tuple[np.ndarray, np.ndarray, STRtree]:
+        """ node ids, node coordinates and a spatial index over the nodes of this altitude area """
+        if self.nodes_tree is None:
+            node_ids = np.array(sorted(self.nodes), dtype=np.int64)
+            node_xy = np.array(tuple((all_nodes[node].x, all_nodes[node].y) for node in node_ids.tolist()),
+                               dtype=np.float64).reshape((-1, 2))
+            shapely.prepare(self.clear_geometry)
+            self.nodes_tree = (node_ids, node_xy, STRtree(shapely.points(node_xy)))
+        return self.nodes_tree
 
     def nodes_for_point(self, point: PointCompatible, all_nodes) -> NodeConnectionsByNode:
         point = Point(point.x, point.y)
 
-        nodes = {}
-        if self.nodes:
-            for node in self.nodes:
-                node = all_nodes[node]
-                line = LineString([(node.x, node.y), (point.x, point.y)])
-                if line.length < 10 and not self.clear_geometry_prep.intersects(line):
-                    nodes[node.i] = RouterNodeAndEdge(node=None, edge=None)
-            if not nodes:
-                nearest_node = min(tuple(all_nodes[node] for node in self.nodes),
-                                   key=lambda node: point.distance(node.point))
-                nodes[nearest_node.i] = RouterNodeAndEdge(node=None, edge=None)
-        else:
-            nodes = self.fallback_nodes
+        if not self.nodes:
+            return self.fallback_nodes
+
+        node_ids, node_xy, tree = self.get_nodes_tree(all_nodes)
+        candidates = np.sort(tree.query(point, predicate='dwithin', distance=10))
+        lines = np.empty((len(candidates), 2, 2), dtype=np.float64)
+        lines[:, 0] = node_xy[candidates]
+        lines[:, 1] = (point.x, point.y)
+        lines = shapely.linestrings(lines)
+        connected = (shapely.length(lines) < 10) & ~shapely.intersects(self.clear_geometry, lines)
+
+        nodes = {node: RouterNodeAndEdge(node=None, edge=None) for node in node_ids[candidates[connected]].tolist()}
+        if not nodes:
+            nearest_node = int(node_ids[tree.nearest(point)])
+            nodes[nearest_node] = RouterNodeAndEdge(node=None, edge=None)
         return nodes
 
     def __getstate__(self):
         result = self.__dict__.copy()
         result.pop('geometry_prep', None)
         result.pop('clear_geometry_prep', None)
+        result['nodes_tree'] = None
         return result
 
 
@@ -792,11 +1402,76 @@ class RouterEdge:
         )
 
 
+class RouterNodes(Sequence[RouterNode]):
+    """
+    Read-only sequence of all graph nodes, backed by (usually memory-mapped) arrays.
+    RouterNode objects are created on access.
+    """
+    def __init__(self, pks: np.ndarray, spaces: np.ndarray, xyz: np.ndarray):
+        self.pks = pks
+        self.spaces = spaces
+        self.xyz = xyz
+
+    @classmethod
+    def from_nodes(cls, nodes: Sequence[RouterNode]) -> "RouterNodes":
+        return cls(
+            pks=np.fromiter((node.pk for node in nodes), dtype=np.uint32, count=len(nodes)),
+            spaces=np.fromiter((node.space for node in nodes), dtype=np.uint32, count=len(nodes)),
+            xyz=np.array(tuple((node.x, node.y, node.altitude) for node in nodes), dtype=np.float64).reshape((-1, 3)),
+        )
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self[j] for j in range(*i.indices(len(self))))
+        i = int(i)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        x, y, altitude = self.xyz[i].tolist()
+        return RouterNode(i=i, pk=int(self.pks[i]), x=x, y=y, space=int(self.spaces[i]), altitude=altitude)
+
+
+class RouterEdges(Mapping[EdgeIndex, RouterEdge]):
+    """
+    Read-only mapping of (from_node, to_node) to all graph edges, backed by the router's graph and edge arrays.
+    RouterEdge objects are created on access.
+    """
+    def __init__(self, router: Router):
+        self.router = router
+
+    def get_edge_index(self, key: EdgeIndex) -> int:
+        from_node, to_node = key
+        graph = self.router.graph
+        start, end = graph.indptr[from_node], graph.indptr[from_node+1]
+        i = start + np.searchsorted(graph.indices[start:end], to_node)
+        if i >= end or graph.indices[i] != to_node:
+            raise KeyError(key)
+        return int(i)
+
+    def __getitem__(self, key: EdgeIndex) -> RouterEdge:
+        i = self.get_edge_index(key)
+        rise = float(self.router.edge_rises[i])
+        return RouterEdge(
+            from_node=int(key[0]),
+            to_node=int(key[1]),
+            waytype=int(self.router.edge_waytypes[i]),
+            access_restriction=int(self.router.edge_restrictions[i]) or None,
+            rise=None if np.isnan(rise) else rise,
+            distance=float(self.router.edge_distances[i]),
+        )
+
+    def __iter__(self):
+        return zip(self.router.edge_from.tolist(), self.router.graph.indices.tolist())
+
+    def __len__(self):
+        return len(self.router.graph.indices)
+
+
 @dataclass
 class RouterWayType:
     src: WayType
-    upwards_indices: deque[EdgeIndex] = field(default_factory=deque)
-    nonupwards_indices: deque[EdgeIndex] = field(default_factory=deque)
 
     def __getattr__(self, name):
         if name in ('__getstate__', '__setstate__'):
@@ -831,16 +1506,40 @@ class RouterLocation:
         return None
 
 
+class RouteLocations(NamedTuple):
+    restrictions: "RouterRestrictionSet"
+    origins: RouterLocation
+    destinations: RouterLocation
+
+
 @dataclass
 class RouterRestriction:
     spaces: set[int] = field(default_factory=set)
     additional_nodes: set[int] = field(default_factory=set)
-    edges: deque[EdgeIndex] = field(default_factory=deque)
+    edges: deque[int] = field(default_factory=deque)
+
+
+class RouterRestrictionMasks(NamedTuple):
+    space_nodes: np.ndarray
+    additional_nodes: np.ndarray
+    excluded_edges: np.ndarray
 
 
 @dataclass
 class RouterRestrictionSet:
     restrictions: dict[int, RouterRestriction]
+    cache_key: str = None
+    masks: Optional[RouterRestrictionMasks] = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.cache_key is None:
+            self.cache_key = self.build_cache_key(self.restrictions)
+
+    @staticmethod
+    def build_cache_key(restriction_ids) -> str:
+        """ compact fingerprint of a set of restrictions, the same restrictions always give the same key """
+        return hashlib.blake2b(','.join(str(pk) for pk in sorted(restriction_ids)).encode(),
+                               digest_size=8).hexdigest()
 
     @cached_property
     def spaces(self) -> frozenset[int]:
@@ -852,15 +1551,11 @@ class RouterRestrictionSet:
                                      for restriction in self.restrictions.values()), frozenset())
 
     @cached_property
-    def edges(self):
+    def edges(self) -> np.ndarray:
+        """ indices of all restricted edges, in CSR order """
         if not self.restrictions:
-            return np.array((), dtype=np.uint32).reshape((-1, 2))
-        return np.vstack(tuple(restriction.edges for restriction in self.restrictions.values()))
-
-    @cached_property
-    def cache_key(self):
-        return '%s_%s' % ('-'.join(str(i) for i in self.spaces),
-                          '-'.join(str(i) for i in self.edges.flatten().tolist()))
+            return np.array((), dtype=np.uint32)
+        return np.concatenate(tuple(restriction.edges for restriction in self.restrictions.values()))
 
     def __contains__(self, pk):
         return pk in self.restrictions
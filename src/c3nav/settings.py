@@ -178,12 +178,45 @@ CACHE_SIZE_LOCATIONS = config.getint('c3nav', 'cache_size_locations', fallback=1
 CACHE_SIZE_API = config.getint('c3nav', 'cache_size_api', fallback=64)
 
 RENDER_SCALE = config.getfloat('c3nav', 'render_scale', fallback=20.0)
+# svg, raster (renders directly without building an svg document) or opengl
 IMAGE_RENDERER = config.get('c3nav', 'image_renderer', fallback='svg')
 SVG_RENDERER = config.get('c3nav', 'svg_renderer', fallback='rsvg-convert')
 
 CACHE_TILES = config.getboolean('c3nav', 'cache_tiles', fallback=not DEBUG)
+# directories (one directory per tile) or sqlite (single database file, identical tiles are stored once)
+TILE_STORE = config.get('c3nav', 'tile_store', fallback='directories')
+TILE_STORE_FILE = Path(config.get('c3nav', 'tile_store_file', fallback=str(TILES_ROOT / 'tiles.sqlite3')))
+# render blocks of n×n tiles at once and put all of them into the tile cache, 1 disables this
+TILE_METATILE_SIZE = config.getint('c3nav', 'tile_metatile_size', fallback=1)
+# prerender outdated tiles up to this zoom level after map updates, using this many worker processes
+TILE_PRERENDER = config.getboolean('c3nav', 'tile_prerender', fallback=False)
+TILE_PRERENDER_MAX_ZOOM = config.getint('c3nav', 'tile_prerender_max_zoom', fallback=2)
+TILE_PRERENDER_WORKERS = config.getint('c3nav', 'tile_prerender_workers', fallback=1)
+# access permission combinations to prerender tiles for, like "0; 1,2; 3", 0 means no permissions
+TILE_PRERENDER_ACCESS = config.get('c3nav', 'tile_prerender_access', fallback='0')
+# count tile requests in the cache, so the most popular tiles are prerendered first
+TILE_ACCESS_STATS = config.getboolean('c3nav', 'tile_access_stats', fallback=False)
 CACHE_PREVIEWS = config.getboolean('c3nav', 'cache_previews', fallback=not DEBUG)
 CACHE_RESOLUTION = config.getint('c3nav', 'cache_resolution', fallback=4)
+# number of worker processes to build the render data of levels and themes with during map update processing
+RENDER_DATA_WORKERS = config.getint('c3nav', 'render_data_workers', fallback=1)
+# size of the square chunks (in meters) that 2d render data is cut into so small tiles only load what they show
+# tiles up to twice this size are rendered from chunks, 0 disables chunks
+RENDER_CHUNK_SIZE = config.getint('c3nav', 'render_chunk_size', fallback=32)
+
+# build contraction hierarchies for public routing with default route options during router rebuild
+ROUTING_CONTRACTION_HIERARCHIES = config.getboolean('c3nav', 'routing_contraction_hierarchies', fallback=False)
+# number of distinct access permission sets whose restriction masks are kept in memory per router
+ROUTING_RESTRICTION_CACHE_SIZE = config.getint('c3nav', 'routing_restriction_cache_size', fallback=32)
+# number of weighted graphs (one per restrictions and route options) that are kept in memory per router
+ROUTING_GRAPH_CACHE_SIZE = config.getint('c3nav', 'routing_graph_cache_size', fallback=8)
+# seconds serialized routes are cached for, keyed by map update, restrictions, options and origin/destination
+# 0 disables the route cache
+ROUTE_CACHE_TIMEOUT = config.getint('c3nav', 'route_cache_timeout', fallback=900)
+# maximum number of origin/destination pairs in one route matrix request
+ROUTE_MATRIX_MAX_PAIRS = config.getint('c3nav', 'route_matrix_max_pairs', fallback=10000)
+# maximum number of scans in one batch positioning request
+POSITIONING_BATCH_MAX_SCANS = config.getint('c3nav', 'positioning_batch_max_scans', fallback=1000)
 
 COMPLIANCE_CHECKBOX = config.getboolean('c3nav', 'compliance_checkbox', fallback=False)
 
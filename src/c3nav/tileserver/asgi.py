@@ -0,0 +1,185 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import httpx
+
+from c3nav.tileserver.base import Response, TileRequest, TileServer, logger
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+class AsyncTileServer(TileServer):
+    """
+    ASGI variant of the tileserver.
+    Upstream requests use a connection pool, concurrent requests for the same tile share one upstream request
+    and the number of concurrent upstream requests is limited, further requests wait for a free slot.
+    Everything that blocks (memcached, the tile store, loading the cache package) runs in a thread pool,
+    so it doesn't stall the event loop.
+    """
+    def __init__(self):
+        super().__init__()
+        self.upstream_concurrency = int(os.environ.get('C3NAV_UPSTREAM_CONCURRENCY', 8))
+        self.upstream_timeout = float(os.environ.get('C3NAV_UPSTREAM_TIMEOUT', 30))
+
+        self.executor = ThreadPoolExecutor(max_workers=int(os.environ.get('C3NAV_WORKER_THREADS', 16)),
+                                           thread_name_prefix='tileserver')
+        self.local = threading.local()
+
+        # created on startup, since they belong to the event loop
+        self.client: Optional[httpx.AsyncClient] = None
+        self.upstream_semaphore: Optional[asyncio.Semaphore] = None
+        # concurrent first requests must not create multiple clients if the server doesn't send lifespan events
+        self.startup_lock = asyncio.Lock()
+        self.running_upstream_requests: dict[str, asyncio.Task] = {}
+
+        self.metrics = None
+        if prometheus_client is not None:
+            self.metrics = prometheus_client.CollectorRegistry(auto_describe=True)
+            self.tile_requests = prometheus_client.Counter(
+                'c3nav_tileserver_tile_requests', 'Tile requests by result (hit, miss, coalesced, not_modified)',
+                ['result'], registry=self.metrics
+            )
+            self.upstream_latency = prometheus_client.Histogram(
+                'c3nav_tileserver_upstream_seconds', 'Duration of upstream tile requests', registry=self.metrics
+            )
+            self.upstream_waiting = prometheus_client.Gauge(
+                'c3nav_tileserver_upstream_waiting', 'Tile requests waiting for a free upstream slot',
+                registry=self.metrics
+            )
+
+    @property
+    def cache(self):
+        # pylibmc clients can't be shared between the threads of the thread pool
+        cache = getattr(self.local, 'cache', None)
+        if cache is None:
+            cache = self.get_cache_client()
+            self.local.cache = cache
+        return cache
+
+    async def run_sync(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def count_request(self, result):
+        if self.metrics is not None:
+            self.tile_requests.labels(result).inc()
+
+    async def startup(self):
+        async with self.startup_lock:
+            if self.client is not None:
+                return
+            self.client = httpx.AsyncClient(
+                headers=self.auth_headers,
+                auth=self.http_auth_credentials,
+                limits=httpx.Limits(max_connections=self.upstream_concurrency,
+                                    max_keepalive_connections=self.upstream_concurrency),
+                timeout=self.upstream_timeout,
+            )
+            self.upstream_semaphore = asyncio.Semaphore(self.upstream_concurrency)
+
+    async def shutdown(self):
+        await self.client.aclose()
+        self.executor.shutdown(wait=False)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def metrics_response(self) -> Response:
+        if self.metrics is None:
+            return self.not_found(b'metrics are not available.')
+        data = prometheus_client.generate_latest(self.metrics)
+        return '200 OK', [self.get_date_header(),
+                          ('Content-Type', prometheus_client.CONTENT_TYPE_LATEST),
+                          ('Content-Length', str(len(data)))], data
+
+    async def fetch_upstream(self, tile: TileRequest) -> Response:
+        if self.metrics is not None:
+            self.upstream_waiting.inc()
+        async with self.upstream_semaphore:
+            if self.metrics is not None:
+                self.upstream_waiting.dec()
+            start = time.perf_counter()
+            try:
+                r = await self.client.get(self.upstream_base+tile.upstream_path)
+            except httpx.HTTPError as e:
+                logger.error('Upstream request failed: %s' % e)
+                error = b'upstream request failed'
+                return '502 Bad Gateway', [self.get_date_header(),
+                                           ('Content-Type', 'text/plain'),
+                                           ('Content-Length', str(len(error)))], error
+            finally:
+                if self.metrics is not None:
+                    self.upstream_latency.observe(time.perf_counter() - start)
+        return await self.run_sync(self.handle_upstream_response,
+                                   tile, r.status_code, r.reason_phrase, r.headers, r.content)
+
+    async def get_tile_response(self, tile: TileRequest) -> Response:
+        if self.client is None:
+            # the server didn't send lifespan events
+            await self.startup()
+
+        cached_result = await self.run_sync(self.get_cached_tile, tile)
+        if cached_result is not None:
+            self.count_request('hit')
+            return self.deliver_tile(tile.etag, cached_result)
+
+        # if this tile is already being requested upstream, wait for that request instead of making another one
+        running_request = self.running_upstream_requests.get(tile.cache_key)
+        if running_request is None:
+            self.count_request('miss')
+            # the upstream request runs on its own, so it isn't cancelled if the client that started it disconnects
+            running_request = asyncio.ensure_future(self.fetch_upstream(tile))
+            self.running_upstream_requests[tile.cache_key] = running_request
+            running_request.add_done_callback(lambda f: self.running_upstream_requests.pop(tile.cache_key, None))
+        else:
+            self.count_request('coalesced')
+        return await asyncio.shield(running_request)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        request_headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            request_headers[name] = request_headers[name]+'; '+value if name in request_headers else value
+
+        if scope['path'] == '/metrics':
+            result = self.metrics_response()
+        else:
+            result = await self.run_sync(self.handle_request, scope['path'], request_headers.get('cookie', None),
+                                         request_headers.get('if-none-match', None))
+            if isinstance(result, TileRequest):
+                result = await self.get_tile_response(result)
+            elif result[0].startswith('304'):
+                self.count_request('not_modified')
+
+        status, headers, body = result
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+application = AsyncTileServer()
@@ -0,0 +1,513 @@
+import base64
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import NamedTuple, Optional
+
+import pylibmc
+import requests
+from requests.auth import HTTPBasicAuth
+
+from c3nav.mapdata.utils.cache import CachePackage, TileStore
+from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, build_tile_etag, get_tile_bounds,
+                                       parse_tile_access_cookie)
+
+loglevel = logging.DEBUG if os.environ.get('C3NAV_DEBUG', False) else os.environ.get('C3NAV_LOGLEVEL', 'INFO').upper()
+
+logging.basicConfig(level=loglevel,
+                    format='[%(asctime)s] [%(process)s] [%(levelname)s] %(name)s: %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S %z')
+
+logger = logging.getLogger('c3nav')
+
+if os.environ.get('C3NAV_LOGFILE'):
+    logging.basicConfig(filename=os.environ['C3NAV_LOGFILE'])
+
+
+# status, headers, body
+Response = tuple[str, list[tuple[str, str]], bytes]
+
+
+class TileRequest(NamedTuple):
+    level: int
+    zoom: int
+    x: int
+    y: int
+    theme_id: int
+    theme_key: str
+    base_cache_key: str
+    access_cache_key: str
+    etag: str
+    cache_key: str
+
+    @property
+    def upstream_path(self):
+        return '/map/%d/%d/%d/%d/%d/%s.png' % (self.level, self.zoom, self.x, self.y, self.theme_id,
+                                               self.access_cache_key)
+
+
+class TileLRUCache:
+    """
+    Thread-safe LRU cache of tile data, keyed by tile etag and bounded by the total size of the cached data.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.data: OrderedDict[str, bytes] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key) -> Optional[bytes]:
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value: bytes):
+        if len(value) > self.max_size:
+            return
+        with self.lock:
+            old_value = self.data.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self.data[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                self.size -= len(self.data.popitem(last=False)[1])
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self.data),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else None,
+            }
+
+
+class TileServer:
+    def __init__(self):
+        self.path_regex = re.compile(r'^/(\d+)/(-?\d+)/(-?\d+)/(-?\d+)(/(-?\d+))?.png$')
+
+        self.cookie_regex = re.compile(r'(^| )c3nav_tile_access="?([^;" ]+)"?')
+
+        try:
+            self.upstream_base = os.environ['C3NAV_UPSTREAM_BASE'].strip('/')
+        except KeyError:
+            raise Exception('C3NAV_UPSTREAM_BASE needs to be set.')
+
+        try:
+            self.data_dir = os.environ.get('C3NAV_DATA_DIR', 'data')
+        except KeyError:
+            raise Exception('C3NAV_DATA_DIR needs to be set.')
+
+        if not os.path.exists(self.data_dir):
+            os.mkdir(self.data_dir)
+
+        self.tile_secret = os.environ.get('C3NAV_TILE_SECRET', None)
+        if not self.tile_secret:
+            tile_secret_file = None
+            try:
+                tile_secret_file = os.environ['C3NAV_TILE_SECRET_FILE']
+                self.tile_secret = open(tile_secret_file).read().strip()
+            except KeyError:
+                raise Exception('C3NAV_TILE_SECRET or C3NAV_TILE_SECRET_FILE need to be set.')
+            except FileNotFoundError:
+                raise Exception('The C3NAV_TILE_SECRET_FILE (%s) does not exist.' % tile_secret_file)
+
+        # optional sqlite tile store, can be shared between all tileserver processes on this machine
+        self.tile_store = None
+        tile_store_file = os.environ.get('C3NAV_TILE_STORE_FILE', None)
+        if tile_store_file:
+            self.tile_store = TileStore(tile_store_file)
+
+        # in-process cache for the hottest tiles, size in megabytes, 0 disables it
+        self.tile_lru = None
+        tile_lru_size = int(os.environ.get('C3NAV_TILE_LRU_SIZE', 64))
+        if tile_lru_size:
+            self.tile_lru = TileLRUCache(tile_lru_size * 1024 * 1024)
+
+        self.reload_interval = int(os.environ.get('C3NAV_RELOAD_INTERVAL', 60))
+
+        self.http_auth_credentials = None
+        self.http_auth = os.environ.get('C3NAV_HTTP_AUTH', None)
+        if self.http_auth:
+            self.http_auth_credentials = tuple(self.http_auth.split(':', 1))
+            self.http_auth = HTTPBasicAuth(*self.http_auth_credentials)
+
+        self.auth_headers = {'X-Tile-Secret': base64.b64encode(self.tile_secret.encode()).decode()}
+
+        # reuse upstream connections
+        self.session = requests.Session()
+        self.session.headers.update(self.auth_headers)
+        self.session.auth = self.http_auth
+
+        # the package, its etag and its processed geometry update always belong together,
+        # they are only changed by switching to the package file in get_cache_package
+        self.processed_geometry_update = None
+        self.cache_package = None
+        self.cache_package_etag = None
+        # all worker processes memory-map this file, it is replaced atomically when a new package is loaded.
+        # only the process holding the lock on the lock file downloads packages and writes it.
+        self.cache_package_filename = os.path.join(self.data_dir, 'package.mmap')
+        self.cache_package_lock_filename = os.path.join(self.data_dir, 'package.mmap.lock')
+        self.cache_package_file_id = None
+        self.cache_package_last_check = 0
+        self.cache_package_switch_lock = threading.Lock()
+        # set if upstream sent a delta package we can't apply, so the next download is a full package
+        self.cache_package_full_download = False
+
+        cache = self.get_cache_client()
+
+        wait = 1
+        while True:
+            success = self.load_cache_package(cache=cache)
+            if success:
+                logger.info('Cache package successfully loaded.')
+                break
+            logger.info('Retrying after %s seconds...' % wait)
+            time.sleep(wait)
+            wait = min(10, wait*2)
+
+        threading.Thread(target=self.update_cache_package_thread, daemon=True).start()
+
+    @staticmethod
+    def get_cache_client():
+        servers = os.environ.get('C3NAV_MEMCACHED_SERVER', '127.0.0.1').split(',')
+        return pylibmc.Client(servers, binary=True, behaviors={"tcp_nodelay": True, "ketama": True})
+
+    def update_cache_package_thread(self):
+        cache = self.get_cache_client()  # different thread → different client!
+        while True:
+            time.sleep(self.reload_interval)
+            self.load_cache_package(cache=cache)
+
+    def get_date_header(self):
+        return 'Date', formatdate(timeval=time.time(), localtime=False, usegmt=True)
+
+    def load_cache_package(self, cache):
+        with open(self.cache_package_lock_filename, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # another process might have written a newer package while we were waiting
+            self.get_cache_package(force=True)
+            return self._load_cache_package(cache)
+
+    def _load_cache_package(self, cache):
+        logger.debug('Downloading cache package from upstream...')
+        try:
+            headers = self.auth_headers.copy()
+            if self.cache_package_etag is not None and not self.cache_package_full_download:
+                headers['If-None-Match'] = self.cache_package_etag
+            # if we already have a package, upstream only sends us what changed
+            r = requests.get(self.upstream_base+'/map/cache/package-delta.tar.zst', headers=headers,
+                             auth=self.http_auth, stream=True)
+            if r.status_code == 404:
+                # upstream doesn't support delta packages
+                r.close()
+                r = requests.get(self.upstream_base+'/map/cache/package.tar.zst', headers=headers,
+                                 auth=self.http_auth, stream=True)
+
+            if r.status_code == 403:
+                logger.error('Rejected cache package download with Error 403. Tile secret is probably incorrect.')
+                return False
+
+            if r.status_code == 401:
+                logger.error('Rejected cache package download with Error 401. You have HTTP Auth active.')
+                return False
+
+            if r.status_code == 304:
+                if self.cache_package is not None:
+                    logger.debug('Not modified.')
+                    cache.set('cache_package_last_successful_check', time.time())
+                    return True
+                logger.error('Unexpected not modified.')
+                return False
+
+            r.raise_for_status()
+        except Exception as e:
+            logger.error('Cache package download failed: %s' % e)
+            return False
+
+        processed_geometry_update = int(r.headers['X-Processed-Geometry-Update'])
+        if self.processed_geometry_update is not None and processed_geometry_update < self.processed_geometry_update:
+            # never go back to an older map state, e.g. if upstream is behind
+            r.close()
+            logger.warning('Upstream sent an older cache package (%d < %d), ignoring it.' %
+                           (processed_geometry_update, self.processed_geometry_update))
+            return self.cache_package is not None
+
+        logger.debug('Receiving and loading new cache package...')
+
+        try:
+            # decompress and parse while receiving
+            r.raw.decode_content = True
+            with r:
+                cache_package = CachePackage.read(r.raw, stream=True)
+            if cache_package.delta_base is not None:
+                if (self.cache_package is None or self.cache_package_etag is None or
+                        self.cache_package_etag.removeprefix('W/').strip('"') != cache_package.delta_base):
+                    self.cache_package_full_download = True
+                    raise ValueError('Got delta package for a different package.')
+                logger.debug('Applying delta package with %d changed levels.' % len(cache_package.levels))
+                cache_package = self.cache_package.apply_delta(cache_package)
+            cache_package.metadata = {
+                'etag': r.headers.get('ETag', None),
+                'processed_geometry_update': processed_geometry_update,
+            }
+        except Exception as e:
+            logger.error('Cache package parsing failed: %s' % e)
+            return False
+
+        try:
+            cache_package.save_mmap(self.cache_package_filename)
+        except Exception as e:
+            logger.error('Saving package failed: %s' % e)
+            return False
+        self.cache_package_full_download = False
+        self.get_cache_package(force=True)
+        cache.set('cache_package_last_successful_check', time.time())
+        return True
+
+    def not_found(self, text) -> Response:
+        return '404 Not Found', [self.get_date_header(),
+                                 ('Content-Type', 'text/plain'),
+                                 ('Content-Length', str(len(text)))], text
+
+    def internal_server_error(self, text=b'internal server error') -> Response:
+        return '500 Internal Server Error', [self.get_date_header(),
+                                             ('Content-Type', 'text/plain'),
+                                             ('Content-Length', str(len(text)))], text
+
+    def deliver_tile(self, etag, data) -> Response:
+        return '200 OK', [self.get_date_header(),
+                          ('Content-Type', 'image/png'),
+                          ('Content-Length', str(len(data))),
+                          ('Cache-Control', 'no-cache'),
+                          ('ETag', etag)], data
+
+    def liveness_check_response(self) -> Response:
+        self.get_cache_package()
+        text = b'OK'
+        return '200 OK', [self.get_date_header(),
+                          ('Content-Type', 'text/plain'),
+                          ('Content-Length', str(len(text)))], text
+
+    def readiness_check_response(self) -> Response:
+        text = b'OK'
+        error = False
+        try:
+            last_check = self.cache.get('cache_package_last_successful_check')
+        except pylibmc.Error:
+            error = True
+            text = b'memcached error'
+        else:
+            if last_check is None or last_check <= (time.time() - self.reload_interval * 3):
+                error = True
+                if last_check:
+                    text = f'last successful cache package check was {time.time() - last_check}s ago.'.encode('utf-8')
+                else:
+                    text = b'last successful cache package check is unknown'
+        return (('500 Internal Server Error' if error else '200 OK'),
+                [self.get_date_header(),
+                 ('Content-Type', 'text/plain'),
+                 ('Content-Length', str(len(text)))], text)
+
+    def get_cache_package(self, force=False):
+        # check at most once per second if the package file was replaced
+        now = time.monotonic()
+        if not force and self.cache_package is not None and now - self.cache_package_last_check < 1:
+            return self.cache_package
+
+        # if another thread is switching packages right now, keep using the current one
+        if not self.cache_package_switch_lock.acquire(blocking=force or self.cache_package is None):
+            return self.cache_package
+        try:
+            self.cache_package_last_check = now
+            try:
+                stat = os.stat(self.cache_package_filename)
+            except FileNotFoundError:
+                if self.cache_package is not None:
+                    logger.warning('cache package file went missing.')
+                return self.cache_package
+            file_id = (stat.st_ino, stat.st_mtime_ns)
+            if self.cache_package_file_id != file_id:
+                logger.debug('Loading new cache package in worker.')
+                cache_package = CachePackage.open_mmap(self.cache_package_filename)
+                processed_geometry_update = cache_package.metadata.get('processed_geometry_update', None)
+                if processed_geometry_update != self.processed_geometry_update and self.tile_lru is not None:
+                    # tiles of the old map state are no longer needed
+                    self.tile_lru.clear()
+                self.cache_package = cache_package
+                self.cache_package_etag = cache_package.metadata.get('etag', None)
+                self.processed_geometry_update = processed_geometry_update
+                self.cache_package_file_id = file_id
+            return self.cache_package
+        finally:
+            self.cache_package_switch_lock.release()
+
+    @property
+    def cache(self):
+        cache = self.get_cache_client()
+        self.__dict__['cache'] = cache
+        return cache
+
+    def stats_response(self) -> Response:
+        text = json.dumps({
+            'pid': os.getpid(),
+            'processed_geometry_update': self.processed_geometry_update,
+            'tile_lru': self.tile_lru.stats() if self.tile_lru is not None else None,
+        }).encode()
+        return '200 OK', [self.get_date_header(),
+                          ('Content-Type', 'application/json'),
+                          ('Content-Length', str(len(text)))], text
+
+    def handle_request(self, path_info, cookie, if_none_match) -> Response | TileRequest:
+        """
+        Handle everything that doesn't need the tile data. Returns either a response or the tile to deliver.
+        """
+        if path_info == '/health' or path_info == '/health/live':
+            return self.liveness_check_response()
+
+        if path_info == '/health/ready':
+            return self.readiness_check_response()
+
+        if path_info == '/stats':
+            return self.stats_response()
+
+        match = self.path_regex.match(path_info)
+        if match is None:
+            return self.not_found(b'invalid tile path.')
+
+        level, zoom, x, y, _, theme = match.groups()
+        if theme is None:
+            theme = 0
+
+        zoom = int(zoom)
+        if not (-2 <= zoom <= 5):
+            return self.not_found(b'zoom out of bounds.')
+
+        # do this to be thread safe
+        try:
+            cache_package = self.get_cache_package()
+        except Exception as e:
+            logger.error('get_cache_package() failed: %s' % e)
+            return self.internal_server_error()
+
+        # check if bounds are valid
+        x = int(x)
+        y = int(y)
+        minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+        if not cache_package.bounds_valid(minx, miny, maxx, maxy):
+            return self.not_found(b'coordinates out of bounds.')
+
+        # get level
+        level = int(level)
+        theme_id = int(theme)
+        theme = None if theme_id == 0 else theme_id
+        level_data = cache_package.levels.get((level, theme))
+        if level_data is None:
+            return self.not_found(b'invalid level or theme.')
+
+        # build cache keys
+        last_update = level_data.history.last_update(minx, miny, maxx, maxy)
+        base_cache_key = build_base_cache_key(last_update)
+
+        # decode access permissions
+        access_permissions = set()
+        access_cache_key = '0'
+
+        if cookie:
+            cookie = self.cookie_regex.search(cookie)
+            if cookie:
+                cookie = cookie.group(2)
+                access_permissions = (
+                    parse_tile_access_cookie(cookie, self.tile_secret) &
+                    (set(level_data.restrictions[minx:maxx, miny:maxy]) | level_data.global_restrictions)
+                )
+                access_cache_key = build_access_cache_key(access_permissions)
+
+        if not all((r in access_permissions) for r in level_data.global_restrictions):
+            return self.not_found(b'invalid level or theme.')
+
+        # check browser cache
+        tile_etag = build_tile_etag(level, zoom, x, y, theme_id, base_cache_key, access_cache_key, self.tile_secret)
+        if if_none_match == tile_etag:
+            return '304 Not Modified', [self.get_date_header(),
+                                        ('Content-Length', '0'),
+                                        ('ETag', tile_etag)], b''
+
+        return TileRequest(level=level, zoom=zoom, x=x, y=y, theme_id=theme_id, theme_key=str(theme),
+                           base_cache_key=base_cache_key, access_cache_key=access_cache_key,
+                           etag=tile_etag, cache_key=path_info+'_'+tile_etag)
+
+    def get_cached_tile(self, tile: TileRequest) -> Optional[bytes]:
+        if self.tile_lru is not None:
+            data = self.tile_lru.get(tile.etag)
+            if data is not None:
+                return data
+
+        if self.tile_store is not None:
+            data = self.tile_store.get(tile.level, tile.zoom, tile.x, tile.y, tile.theme_key,
+                                       tile.base_cache_key, tile.access_cache_key)
+        else:
+            data = self.cache.get(tile.cache_key)
+
+        if data is not None and self.tile_lru is not None:
+            self.tile_lru.set(tile.etag, data)
+        return data
+
+    def handle_upstream_response(self, tile: TileRequest, status_code, reason, headers, content) -> Response:
+        if status_code == 200 and headers['Content-Type'] == 'image/png':
+            if int(headers.get('X-Processed-Geometry-Update', 0)) < (self.processed_geometry_update or 0):
+                error = b'upstream is outdated'
+                return '503 Service Unavailable', [self.get_date_header(),
+                                                   ('Content-Length', str(len(error)))], error
+            if self.tile_store is not None:
+                self.tile_store.put(tile.level, tile.zoom, tile.x, tile.y, tile.theme_key,
+                                    tile.base_cache_key, tile.access_cache_key, content)
+            else:
+                self.cache.set(tile.cache_key, content)
+            if self.tile_lru is not None:
+                self.tile_lru.set(tile.etag, content)
+            return self.deliver_tile(tile.etag, content)
+
+        return '%d %s' % (status_code, reason), [
+            self.get_date_header(),
+            ('Content-Length', str(len(content))),
+            ('Content-Type', headers.get('Content-Type', 'text/plain'))
+        ], content
+
+    def __call__(self, env, start_response):
+        result = self.handle_request(env['PATH_INFO'], env.get('HTTP_COOKIE', None), env.get('HTTP_IF_NONE_MATCH'))
+
+        if isinstance(result, TileRequest):
+            tile = result
+            cached_result = self.get_cached_tile(tile)
+            if cached_result is not None:
+                result = self.deliver_tile(tile.etag, cached_result)
+            else:
+                r = self.session.get(self.upstream_base+tile.upstream_path)
+                result = self.handle_upstream_response(tile, r.status_code, r.reason, r.headers, r.content)
+
+        status, headers, body = result
+        start_response(status, headers)
+        return [body]